@@ -0,0 +1,227 @@
+"""
+Micro-benchmark: compiled rule engine vs. the original check_basic_violations
+
+Usage:
+    python benchmarks/bench_rules.py [--iterations 2000]
+
+Both implementations are run over the same corpus of short and long posts.
+The script first checks that they agree on every post, then reports the
+per-call time for each.
+
+It then times the phrase matchers on their own: the engine's substring
+search over each phrase list against one compiled regex alternation of the
+same phrases, and an Aho-Corasick automaton when pyahocorasick is
+installed. Each matcher must agree with the substring search on every post.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rules import CONFIDENTIAL_PHRASES, HARASSMENT_PHRASES, SOLICITATION_PHRASES, rule_engine  # noqa: E402
+
+PHRASE_LISTS = [SOLICITATION_PHRASES, HARASSMENT_PHRASES, CONFIDENTIAL_PHRASES]
+
+
+def legacy_check_basic_violations(content: str) -> Optional[dict]:
+    """The original per-pattern implementation, kept verbatim for comparison"""
+    import re
+
+    solicitation_patterns = [
+        r"connect you with",
+        r"business opportunity",
+        r"let me introduce you to",
+        r"sales pitch",
+        r"promotional offer",
+        r"investment opportunity",
+        r"get rich quick",
+        r"make money fast"
+    ]
+
+    pii_patterns = [
+        r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',  # Email
+        r'\b\d{3}[-.]?\d{3}[-.]?\d{4}\b',  # Phone
+        r'\b\d{3}-\d{2}-\d{4}\b',  # SSN
+        r'\b\d{5}[-.]?\d{4}\b',  # ZIP+4
+    ]
+
+    harassment_patterns = [
+        r"you're an idiot",
+        r"you're all stupid",
+        r"this is worthless",
+        r"shut up",
+        r"you're incompetent",
+        r"this is garbage"
+    ]
+
+    confidential_patterns = [
+        r"confidential",
+        r"internal only",
+        r"not for public",
+        r"company secret",
+        r"proprietary information"
+    ]
+
+    content_lower = content.lower()
+
+    for pattern in solicitation_patterns:
+        if re.search(pattern, content_lower):
+            return {
+                "type": "solicitation",
+                "severity": 3,
+                "reason": "Contains promotional or sales content"
+            }
+
+    for pattern in pii_patterns:
+        if re.search(pattern, content):
+            return {
+                "type": "pii",
+                "severity": 4,
+                "reason": "Contains personal identifiable information"
+            }
+
+    for pattern in harassment_patterns:
+        if re.search(pattern, content_lower):
+            return {
+                "type": "harassment",
+                "severity": 5,
+                "reason": "Contains hostile or inappropriate language"
+            }
+
+    for pattern in confidential_patterns:
+        if re.search(pattern, content_lower):
+            return {
+                "type": "confidential",
+                "severity": 4,
+                "reason": "Contains confidential or proprietary information"
+            }
+
+    return None
+
+
+FILLER = (
+    "Our board asked for a revised growth plan after the last quarter. "
+    "We are weighing a regional expansion against deeper investment in the core product. "
+    "How have others balanced hiring velocity with burn when the market softened? "
+)
+
+SNIPPETS = [
+    "Hey everyone, I have a great business opportunity to share...",
+    "My email is john.doe@company.com and my phone is 555-1234",
+    "Call me at 415.555.0199 after the meeting",
+    "You're all stupid if you think that will work",
+    "This is CONFIDENTIAL, internal only please",
+    "Happy to connect you with our sales pitch team, it's proprietary information",
+    "Shut up and listen: this is garbage",
+    "Zip 94105-1234 is where the office is",
+    "What's everyone's favorite pizza topping?",
+    "İstanbul office numbers grew 12% this year",
+]
+
+
+def build_corpus(size: int, seed: int = 7) -> list:
+    """Mix of clean and violating posts, short and long"""
+    rng = random.Random(seed)
+    corpus = list(SNIPPETS)
+    for _ in range(size):
+        paragraphs = rng.randint(1, 40)
+        body = FILLER * paragraphs
+        if rng.random() < 0.5:
+            position = rng.randint(0, len(body))
+            body = body[:position] + " " + rng.choice(SNIPPETS) + " " + body[position:]
+        corpus.append(body)
+    return corpus
+
+
+def phrase_matchers() -> dict:
+    """Ways to find which phrase lists match lowercased content, by name"""
+    def substring(content_lower: str) -> list:
+        return [any(phrase in content_lower for phrase in phrases) for phrases in PHRASE_LISTS]
+
+    alternations = [re.compile("|".join(re.escape(phrase) for phrase in phrases)) for phrases in PHRASE_LISTS]
+
+    def alternation(content_lower: str) -> list:
+        return [pattern.search(content_lower) is not None for pattern in alternations]
+
+    matchers = {"substring": substring, "alternation": alternation}
+
+    try:
+        import ahocorasick
+    except ImportError:
+        print("pyahocorasick not installed, skipping the Aho-Corasick matcher")
+        return matchers
+
+    automaton = ahocorasick.Automaton()
+    for index, phrases in enumerate(PHRASE_LISTS):
+        for phrase in phrases:
+            lists = automaton.get(phrase, set())
+            lists.add(index)
+            automaton.add_word(phrase, lists)
+    automaton.make_automaton()
+
+    def aho_corasick(content_lower: str) -> list:
+        found = [False] * len(PHRASE_LISTS)
+        for _, lists in automaton.iter(content_lower):
+            for index in lists:
+                found[index] = True
+        return found
+
+    matchers["aho_corasick"] = aho_corasick
+    return matchers
+
+
+def time_per_post(func, corpus: list, iterations: int) -> float:
+    """Best per-post time in microseconds over three runs"""
+    elapsed = min(timeit.repeat(lambda: [func(content) for content in corpus], number=iterations, repeat=3))
+    return elapsed / (len(corpus) * iterations) * 1e6
+
+
+def compare_phrase_matchers(corpus: list, iterations: int):
+    lowered = [content.lower() for content in corpus]
+    matchers = phrase_matchers()
+    for name, func in matchers.items():
+        if any(func(content) != matchers["substring"](content) for content in lowered):
+            print(f"MISMATCH between {name} and substring phrase matching")
+            sys.exit(1)
+
+    print(f"Phrase matching ({sum(len(phrases) for phrases in PHRASE_LISTS)} phrases in {len(PHRASE_LISTS)} lists):")
+    for name, func in matchers.items():
+        re.purge()
+        print(f"{name:>12}: {time_per_post(func, lowered, iterations):8.2f} us/post")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20, help="passes over the corpus per timing run")
+    parser.add_argument("--corpus-size", type=int, default=200, help="number of generated posts")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.corpus_size)
+
+    mismatches = [
+        content for content in corpus
+        if legacy_check_basic_violations(content) != rule_engine.check(content)
+    ]
+    if mismatches:
+        print(f"MISMATCH on {len(mismatches)} posts, first: {mismatches[0][:120]!r}")
+        sys.exit(1)
+    print(f"Results identical on {len(corpus)} posts")
+
+    timings = {}
+    for name, func in (("legacy", legacy_check_basic_violations), ("rule_engine", rule_engine.check)):
+        re.purge()
+        timings[name] = time_per_post(func, corpus, args.iterations)
+        print(f"{name:>12}: {timings[name]:8.2f} us/post")
+
+    print(f"{'speedup':>12}: {timings['legacy'] / timings['rule_engine']:8.2f}x")
+    print()
+    compare_phrase_matchers(corpus, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Response serialization benchmark: FastAPI's default path versus encode_response
+
+Usage:
+    python benchmarks/bench_serialization.py [--requests 2000] [--batch-sizes 1,100,1000]
+
+Mounts the same prebuilt results on a bare FastAPI app twice: once
+returned as models with a response_model (FastAPI re-validates them, runs
+jsonable_encoder and json.dumps), once through encode_response as JSON
+(orjson) and as MessagePack (Accept: application/msgpack). The app is
+called directly over ASGI, without a client or server, so the CPU time
+measured is routing plus serialization only. Batch size 1 is a single
+ModerationResult (/moderate); larger sizes are /moderate/batch responses.
+
+Prints CPU microseconds per request, the CPU saved against the default
+path and the response size for each encoding.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from fastapi import FastAPI, Request  # noqa: E402
+
+from main import BatchModerationItem, ModerationResult, TokenUsage  # noqa: E402
+from serialization import encode_response  # noqa: E402
+
+
+def build_results(size: int):
+    items = []
+    for index in range(size):
+        if index % 3 == 0:
+            result = ModerationResult(
+                flagged=True,
+                violation_type="solicitation",
+                severity=3,
+                reason="Promotional content offering paid services to other members",
+                confidence=0.92,
+                tokens=TokenUsage(prompt_tokens=412, completion_tokens=38)
+            )
+        else:
+            result = ModerationResult(flagged=False, confidence=0.97, tokens=TokenUsage(prompt_tokens=388, completion_tokens=21))
+        items.append(BatchModerationItem(post_id=100000 + index, result=result))
+    return items
+
+
+def build_app(results) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/default/single", response_model=ModerationResult)
+    async def default_single():
+        return results[1][0].result
+
+    @app.get("/fast/single", response_model=ModerationResult)
+    async def fast_single(request: Request):
+        return encode_response(request, results[1][0].result)
+
+    @app.get("/default/batch/{size}", response_model=List[BatchModerationItem])
+    async def default_batch(size: int):
+        return results[size]
+
+    @app.get("/fast/batch/{size}", response_model=List[BatchModerationItem])
+    async def fast_batch(size: int, request: Request):
+        return encode_response(request, results[size])
+
+    return app
+
+
+async def call(app, path: str, accept: str) -> bytes:
+    """One GET straight through the ASGI app; returns the body"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"bench"), (b"accept", accept.encode())],
+        "client": ("127.0.0.1", 1), "server": ("bench", 80)
+    }
+    body = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return b"".join(body)
+
+
+async def measure(app, path: str, accept: str, requests: int):
+    """(CPU microseconds per request, response bytes)"""
+    size = len(await call(app, path, accept))
+    for _ in range(min(requests // 10, 50)):
+        await call(app, path, accept)
+    started = time.process_time()
+    for _ in range(requests):
+        await call(app, path, accept)
+    return (time.process_time() - started) / requests * 1e6, size
+
+
+async def run(args):
+    sizes = [int(size) for size in args.batch_sizes.split(",")]
+    results = {size: build_results(size) for size in set(sizes) | {1}}
+    app = build_app(results)
+
+    print(f"{'response':<18} {'encoding':<22} {'CPU us/req':>11} {'saved':>8} {'bytes':>9}")
+    for size in sizes:
+        requests = max(args.requests // max(size // 10, 1), 20)
+        name = "single" if size == 1 else f"batch of {size}"
+        suffix = "single" if size == 1 else f"batch/{size}"
+        baseline, baseline_bytes = await measure(app, f"/default/{suffix}", "application/json", requests)
+        print(f"{name:<18} {'default (validate+json)':<22} {baseline:>11.1f} {'':>8} {baseline_bytes:>9}")
+        for label, accept in (("orjson", "application/json"), ("msgpack", "application/msgpack")):
+            cpu, size_bytes = await measure(app, f"/fast/{suffix}", accept, requests)
+            saved = (1 - cpu / baseline) * 100
+            print(f"{'':<18} {label:<22} {cpu:>11.1f} {saved:>7.0f}% {size_bytes:>9}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per measurement for a single result")
+    parser.add_argument("--batch-sizes", default="1,100,1000")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,108 @@
+"""
+Local stand-in for the Discourse flag API, for offline tests of flag delivery
+
+Usage:
+    python benchmarks/fake_discourse.py [--port 8090] [--latency 0.05] \\
+        [--error-rate 0.0] [--reject-posts 13,42]
+
+Serves POST /post_actions.json like Discourse core: it needs the Api-Key
+and Api-Username headers, creates one flag per post and action type, and
+answers a repeat with 403 "already performed this action". Each request
+waits --latency seconds and fails with a 503 at --error-rate; posts in
+--reject-posts get a 404, which the service treats as permanent.
+
+GET /stats reports requests, created flags, duplicates (repeats of a
+flag already created) and the number of TCP connections opened, which
+shows whether the client reuses connections.
+
+Point the service at it with DISCOURSE_BASE_URL=http://127.0.0.1:<port>.
+"""
+import argparse
+import asyncio
+import random
+from dataclasses import dataclass, field
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+@dataclass
+class FakeDiscourseConfig:
+    latency: float = 0.05
+    error_rate: float = 0.0
+    reject_posts: set = field(default_factory=set)
+    seed: int = 7
+
+
+def build_app(config: FakeDiscourseConfig) -> Starlette:
+    rng = random.Random(config.seed)
+    flags = {}
+    connections = set()
+    stats = {"requests": 0, "errors": 0, "duplicates": 0, "idempotent_replays": 0}
+
+    async def post_actions(request: Request):
+        stats["requests"] += 1
+        connections.add(request.client)
+        if not request.headers.get("Api-Key") or not request.headers.get("Api-Username"):
+            return JSONResponse({"errors": ["You are not permitted to view the requested resource."]}, status_code=403)
+
+        body = await request.json()
+        await asyncio.sleep(config.latency)
+        if rng.random() < config.error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"errors": ["fake_discourse injected error"]}, status_code=503)
+
+        post_id = int(body["id"])
+        if post_id in config.reject_posts:
+            return JSONResponse({"errors": ["The requested URL or resource could not be found."]}, status_code=404)
+
+        flag_key = (post_id, int(body["post_action_type_id"]))
+        if flag_key in flags:
+            if flags[flag_key]["idempotency_key"] == request.headers.get("Idempotency-Key"):
+                stats["idempotent_replays"] += 1
+            stats["duplicates"] += 1
+            return JSONResponse({"errors": ["You have already performed this action."]}, status_code=403)
+
+        flags[flag_key] = {
+            "id": len(flags) + 1,
+            "post_id": post_id,
+            "post_action_type_id": flag_key[1],
+            "message": body.get("message"),
+            "idempotency_key": request.headers.get("Idempotency-Key")
+        }
+        return JSONResponse({"id": post_id, "actions_summary": [{"id": flag_key[1], "count": 1, "acted": True}]})
+
+    async def fake_stats(request: Request):
+        return JSONResponse({**stats, "flags": len(flags), "connections": len(connections)})
+
+    return Starlette(routes=[
+        Route("/post_actions.json", post_actions, methods=["POST"]),
+        Route("/stats", fake_stats)
+    ])
+
+
+def main_cli():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 503")
+    parser.add_argument("--reject-posts", default="", help="comma-separated post ids answered with a 404")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    config = FakeDiscourseConfig(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        reject_posts={int(post_id) for post_id in args.reject_posts.split(",") if post_id.strip()},
+        seed=args.seed
+    )
+    uvicorn.run(build_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main_cli()
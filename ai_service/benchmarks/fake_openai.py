@@ -0,0 +1,174 @@
+"""
+Local OpenAI-compatible stand-in for offline benchmarks
+
+Usage:
+    python benchmarks/fake_openai.py [--port 8089] [--latency 0.4] [--jitter 0.2] \\
+        [--error-rate 0.0] [--tokens 120] [--tokens-per-second 60]
+
+Serves POST /v1/chat/completions, streamed or not. Each completion waits
+--latency seconds (plus up to --jitter, uniformly), fails with a 500 at
+--error-rate, and reports --tokens completion tokens in its usage block.
+Streamed completions send one chunk per token at --tokens-per-second.
+
+Replies are shaped for the prompt they answer, so the service parses them
+like real ones: moderation prompts get an unflagged verdict (a JSON array
+for micro-batched prompts), Vera prompts a verification result, and peer
+reply prompts --tokens words of text.
+
+Point the service at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from dataclasses import dataclass
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+WORDS = (
+    "board strategy capital growth market talent leadership margin pipeline "
+    "customers pricing succession runway integration culture hiring forecast"
+).split()
+
+
+@dataclass
+class FakeOpenAIConfig:
+    latency: float = 0.4
+    jitter: float = 0.2
+    error_rate: float = 0.0
+    tokens: int = 120
+    tokens_per_second: float = 60.0
+    seed: int = 7
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token)"""
+    return max(1, len(text) // 4)
+
+
+def reply_content(messages: list, tokens: int, rng: random.Random) -> str:
+    """Completion text shaped for the prompt it answers"""
+    system = messages[0]["content"] if messages else ""
+    prompt = messages[-1]["content"] if messages else ""
+
+    if "Vera" in system:
+        return json.dumps({
+            "recommendation": "review_required",
+            "confidence_score": 0.6,
+            "risk_factors": [],
+            "analysis": {"notes": "fake_openai stand-in"}
+        })
+    if "content moderator" in system:
+        verdict = {"flagged": False, "confidence": 0.9}
+        if "JSON array" in prompt:
+            count = len(re.findall(r"^\s*\[\d+\] ", prompt, re.MULTILINE))
+            return json.dumps([{"index": index, **verdict} for index in range(1, count + 1)])
+        return json.dumps(verdict)
+    return " ".join(rng.choice(WORDS) for _ in range(tokens))
+
+
+def build_app(config: FakeOpenAIConfig) -> Starlette:
+    rng = random.Random(config.seed)
+    stats = {"requests": 0, "errors": 0, "streams": 0}
+
+    async def completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        await asyncio.sleep(config.latency + rng.uniform(0, config.jitter))
+
+        if rng.random() < config.error_rate:
+            stats["errors"] += 1
+            return JSONResponse(
+                {"error": {"message": "fake_openai injected error", "type": "server_error"}},
+                status_code=500
+            )
+
+        messages = body.get("messages", [])
+        model = body.get("model", "gpt-4")
+        content = reply_content(messages, config.tokens, rng)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        prompt_tokens = sum(estimate_tokens(message.get("content", "")) for message in messages)
+
+        if body.get("stream"):
+            stats["streams"] += 1
+            return StreamingResponse(
+                stream_chunks(completion_id, created, model, content),
+                media_type="text/event-stream"
+            )
+
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": config.tokens,
+                "total_tokens": prompt_tokens + config.tokens
+            }
+        })
+
+    async def stream_chunks(completion_id: str, created: int, model: str, content: str):
+        interval = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+        pieces = re.findall(r"\S+\s*", content) or [content]
+        for piece in pieces:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+            if interval:
+                await asyncio.sleep(interval)
+        yield "data: [DONE]\n\n"
+
+    async def fake_stats(request: Request):
+        return JSONResponse(stats)
+
+    return Starlette(routes=[
+        Route("/v1/chat/completions", completions, methods=["POST"]),
+        Route("/stats", fake_stats)
+    ])
+
+
+def main_cli():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.4, help="base completion latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="extra uniform latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of completions answered with a 500")
+    parser.add_argument("--tokens", type=int, default=120, help="completion tokens per reply")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0, help="streaming speed (0 sends at once)")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    config = FakeOpenAIConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        tokens=args.tokens,
+        tokens_per_second=args.tokens_per_second,
+        seed=args.seed
+    )
+    uvicorn.run(build_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,371 @@
+"""
+Offline load test: drive the service at a target request rate against a local OpenAI stand-in
+
+Usage:
+    python benchmarks/load_test.py [--rps 50] [--duration 20] [--endpoints moderate,webhook,reply,verify] \\
+        [--latency 0.4] [--jitter 0.2] [--error-rate 0.0] [--tokens 120] \\
+        [--url http://127.0.0.1:8000] [--json report.json] [--max-p99-ms 3000] [--max-error-rate 0.01]
+
+By default it starts benchmarks/fake_openai.py and the service (uvicorn
+main:app) as subprocesses on free local ports, with the service pointed at
+the stand-in through OPENAI_BASE_URL. No network access is needed. Pass
+--url to target a service that is already running (and already pointed at
+a stand-in).
+
+Each endpoint is driven in turn at --rps for --duration seconds. The load is
+open-loop: requests are sent on a fixed schedule whether or not earlier ones
+have finished, and latency is measured from the scheduled send time, so a
+stalled service shows up as latency rather than as a lower request rate.
+
+For each endpoint it reports throughput, error rate, p50/p95/p99/max
+latency and the service's event-loop lag (from cop_ai_event_loop_lag_seconds
+on /metrics). For /webhook it also reports how long the queue took to drain.
+Injected stand-in errors are retried by the OpenAI client, so they show up
+as tail latency first and as endpoint errors only once retries run out.
+Exits non-zero if --max-p99-ms or --max-error-rate is exceeded, so it can
+gate deploys.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCHMARK_DIR)
+
+ENDPOINTS = ("moderate", "webhook", "reply", "verify")
+LAG_METRIC = "cop_ai_event_loop_lag_seconds"
+
+# Neutral vocabulary: random sentences from it pass the regex pre-filter and
+# are too dissimilar to trip the near-duplicate index or hit the result cache
+VOCABULARY = (
+    "quarter planning board review budget roadmap hiring retention pricing "
+    "margin forecast runway investor update strategy offsite culture feedback "
+    "succession onboarding vendor contract renewal churn expansion segment "
+    "partner channel launch timeline headcount compensation audit committee "
+    "governance reporting metrics dashboard priorities tradeoffs alignment "
+    "delegation coaching resilience workload calendar travel market signal"
+).split()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+class RequestFactory:
+    """Unique request bodies, so caches and in-flight dedup do not flatter the numbers"""
+
+    def __init__(self, seed: int = 11):
+        self.rng = random.Random(seed)
+        self.counter = 0
+
+    def _sentence(self) -> str:
+        words = [self.rng.choice(VOCABULARY) for _ in range(self.rng.randint(18, 40))]
+        return " ".join(words).capitalize() + "?"
+
+    def build(self, endpoint: str):
+        self.counter += 1
+        post = {
+            "post_id": 1_000_000 + self.counter,
+            "user_id": 10_000 + self.counter % 500,
+            "peer_id": f"Peer #{self.counter % 500:03d}",
+            "content": self._sentence(),
+            "room_id": self.counter % 6 + 1
+        }
+        if endpoint == "moderate":
+            return "POST", "/moderate", post
+        if endpoint == "reply":
+            return "POST", "/reply", post
+        if endpoint == "webhook":
+            return "POST", "/webhook", {"event_type": "post_created", **post}
+        if endpoint == "verify":
+            return "POST", "/verify", {
+                "user_info": {"name": f"Applicant {self.counter}", "title": "CFO", "company": f"Company {self.counter}"},
+                "application_data": {"linkedin": f"https://example.com/in/{self.counter}"},
+                "criteria": [{"name": "Executive role", "description": "C-level title", "weight": 1.0}]
+            }
+        raise ValueError(f"Unknown endpoint: {endpoint}")
+
+
+class LoopLagProbe:
+    """Measures the load generator's own event-loop lag (a saturated client skews results)"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def scrape_lag_histogram(client: httpx.AsyncClient) -> Dict[float, float]:
+    """Cumulative bucket counts of the service's event-loop lag histogram"""
+    response = await client.get("/metrics")
+    buckets = {}
+    for family in text_string_to_metric_families(response.text):
+        if family.name != LAG_METRIC:
+            continue
+        for sample in family.samples:
+            if sample.name == f"{LAG_METRIC}_bucket":
+                buckets[float(sample.labels["le"])] = sample.value
+    return buckets
+
+
+def lag_summary(before: Dict[float, float], after: Dict[float, float]) -> Optional[dict]:
+    """Quantiles (bucket upper bounds) of the lag samples taken between two scrapes"""
+    if not after:
+        return None
+    bounds = sorted(after)
+    counts = [after[bound] - before.get(bound, 0.0) for bound in bounds]
+    total = counts[-1]
+    if total <= 0:
+        return None
+
+    def quantile(q: float) -> float:
+        for bound, count in zip(bounds, counts):
+            if count >= q * total:
+                return bound
+        return bounds[-1]
+
+    return {
+        "samples": int(total),
+        "p50_ms": quantile(0.5) * 1000,
+        "p99_ms": quantile(0.99) * 1000,
+        "max_ms": quantile(1.0) * 1000
+    }
+
+
+async def wait_for_webhook_drain(client: httpx.AsyncClient, timeout: float = 120.0) -> Optional[float]:
+    """Seconds until the webhook queue is empty and idle, or None on timeout"""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        queue = (await client.get("/health")).json().get("webhook_queue", {})
+        if not queue.get("depth") and not queue.get("in_flight") and not queue.get("pending_retries"):
+            return time.perf_counter() - start
+        await asyncio.sleep(0.1)
+    return None
+
+
+async def drive(client: httpx.AsyncClient, factory: RequestFactory, endpoint: str, rps: float, duration: float) -> dict:
+    """Send requests on an open-loop schedule and collect per-request results"""
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    tasks = []
+
+    async def send(scheduled: float, method: str, path: str, body: dict):
+        try:
+            response = await client.request(method, path, json=body)
+            status = str(response.status_code)
+        except Exception as e:
+            status = type(e).__name__
+        latencies.append(time.perf_counter() - scheduled)
+        statuses[status] = statuses.get(status, 0) + 1
+
+    total = int(rps * duration)
+    start = time.perf_counter()
+    for index in range(total):
+        scheduled = start + index / rps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(scheduled, *factory.build(endpoint))))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    ok = sum(count for status, count in statuses.items() if status.startswith("2"))
+    return {
+        "endpoint": endpoint,
+        "requests": total,
+        "ok": ok,
+        "error_rate": round(1 - ok / total, 4) if total else 0.0,
+        "statuses": statuses,
+        "throughput_rps": round(ok / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=0.0) * 1000
+    }
+
+
+async def run(args, url: str) -> List[dict]:
+    factory = RequestFactory(seed=args.seed)
+    probe = LoopLagProbe()
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    results = []
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=args.timeout) as client:
+        for endpoint in args.endpoints:
+            if args.warmup > 0:
+                await drive(client, factory, endpoint, args.rps, args.warmup)
+
+            lag_before = await scrape_lag_histogram(client)
+            probe.start()
+            result = await drive(client, factory, endpoint, args.rps, args.duration)
+            await probe.stop()
+            if endpoint == "webhook":
+                result["queue_drain_seconds"] = await wait_for_webhook_drain(client)
+            result["service_loop_lag"] = lag_summary(lag_before, await scrape_lag_histogram(client))
+            result["client_loop_lag_max_ms"] = max(probe.samples, default=0.0) * 1000
+            results.append(result)
+            print_result(result)
+
+    return results
+
+
+def print_result(result: dict):
+    lag = result["service_loop_lag"]
+    lag_text = f"loop lag p50 {lag['p50_ms']:.1f} / p99 {lag['p99_ms']:.1f} ms" if lag else "loop lag n/a"
+    print(
+        f"{result['endpoint']:>9}: {result['requests']} req, {result['throughput_rps']:.1f} ok/s, "
+        f"errors {result['error_rate']:.2%}, p50 {result['p50_ms']:.0f} / p95 {result['p95_ms']:.0f} / "
+        f"p99 {result['p99_ms']:.0f} / max {result['max_ms']:.0f} ms, {lag_text}"
+    )
+    if result.get("queue_drain_seconds") is not None:
+        print(f"{'':>9}  webhook queue drained in {result['queue_drain_seconds']:.2f}s")
+    if result["client_loop_lag_max_ms"] > 50:
+        print(f"{'':>9}  warning: load generator loop lagged {result['client_loop_lag_max_ms']:.0f} ms, lower --rps")
+    non_ok = {status: count for status, count in result["statuses"].items() if not status.startswith("2")}
+    if non_ok:
+        print(f"{'':>9}  non-2xx: {json.dumps(non_ok, sort_keys=True)}")
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"{' '.join(process.args)} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    sys.exit(f"Timed out waiting for {url}")
+
+
+def start_stack(args) -> Tuple[str, List[subprocess.Popen]]:
+    """Start the OpenAI stand-in and the service; return the service URL and processes"""
+    fake_port, service_port = free_port(), free_port()
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(BENCHMARK_DIR, "fake_openai.py"),
+        "--port", str(fake_port),
+        "--latency", str(args.latency),
+        "--jitter", str(args.jitter),
+        "--error-rate", str(args.error_rate),
+        "--tokens", str(args.tokens)
+    ])
+    wait_until_up(f"http://127.0.0.1:{fake_port}/stats", fake)
+
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+        "EVENT_LOOP_MONITOR_INTERVAL_SECONDS": "0.1"
+    })
+    env.pop("REDIS_URL", None)
+    log = open(args.service_log, "w") if args.service_log else subprocess.DEVNULL
+    service = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(service_port), "--log-level", "warning"],
+        cwd=SERVICE_DIR,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT
+    )
+    url = f"http://127.0.0.1:{service_port}"
+    wait_until_up(f"{url}/", service)
+    return url, [service, fake]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rps", type=float, default=50, help="target requests per second per endpoint")
+    parser.add_argument("--duration", type=float, default=20, help="measured seconds per endpoint")
+    parser.add_argument("--warmup", type=float, default=2, help="unmeasured seconds per endpoint")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="comma-separated subset of " + ",".join(ENDPOINTS))
+    parser.add_argument("--latency", type=float, default=0.4, help="stand-in completion latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="stand-in extra uniform latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="stand-in error rate")
+    parser.add_argument("--tokens", type=int, default=120, help="stand-in completion tokens per reply")
+    parser.add_argument("--url", help="target an already running service instead of starting one")
+    parser.add_argument("--service-log", help="write the started service's log to this file")
+    parser.add_argument("--max-connections", type=int, default=1000)
+    parser.add_argument("--timeout", type=float, default=60.0, help="client request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--max-p99-ms", type=float, help="fail if any endpoint's p99 exceeds this")
+    parser.add_argument("--max-error-rate", type=float, help="fail if any endpoint's error rate exceeds this")
+    args = parser.parse_args()
+
+    args.endpoints = [name.strip() for name in args.endpoints.split(",") if name.strip()]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+    processes = []
+    url = args.url
+    if not url:
+        url, processes = start_stack(args)
+    print(
+        f"Driving {url} at {args.rps:g} rps for {args.duration:g}s per endpoint "
+        f"(stand-in latency {args.latency:g}s + {args.jitter:g}s jitter, error rate {args.error_rate:g})"
+    )
+
+    try:
+        results = asyncio.run(run(args, url))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=30)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != "json"}, "results": results}, f, indent=2)
+
+    failed = False
+    for result in results:
+        if args.max_p99_ms is not None and result["p99_ms"] > args.max_p99_ms:
+            print(f"FAIL {result['endpoint']}: p99 {result['p99_ms']:.0f} ms > {args.max_p99_ms:g} ms")
+            failed = True
+        if args.max_error_rate is not None and result["error_rate"] > args.max_error_rate:
+            print(f"FAIL {result['endpoint']}: error rate {result['error_rate']:.2%} > {args.max_error_rate:.2%}")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
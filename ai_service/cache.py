@@ -0,0 +1,155 @@
+"""
+Result cache for AI verdicts.
+
+Two tiers:
+
+- an in-process LRU with a per-entry TTL
+- an optional Redis tier (REDIS_URL) shared by every uvicorn worker
+
+Keys are SHA-256 digests of the normalized content plus whatever versions
+the caller passes in (model, prompt version), so a prompt or model change
+never serves stale verdicts. Redis errors are logged and treated as misses;
+the cache never fails a request.
+"""
+import hashlib
+import json
+import logging
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_content(content: str) -> str:
+    """Normalize content so trivially different copies share a cache key"""
+    return " ".join(unicodedata.normalize("NFC", content).split())
+
+
+class ResultCache:
+    """LRU + TTL cache with an optional shared Redis tier"""
+
+    def __init__(
+        self,
+        namespace: str,
+        max_entries: int = 10000,
+        ttl_seconds: float = 3600,
+        redis_url: Optional[str] = None
+    ):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.redis_url = redis_url
+
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._redis = None
+
+        self.hits = 0
+        self.misses = 0
+        self.redis_hits = 0
+        self.redis_errors = 0
+
+    def make_key(self, content: str, *versions: str) -> str:
+        """Build a cache key from the normalized content and version strings"""
+        digest = hashlib.sha256()
+        for part in versions:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\x1f")
+        digest.update(normalize_content(content).encode("utf-8"))
+        return digest.hexdigest()
+
+    async def start(self):
+        """Connect the Redis tier if one is configured"""
+        if not self.redis_url or self._redis is not None:
+            return
+        try:
+            import redis.asyncio as redis
+
+            self._redis = redis.from_url(self.redis_url)
+            await self._redis.ping()
+            logger.info(f"{self.namespace} cache using Redis tier at {self.redis_url}")
+        except Exception as e:
+            logger.warning(f"{self.namespace} cache Redis tier unavailable, using local cache only: {str(e)}")
+            self._redis = None
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.close()
+        self._redis = None
+
+    def _redis_key(self, key: str) -> str:
+        return f"cop:{self.namespace}:{key}"
+
+    def _get_local(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_local(self, key: str, value: dict):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[dict]:
+        """Look up a cached value, checking the local tier before Redis"""
+        value = self._get_local(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        if self._redis is not None:
+            try:
+                raw = await self._redis.get(self._redis_key(key))
+                if raw is not None:
+                    value = json.loads(raw)
+                    self._set_local(key, value)
+                    self.hits += 1
+                    self.redis_hits += 1
+                    return value
+            except Exception as e:
+                self.redis_errors += 1
+                logger.warning(f"{self.namespace} cache Redis get error: {str(e)}")
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: dict):
+        """Store a value in both tiers"""
+        self._set_local(key, value)
+        if self._redis is not None:
+            try:
+                await self._redis.set(self._redis_key(key), json.dumps(value), ex=int(self.ttl_seconds))
+            except Exception as e:
+                self.redis_errors += 1
+                logger.warning(f"{self.namespace} cache Redis set error: {str(e)}")
+
+    async def invalidate(self, key: str):
+        """Drop a value from both tiers"""
+        self._entries.pop(key, None)
+        if self._redis is not None:
+            try:
+                await self._redis.delete(self._redis_key(key))
+            except Exception as e:
+                self.redis_errors += 1
+                logger.warning(f"{self.namespace} cache Redis delete error: {str(e)}")
+
+    def stats(self) -> dict:
+        """Hit/miss counters for /health and metrics"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "redis_hits": self.redis_hits,
+            "redis_errors": self.redis_errors,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self._entries),
+            "redis_enabled": self._redis is not None
+        }
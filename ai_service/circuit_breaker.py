@@ -0,0 +1,163 @@
+"""
+Circuit breaker for upstream LLM calls.
+
+Each breaker keeps a rolling window of recent call outcomes. When enough
+calls in the window have failed, or run slower than slow_call_seconds, the
+circuit opens and calls are rejected immediately with CircuitOpenError, so
+callers reach their fallback path without waiting on a struggling upstream.
+
+After open_seconds the circuit goes half-open and lets up to
+half_open_max_calls probe calls through. The first probe to finish decides:
+success closes the circuit, a failure or slow call reopens it.
+"""
+import logging
+import time
+from collections import deque
+from typing import Deque, Tuple
+
+from metrics import CIRCUIT_REJECTIONS, CIRCUIT_STATE
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling upstream while the circuit is open"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"circuit {name} is open (retry in {retry_after:.1f}s)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Rolling-window error and latency circuit breaker with a half-open probe state"""
+
+    def __init__(
+        self,
+        name: str,
+        window_seconds: float = 30.0,
+        min_calls: int = 10,
+        error_rate_threshold: float = 0.5,
+        slow_call_seconds: float = 10.0,
+        slow_call_rate_threshold: float = 0.5,
+        open_seconds: float = 15.0,
+        half_open_max_calls: int = 1
+    ):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate_threshold = error_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+
+        # (finished_at, failed, slow), oldest first
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()
+        self._failures = 0
+        self._slow = 0
+
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+
+        self.rejected = 0
+        self.opened = 0
+        CIRCUIT_STATE.labels(name).set(STATE_VALUES[CLOSED])
+
+    def _set_state(self, state: str, now: float):
+        if state == self.state:
+            return
+        logger.warning(f"Circuit {self.name}: {self.state} -> {state}")
+        self.state = state
+        CIRCUIT_STATE.labels(self.name).set(STATE_VALUES[state])
+        if state == OPEN:
+            self._opened_at = now
+            self.opened += 1
+        if state != HALF_OPEN:
+            self._probes = 0
+        if state == CLOSED:
+            self._calls.clear()
+            self._failures = self._slow = 0
+
+    def _prune(self, now: float):
+        cutoff = now - self.window_seconds
+        while self._calls and self._calls[0][0] < cutoff:
+            _, failed, slow = self._calls.popleft()
+            self._failures -= failed
+            self._slow -= slow
+
+    def allow(self) -> bool:
+        """
+        Take permission for one upstream call.
+
+        Returns False (and counts a rejection) if the circuit is open, or if
+        it is half-open and the probe slots are taken. Every True must be
+        followed by record() or release().
+        """
+        now = time.monotonic()
+        if self.state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._set_state(HALF_OPEN, now)
+
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and self._probes < self.half_open_max_calls:
+            self._probes += 1
+            return True
+
+        self.rejected += 1
+        CIRCUIT_REJECTIONS.labels(self.name).inc()
+        return False
+
+    def retry_after(self) -> float:
+        """Seconds until the circuit will let a probe through"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def release(self):
+        """Give back a permission without an outcome (e.g. the caller was cancelled)"""
+        if self.state == HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def record(self, duration: float, failed: bool):
+        """Record the outcome of a call that allow() let through"""
+        now = time.monotonic()
+        slow = duration >= self.slow_call_seconds
+
+        if self.state == HALF_OPEN:
+            self._set_state(OPEN if failed or slow else CLOSED, now)
+            return
+        if self.state == OPEN:
+            # A call that started before the circuit opened
+            return
+
+        self._calls.append((now, failed, slow))
+        self._failures += failed
+        self._slow += slow
+        self._prune(now)
+
+        total = len(self._calls)
+        if total < self.min_calls:
+            return
+        if self._failures / total >= self.error_rate_threshold or self._slow / total >= self.slow_call_rate_threshold:
+            self._set_state(OPEN, now)
+
+    def stats(self) -> dict:
+        self._prune(time.monotonic())
+        total = len(self._calls)
+        return {
+            "state": self.state,
+            "window_calls": total,
+            "error_rate": round(self._failures / total, 4) if total else 0.0,
+            "slow_call_rate": round(self._slow / total, 4) if total else 0.0,
+            "retry_after_seconds": round(self.retry_after(), 2),
+            "opened": self.opened,
+            "rejected": self.rejected
+        }
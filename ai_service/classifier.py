@@ -0,0 +1,293 @@
+"""
+Local moderation classifier: hashed word n-grams + multinomial logistic
+regression, in pure Python.
+
+It sits between the regex pre-filter and the LLM. Posts it scores as
+confidently clean or confidently violating are decided locally; anything
+in between escalates to moderate_with_ai.
+
+Artifacts are JSON files (optionally gzipped) holding the classes, the
+hashing configuration, the sparse weights and a version string. They are
+produced by scripts/train_classifier.py and loaded once at startup.
+"""
+import gzip
+import json
+import logging
+import math
+import random
+import re
+import zlib
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CLEAN_LABEL = "clean"
+ARTIFACT_FORMAT = "hashed-ngram-logreg/1"
+
+TOKEN_RE = re.compile(r"[a-z0-9@$%']+")
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class HashedNgramClassifier:
+    """Softmax regression over hashed word n-gram counts"""
+
+    def __init__(
+        self,
+        classes: List[str],
+        n_features: int = 2 ** 18,
+        ngram_max: int = 2,
+        weights: Optional[Dict[int, List[float]]] = None,
+        bias: Optional[List[float]] = None,
+        version: str = "dev",
+        metadata: Optional[dict] = None
+    ):
+        self.classes = list(classes)
+        self.n_features = n_features
+        self.ngram_max = ngram_max
+        self.weights: Dict[int, List[float]] = weights or {}
+        self.bias = bias or [0.0] * len(self.classes)
+        self.version = version
+        self.metadata = metadata or {}
+
+    def features(self, text: str) -> Dict[int, float]:
+        """Hashed n-gram counts, log-scaled and L2-normalized"""
+        tokens = TOKEN_RE.findall(text.lower())
+        counts: Dict[int, float] = {}
+        mask = self.n_features - 1
+        for n in range(1, self.ngram_max + 1):
+            for start in range(len(tokens) - n + 1):
+                gram = " ".join(tokens[start:start + n])
+                index = zlib.crc32(gram.encode("utf-8")) & mask
+                counts[index] = counts.get(index, 0.0) + 1.0
+
+        if not counts:
+            return counts
+        for index, count in counts.items():
+            counts[index] = 1.0 + math.log(count)
+        norm = math.sqrt(sum(value * value for value in counts.values()))
+        return {index: value / norm for index, value in counts.items()}
+
+    def _probabilities(self, features: Dict[int, float]) -> List[float]:
+        scores = list(self.bias)
+        for index, value in features.items():
+            row = self.weights.get(index)
+            if row is not None:
+                for k, weight in enumerate(row):
+                    scores[k] += weight * value
+        peak = max(scores)
+        exps = [math.exp(score - peak) for score in scores]
+        total = sum(exps)
+        return [value / total for value in exps]
+
+    def predict_proba(self, text: str) -> Dict[str, float]:
+        """Class probabilities for a post"""
+        return dict(zip(self.classes, self._probabilities(self.features(text))))
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """Most likely class and its probability"""
+        probabilities = self._probabilities(self.features(text))
+        best = max(range(len(probabilities)), key=probabilities.__getitem__)
+        return self.classes[best], probabilities[best]
+
+    @classmethod
+    def fit(
+        cls,
+        texts: List[str],
+        labels: List[str],
+        classes: Optional[List[str]] = None,
+        n_features: int = 2 ** 18,
+        ngram_max: int = 2,
+        epochs: int = 8,
+        learning_rate: float = 0.5,
+        l2: float = 1e-6,
+        seed: int = 13,
+        version: str = "dev"
+    ) -> "HashedNgramClassifier":
+        """Train with plain SGD on the softmax cross-entropy loss"""
+        classes = classes or sorted(set(labels))
+        model = cls(classes, n_features=n_features, ngram_max=ngram_max, version=version)
+        class_index = {label: k for k, label in enumerate(classes)}
+
+        examples = [(model.features(text), class_index[label]) for text, label in zip(texts, labels)]
+        order = list(range(len(examples)))
+        rng = random.Random(seed)
+
+        for epoch in range(epochs):
+            rng.shuffle(order)
+            rate = learning_rate / (1.0 + epoch)
+            for i in order:
+                features, target = examples[i]
+                probabilities = model._probabilities(features)
+                gradient = [p - (1.0 if k == target else 0.0) for k, p in enumerate(probabilities)]
+
+                for k, g in enumerate(gradient):
+                    model.bias[k] -= rate * g
+                for index, value in features.items():
+                    row = model.weights.get(index)
+                    if row is None:
+                        row = model.weights[index] = [0.0] * len(classes)
+                    for k, g in enumerate(gradient):
+                        row[k] -= rate * (g * value + l2 * row[k])
+
+        return model
+
+    def save(self, path: str):
+        """Write the model artifact"""
+        artifact = {
+            "format": ARTIFACT_FORMAT,
+            "version": self.version,
+            "created_at": datetime.utcnow().isoformat(),
+            "classes": self.classes,
+            "n_features": self.n_features,
+            "ngram_max": self.ngram_max,
+            "bias": [round(value, 6) for value in self.bias],
+            "weights": {
+                str(index): [round(value, 6) for value in row]
+                for index, row in self.weights.items()
+                if any(abs(value) > 1e-6 for value in row)
+            },
+            "metadata": self.metadata
+        }
+        with _open(path, "w") as f:
+            json.dump(artifact, f, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str) -> "HashedNgramClassifier":
+        """Read a model artifact written by save()"""
+        with _open(path, "r") as f:
+            artifact = json.load(f)
+        if artifact.get("format") != ARTIFACT_FORMAT:
+            raise ValueError(f"Unsupported classifier artifact format: {artifact.get('format')}")
+
+        return cls(
+            classes=artifact["classes"],
+            n_features=artifact["n_features"],
+            ngram_max=artifact["ngram_max"],
+            weights={int(index): row for index, row in artifact["weights"].items()},
+            bias=artifact["bias"],
+            version=artifact["version"],
+            metadata=artifact.get("metadata", {})
+        )
+
+
+def load_classifier(path: Optional[str]) -> Optional[HashedNgramClassifier]:
+    """Load the artifact at path, or return None (tier disabled) if it is missing or invalid"""
+    if not path:
+        return None
+    try:
+        model = HashedNgramClassifier.load(path)
+        logger.info(f"Loaded moderation classifier {model.version} from {path} ({len(model.weights)} features)")
+        return model
+    except FileNotFoundError:
+        logger.info(f"No moderation classifier at {path}, local tier disabled")
+    except Exception as e:
+        logger.error(f"Failed to load moderation classifier from {path}: {str(e)}")
+    return None
+
+
+def label_from_record(record: dict) -> Optional[str]:
+    """
+    Training label for an exported post/flag record.
+
+    Records carry either an explicit "label", or the flag's "violation_type"
+    and review "status": approved/resolved flags are violations, rejected
+    flags and unflagged posts are clean, pending flags are skipped.
+    """
+    if record.get("label"):
+        return record["label"]
+    violation_type = record.get("violation_type")
+    status = record.get("status")
+    if not violation_type or status == "rejected":
+        return CLEAN_LABEL
+    if status in ("approved", "resolved"):
+        return violation_type
+    return None
+
+
+def iter_records(path: str) -> Iterable[dict]:
+    """Read exported records from JSONL or CSV (content, label | violation_type + status)"""
+    if path.endswith(".csv"):
+        import csv
+
+        with open(path, newline="", encoding="utf-8") as f:
+            yield from csv.DictReader(f)
+        return
+
+    with _open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def load_dataset(path: str) -> Tuple[List[str], List[str]]:
+    """Texts and labels from an export file, skipping unlabelled records"""
+    texts, labels = [], []
+    for record in iter_records(path):
+        label = label_from_record(record)
+        content = record.get("content") or record.get("raw")
+        if label is None or not content:
+            continue
+        texts.append(content)
+        labels.append(label)
+    return texts, labels
+
+
+def is_confident(label: str, probability: float, clean_threshold: float, violation_threshold: float) -> bool:
+    """Whether a prediction is confident enough to skip the LLM"""
+    if label == CLEAN_LABEL:
+        return probability >= clean_threshold
+    return probability >= violation_threshold
+
+
+def evaluate(
+    model: HashedNgramClassifier,
+    texts: List[str],
+    labels: List[str],
+    clean_threshold: float,
+    violation_threshold: float
+) -> dict:
+    """Accuracy, per-class precision/recall and tier routing stats on labelled data"""
+    confusion: Dict[Tuple[str, str], int] = {}
+    local_total = local_correct = missed_violations = 0
+
+    for text, actual in zip(texts, labels):
+        predicted, probability = model.predict(text)
+        confusion[(actual, predicted)] = confusion.get((actual, predicted), 0) + 1
+        if is_confident(predicted, probability, clean_threshold, violation_threshold):
+            local_total += 1
+            local_correct += predicted == actual
+            # Violations cleared locally never reach the LLM; the costliest error
+            missed_violations += predicted == CLEAN_LABEL and actual != CLEAN_LABEL
+
+    total = len(labels)
+    per_class = {}
+    for label in sorted(set(labels) | set(model.classes)):
+        true_positive = confusion.get((label, label), 0)
+        predicted_count = sum(count for (_, p), count in confusion.items() if p == label)
+        support = sum(count for (a, _), count in confusion.items() if a == label)
+        per_class[label] = {
+            "precision": round(true_positive / predicted_count, 4) if predicted_count else 0.0,
+            "recall": round(true_positive / support, 4) if support else 0.0,
+            "support": support
+        }
+
+    return {
+        "examples": total,
+        "accuracy": round(sum(count for (a, p), count in confusion.items() if a == p) / total, 4) if total else 0.0,
+        "per_class": per_class,
+        "tier": {
+            "clean_threshold": clean_threshold,
+            "violation_threshold": violation_threshold,
+            "decided_locally": round(local_total / total, 4) if total else 0.0,
+            "escalated_to_llm": round(1 - local_total / total, 4) if total else 0.0,
+            "local_accuracy": round(local_correct / local_total, 4) if local_total else 0.0,
+            "violations_cleared_locally": missed_violations
+        }
+    }
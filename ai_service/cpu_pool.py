@@ -0,0 +1,122 @@
+"""
+Process pool for CPU-bound moderation stages on very large posts.
+
+The regex rule scan and the local classifier hold the GIL, so a multi-
+megabyte post blocks the event loop (and every other request in the
+worker) for as long as they run. Posts of at least min_chars are sent to a
+small pool of processes instead; shorter posts stay inline, where the
+round trip to another process would cost more than the scan.
+
+Pool processes are spawned (not forked, so they inherit no event loop,
+sockets or threads from the uvicorn worker) and load the rule engine and
+the classifier once, in init_process. If the pool breaks, the stage runs
+inline and the pool is recreated.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, Tuple
+
+from metrics import CPU_POOL_TASKS
+
+logger = logging.getLogger(__name__)
+
+# Set in each pool process by init_process
+_classifier = None
+
+
+def init_process(classifier_path: Optional[str]):
+    """Pool process startup: build the rule engine and load the classifier once"""
+    global _classifier
+    import rules  # noqa: F401  (compiles the rule set at import)
+    from classifier import load_classifier
+
+    _classifier = load_classifier(classifier_path)
+
+
+def ready() -> int:
+    return os.getpid()
+
+
+def check_rules(content: str) -> Optional[dict]:
+    from rules import rule_engine
+
+    return rule_engine.check(content)
+
+
+def classify(content: str) -> Optional[Tuple[str, float]]:
+    if _classifier is None:
+        return None
+    return _classifier.predict(content)
+
+
+class CPUPool:
+    """Runs CPU-bound stages for large posts in worker processes"""
+
+    def __init__(self, workers: int = 1, min_chars: int = 20000, classifier_path: Optional[str] = None):
+        self.workers = workers
+        self.min_chars = min_chars
+        self.classifier_path = classifier_path
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._restart: Optional[asyncio.Task] = None
+        self.offloaded = 0
+        self.fallbacks = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._executor is not None
+
+    async def start(self):
+        """Spawn the pool processes and wait until each has loaded the rules and model"""
+        if self.workers <= 0 or self._executor is not None:
+            return
+        started = time.perf_counter()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_process,
+            initargs=(self.classifier_path,)
+        )
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, ready) for _ in range(self.workers)))
+        logger.info(
+            f"CPU pool started: {self.workers} processes for posts of {self.min_chars}+ characters "
+            f"({time.perf_counter() - started:.2f}s)"
+        )
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    def offloads(self, content: str) -> bool:
+        """Whether a stage on this content should run in the pool"""
+        return self._executor is not None and len(content) >= self.min_chars
+
+    async def run(self, stage: str, func: Callable, content: str, inline: Callable):
+        """Run func(content) in the pool, or inline(content) if the pool broke"""
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._executor, func, content)
+        except BrokenProcessPool as e:
+            self.fallbacks += 1
+            CPU_POOL_TASKS.labels(stage, "fallback").inc()
+            logger.error(f"CPU pool broken, running {stage} inline and restarting the pool: {str(e)}")
+            self.close()
+            self._restart = asyncio.create_task(self.start())
+            return inline(content)
+        self.offloaded += 1
+        CPU_POOL_TASKS.labels(stage, "offloaded").inc()
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "workers": self.workers,
+            "min_chars": self.min_chars,
+            "offloaded": self.offloaded,
+            "fallbacks": self.fallbacks
+        }
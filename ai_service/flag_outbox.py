@@ -0,0 +1,418 @@
+"""
+Outbound delivery of AI flags to Discourse.
+
+Flagged posts are not sent one request at a time as they are moderated.
+enqueue() adds the flag to an outbox that is flushed every window_ms (or
+as soon as max_batch_size flags are waiting); flags for the same post in
+one window are coalesced into the most severe one. Discourse has no bulk
+flag endpoint, so a flushed batch is delivered as concurrent
+POST /post_actions.json calls over one long-lived httpx.AsyncClient,
+which keeps its connections alive between batches.
+
+- Every flag has an idempotency key (post id and flag type). It is sent as
+  the Idempotency-Key header, and with REDIS_URL it is claimed in Redis
+  before sending, so a flag already delivered (or being delivered) by any
+  process is skipped. Discourse answering that the action was already
+  taken also counts as delivered.
+- Connection errors, timeouts, 429 and 5xx responses are retried with
+  exponential backoff and full jitter (429 honours Retry-After); a retried
+  flag rejoins the outbox and goes out with the next batch.
+- Other 4xx responses, and flags still failing after max_attempts, go to
+  the dead-letter store: a Redis list, or a JSONL file when Redis is not
+  configured. Dead letters can be listed and re-queued.
+- close() flushes the outbox and waits for deliveries; retries still
+  pending at shutdown are dead-lettered rather than lost.
+
+The outbox is one of two ways a flag reaches Discourse. The other is the
+ai-moderation plugin job, which flags from the verdict of its own
+/moderate call. Only one of them may own flagging (FLAG_OUTBOX_ENABLED in
+main), otherwise a post moderated through both is flagged twice.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import socket
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+import httpx
+
+from metrics import FLAG_BATCH_SIZE, FLAG_DELIVERIES
+
+logger = logging.getLogger(__name__)
+
+# Discourse core post action types
+OFF_TOPIC = 3
+INAPPROPRIATE = 4
+NOTIFY_MODERATORS = 7
+SPAM = 8
+
+FLAG_TYPES = {
+    "spam": SPAM,
+    "solicitation": SPAM,
+    "off_topic": OFF_TOPIC,
+    "harassment": INAPPROPRIATE,
+    "inappropriate": INAPPROPRIATE
+}
+
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class PermanentDeliveryError(Exception):
+    """Discourse rejected the flag in a way a retry will not fix"""
+
+
+def flag_type(violation_type: Optional[str]) -> int:
+    """Discourse post action type for a violation (others notify moderators with the reason)"""
+    return FLAG_TYPES.get(violation_type or "", NOTIFY_MODERATORS)
+
+
+def idempotency_key(post_id: int, action_type: int) -> str:
+    """Discourse allows one flag of each type per post and user, so that is the identity"""
+    return hashlib.sha256(f"ai-flag:{post_id}:{action_type}".encode("utf-8")).hexdigest()[:32]
+
+
+class FlagOutbox:
+    """Coalesces AI flags per window and delivers them to Discourse with retries"""
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: Optional[str],
+        api_username: str = "system",
+        window_ms: float = 250,
+        max_batch_size: int = 50,
+        concurrency: int = 8,
+        max_attempts: int = 5,
+        retry_backoff_seconds: float = 1.0,
+        retry_backoff_max_seconds: float = 60.0,
+        max_connections: int = 20,
+        timeout: float = 10.0,
+        redis_url: Optional[str] = None,
+        delivered_ttl_seconds: float = 604800,
+        dead_letter_path: Optional[str] = None
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.api_username = api_username
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.retry_backoff_max_seconds = retry_backoff_max_seconds
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.redis_url = redis_url
+        self.delivered_ttl_seconds = delivered_ttl_seconds
+        self.dead_letter_path = dead_letter_path
+
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._dead_key = "cop:flags:dead"
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._redis = None
+        self._pending: Dict[int, dict] = {}
+        self._timer = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._batches = set()
+        self._retries: Dict[asyncio.Task, dict] = {}
+        # Keys delivered by this process, for when Redis is not configured
+        self._delivered = deque(maxlen=10000)
+        self._delivered_keys = set()
+
+        self.enqueued = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.delivered = 0
+        self.duplicates = 0
+        self.retried = 0
+        self.dead_lettered = 0
+
+    @property
+    def started(self) -> bool:
+        return self._client is not None
+
+    async def start(self):
+        """Create the pooled HTTP client and connect Redis, if configured"""
+        if self.started:
+            return
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"Api-Key": self.api_key or "", "Api-Username": self.api_username},
+            limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 5.0))
+        )
+        if self.redis_url:
+            try:
+                import redis.asyncio as redis
+
+                self._redis = redis.from_url(self.redis_url)
+                await self._redis.ping()
+            except Exception as e:
+                logger.warning(f"Flag outbox: Redis unavailable, deduplicating within this process only: {str(e)}")
+                self._redis = None
+        logger.info(
+            f"Flag outbox started ({self.base_url}, window {self.window * 1000:.0f}ms, "
+            f"max_batch_size={self.max_batch_size}, concurrency={self.concurrency})"
+        )
+
+    async def warm(self) -> bool:
+        """Open a pooled connection to Discourse before the first flag needs it"""
+        if not self.started:
+            return False
+        try:
+            await self._client.get("/srv/status")
+            return True
+        except Exception as e:
+            logger.warning(f"Discourse connection warm-up failed: {type(e).__name__}: {str(e)}")
+            return False
+
+    async def close(self, timeout: float = 10.0):
+        """Deliver what is waiting (including retries due within the timeout), then release the client"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self._flush()
+            waiting = self._batches | set(self._retries)
+            if not waiting:
+                break
+            await asyncio.wait(waiting, timeout=max(deadline - time.monotonic(), 0), return_when=asyncio.FIRST_COMPLETED)
+
+        undelivered = list(self._retries.items())
+        self._retries.clear()
+        for task, flag in undelivered:
+            task.cancel()
+            await self._dead_letter(flag, "undelivered at shutdown")
+        for flag in self._pending.values():
+            await self._dead_letter(flag, "undelivered at shutdown")
+        self._pending = {}
+
+        if self._client is not None:
+            await self._client.aclose()
+        self._client = None
+        if self._redis is not None:
+            await self._redis.close()
+        self._redis = None
+
+    def enqueue(self, post_id: int, violation_type: Optional[str], severity: Optional[int], reason: Optional[str]):
+        """Add a flag to the outbox; it is sent with the next batch"""
+        action_type = flag_type(violation_type)
+        flag = {
+            "post_id": post_id,
+            "post_action_type_id": action_type,
+            "violation_type": violation_type,
+            "severity": severity or 0,
+            "reason": reason,
+            "key": idempotency_key(post_id, action_type),
+            "attempts": 0
+        }
+        self.enqueued += 1
+        self._add(flag)
+
+    def _add(self, flag: dict):
+        current = self._pending.get(flag["post_id"])
+        if current is not None:
+            self.coalesced += 1
+            if current["severity"] >= flag["severity"]:
+                return
+        self._pending[flag["post_id"]] = flag
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch, self._pending = list(self._pending.values()), {}
+        self.batches += 1
+        FLAG_BATCH_SIZE.observe(len(batch))
+        task = asyncio.create_task(self._deliver_batch(batch))
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _deliver_batch(self, batch: List[dict]):
+        await asyncio.gather(*(self._deliver(flag) for flag in batch))
+
+    async def _deliver(self, flag: dict):
+        if not await self._claim(flag):
+            self.duplicates += 1
+            FLAG_DELIVERIES.labels("duplicate").inc()
+            return
+
+        flag["attempts"] += 1
+        try:
+            async with self._semaphore:
+                await self._post(flag)
+        except PermanentDeliveryError as e:
+            await self._fail(flag, str(e))
+            return
+        except Exception as e:
+            if flag["attempts"] >= self.max_attempts:
+                await self._fail(flag, f"{type(e).__name__}: {str(e)}")
+                return
+            self._retry(flag, e)
+            return
+
+        await self._mark_delivered(flag)
+        self.delivered += 1
+        FLAG_DELIVERIES.labels("delivered").inc()
+
+    async def _post(self, flag: dict):
+        """Create the flag; returns normally if it exists now, raises otherwise"""
+        body = {"id": flag["post_id"], "post_action_type_id": flag["post_action_type_id"], "flag_topic": False}
+        if flag["post_action_type_id"] == NOTIFY_MODERATORS:
+            body["message"] = f"AI moderation ({flag['violation_type']}): {flag['reason'] or 'no reason given'}"
+
+        response = await self._client.post(
+            "/post_actions.json",
+            json=body,
+            headers={"Idempotency-Key": flag["key"]}
+        )
+        if response.status_code < 300:
+            return
+        if response.status_code in (403, 409, 422) and "already" in response.text.lower():
+            # Someone (possibly an earlier attempt of ours) already flagged it
+            return
+        if response.status_code in RETRYABLE_STATUS:
+            raise httpx.HTTPStatusError(
+                f"Discourse returned {response.status_code}", request=response.request, response=response
+            )
+        raise PermanentDeliveryError(f"Discourse returned {response.status_code}: {response.text[:200]}")
+
+    def _retry(self, flag: dict, error: Exception):
+        delay = random.uniform(0, min(
+            self.retry_backoff_seconds * 2 ** (flag["attempts"] - 1),
+            self.retry_backoff_max_seconds
+        ))
+        if isinstance(error, httpx.HTTPStatusError):
+            retry_after = error.response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+        self.retried += 1
+        FLAG_DELIVERIES.labels("retried").inc()
+        logger.warning(
+            f"Flag for post {flag['post_id']} attempt {flag['attempts']} failed, retrying in {delay:.1f}s: "
+            f"{type(error).__name__}: {str(error)}"
+        )
+        task = asyncio.create_task(self._retry_later(flag, delay))
+        self._retries[task] = flag
+        task.add_done_callback(lambda done: self._retries.pop(done, None))
+
+    async def _retry_later(self, flag: dict, delay: float):
+        await asyncio.sleep(delay)
+        await self._release(flag)
+        self._add(flag)
+
+    async def _fail(self, flag: dict, error: str):
+        logger.error(f"Flag for post {flag['post_id']} failed after {flag['attempts']} attempts: {error}")
+        await self._release(flag)
+        await self._dead_letter(flag, error)
+
+    async def _claim(self, flag: dict) -> bool:
+        """Whether this process should send the flag (nobody has, or is doing so)"""
+        if flag["key"] in self._delivered_keys:
+            return False
+        if self._redis is None:
+            return True
+        try:
+            # Short lease while sending; extended to delivered_ttl_seconds on success
+            lease = int((self.timeout + 5) * 1000)
+            return bool(await self._redis.set(f"cop:flags:sent:{flag['key']}", self.instance_id, nx=True, px=lease))
+        except Exception as e:
+            logger.warning(f"Flag outbox: Redis claim failed, sending anyway: {str(e)}")
+            return True
+
+    async def _release(self, flag: dict):
+        if self._redis is None:
+            return
+        try:
+            await self._redis.delete(f"cop:flags:sent:{flag['key']}")
+        except Exception as e:
+            logger.warning(f"Flag outbox: Redis release failed (the claim expires on its own): {str(e)}")
+
+    async def _mark_delivered(self, flag: dict):
+        if len(self._delivered) == self._delivered.maxlen:
+            self._delivered_keys.discard(self._delivered[0])
+        self._delivered.append(flag["key"])
+        self._delivered_keys.add(flag["key"])
+        if self._redis is None:
+            return
+        try:
+            await self._redis.set(f"cop:flags:sent:{flag['key']}", "delivered", ex=int(self.delivered_ttl_seconds))
+        except Exception as e:
+            logger.warning(f"Flag outbox: Redis delivered marker failed: {str(e)}")
+
+    async def _dead_letter(self, flag: dict, error: str):
+        self.dead_lettered += 1
+        FLAG_DELIVERIES.labels("dead_letter").inc()
+        entry = json.dumps({**flag, "error": error, "failed_at": time.time()})
+        try:
+            if self._redis is not None:
+                await self._redis.lpush(self._dead_key, entry)
+            elif self.dead_letter_path:
+                await asyncio.to_thread(self._append_dead_letter, entry)
+            else:
+                logger.error(f"Flag dead letter (no store configured): {entry}")
+        except Exception as e:
+            logger.error(f"Flag outbox dead-letter error: {str(e)} ({entry})")
+
+    def _append_dead_letter(self, entry: str):
+        with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+            f.write(entry + "\n")
+
+    async def dead_letters(self, limit: int = 100) -> List[dict]:
+        """Most recent dead-lettered flags first"""
+        if self._redis is not None:
+            return [json.loads(entry) for entry in await self._redis.lrange(self._dead_key, 0, limit - 1)]
+        if self.dead_letter_path and os.path.exists(self.dead_letter_path):
+            with open(self.dead_letter_path, encoding="utf-8") as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+            return entries[::-1][:limit]
+        return []
+
+    async def retry_dead_letters(self) -> int:
+        """Move every dead-lettered flag back into the outbox"""
+        entries = []
+        if self._redis is not None:
+            while True:
+                entry = await self._redis.rpop(self._dead_key)
+                if entry is None:
+                    break
+                entries.append(json.loads(entry))
+        elif self.dead_letter_path and os.path.exists(self.dead_letter_path):
+            with open(self.dead_letter_path, encoding="utf-8") as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+            os.remove(self.dead_letter_path)
+
+        for entry in entries:
+            entry.pop("error", None)
+            entry.pop("failed_at", None)
+            entry["attempts"] = 0
+            self._add(entry)
+        return len(entries)
+
+    def stats(self) -> dict:
+        return {
+            "started": self.started,
+            "pending": len(self._pending),
+            "batches_in_flight": len(self._batches),
+            "pending_retries": len(self._retries),
+            "enqueued": self.enqueued,
+            "coalesced": self.coalesced,
+            "batches": self.batches,
+            "delivered": self.delivered,
+            "duplicates": self.duplicates,
+            "retried": self.retried,
+            "dead_lettered": self.dead_lettered,
+            "redis_enabled": self._redis is not None
+        }
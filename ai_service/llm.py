@@ -0,0 +1,304 @@
+"""
+Shared OpenAI client for the AI service.
+
+A single AsyncOpenAI client is created at app startup and reused by every
+request. It runs on one pooled httpx.AsyncClient, and every completion
+takes a slot from the UpstreamScheduler first, which caps calls in flight
+and tokens per minute per model and lets interactive calls go before
+background work.
+
+Each model has its own circuit breaker. While a model's circuit is open,
+chat() raises CircuitOpenError without touching the network, and every
+call is bounded by a deadline that covers queueing and client retries.
+
+When the request is traced, the upstream call is recorded as an "openai"
+span, with "openai_connect" (TCP/TLS setup on a new connection) and
+"openai_ttfb" (request sent to response headers) taken from httpcore's
+trace events.
+"""
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+import openai
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from metrics import OPENAI_ERRORS, OPENAI_FIRST_TOKEN_LATENCY, OPENAI_LATENCY, record_openai_usage
+from scheduler import UpstreamScheduler
+from tracing import current_trace, span
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+DEFAULT_MAX_TOKENS = 256
+
+
+class LLMClient:
+    """Long-lived async OpenAI client with pooling, timeouts and scheduled upstream slots"""
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        max_concurrency: int = 64,
+        timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        base_url: Optional[str] = None,
+        breaker_settings: Optional[dict] = None,
+        scheduler: Optional[UpstreamScheduler] = None
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._client: Optional[openai.AsyncOpenAI] = None
+        # max_concurrency is the per-model limit for models without their own limits
+        self.scheduler = scheduler or UpstreamScheduler(default_concurrency=max_concurrency)
+
+        self.breaker_settings = breaker_settings or {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    @property
+    def started(self) -> bool:
+        return self._client is not None
+
+    async def start(self):
+        """Create the pooled HTTP client and the OpenAI client"""
+        if self.started:
+            return
+
+        self._http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections
+            ),
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+            event_hooks={"request": [attach_trace]}
+        )
+        self._client = openai.AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            http_client=self._http_client,
+            timeout=self.timeout
+        )
+        logger.info(
+            f"OpenAI client started (max_connections={self.max_connections}, "
+            f"max_concurrency={self.max_concurrency}, timeout={self.timeout}s)"
+        )
+
+    async def close(self):
+        """Close the pooled HTTP client"""
+        if self._http_client is not None:
+            await self._http_client.aclose()
+        self._http_client = None
+        self._client = None
+
+    async def warm(self, connections: int = 2) -> int:
+        """
+        Open keep-alive connections to the API before the first request needs them.
+
+        Sends concurrent GET /models requests (no tokens used), so DNS, TCP and
+        TLS are done at startup; any HTTP response leaves a pooled connection.
+        Returns the number of connections opened.
+        """
+        if not self.started or connections <= 0:
+            return 0
+        url = f"{str(self._client.base_url).rstrip('/')}/models"
+
+        async def probe() -> bool:
+            try:
+                await self._http_client.get(
+                    url,
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    timeout=httpx.Timeout(self.connect_timeout * 2, connect=self.connect_timeout)
+                )
+                return True
+            except Exception as e:
+                logger.warning(f"OpenAI connection warm-up failed: {type(e).__name__}: {str(e)}")
+                return False
+
+        return sum(await asyncio.gather(*(probe() for _ in range(connections))))
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        """The circuit breaker for a model, created on first use"""
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(model, **self.breaker_settings)
+        return breaker
+
+    def breaker_stats(self) -> dict:
+        return {model: breaker.stats() for model, breaker in self._breakers.items()}
+
+    async def chat(self, model: str, messages: list, timeout: Optional[float] = None, **kwargs):
+        """
+        Run a chat completion, waiting for a scheduler slot first.
+
+        Raises CircuitOpenError at once if the model's circuit is open, and
+        asyncio.TimeoutError if the whole call (queueing, request and client
+        retries) takes longer than the timeout.
+        """
+        breaker = self.breaker(model)
+        if not breaker.allow():
+            raise CircuitOpenError(model, breaker.retry_after())
+
+        if not self.started:
+            await self.start()
+
+        deadline = timeout or self.timeout
+        upstream_start = None
+
+        async def complete():
+            nonlocal upstream_start
+            with span("queue_wait"):
+                grant = await self.scheduler.acquire(model, estimate_tokens(messages, kwargs))
+            used_tokens = None
+            try:
+                upstream_start = time.perf_counter()
+                try:
+                    with span("openai"):
+                        response = await self._client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            timeout=deadline,
+                            **kwargs
+                        )
+                finally:
+                    OPENAI_LATENCY.labels(model).observe(time.perf_counter() - upstream_start)
+                if response.usage is not None:
+                    used_tokens = response.usage.total_tokens
+                return response
+            finally:
+                grant.release(used_tokens)
+
+        try:
+            response = await asyncio.wait_for(complete(), deadline)
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as e:
+            OPENAI_ERRORS.labels(model, type(e).__name__).inc()
+            if upstream_start is None:
+                # The deadline ran out while queued for a slot; not the upstream's fault
+                breaker.release()
+            else:
+                breaker.record(time.perf_counter() - upstream_start, failed=is_upstream_failure(e))
+            raise
+
+        breaker.record(time.perf_counter() - upstream_start, failed=False)
+        record_openai_usage(model, response.usage)
+        return response
+
+    async def chat_stream(
+        self, model: str, messages: list, timeout: Optional[float] = None, **kwargs
+    ) -> AsyncIterator[str]:
+        """
+        Stream a chat completion as text deltas.
+
+        The scheduler slot is held until the stream ends. If the consumer
+        stops iterating (for example because the client disconnected), the
+        upstream response is closed so no further tokens are generated.
+        """
+        breaker = self.breaker(model)
+        if not breaker.allow():
+            raise CircuitOpenError(model, breaker.retry_after())
+
+        if not self.started:
+            await self.start()
+
+        estimate = estimate_tokens(messages, kwargs)
+        with span("queue_wait"):
+            try:
+                grant = await self.scheduler.acquire(model, estimate)
+            except BaseException:
+                breaker.release()
+                raise
+
+        start = time.perf_counter()
+        stream = None
+        outcome = None
+        generated = 0
+        try:
+            stream = await self._client.chat.completions.create(
+                model=model,
+                messages=messages,
+                timeout=timeout or self.timeout,
+                stream=True,
+                **kwargs
+            )
+            first_token = True
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    generated += len(delta)
+                    if first_token:
+                        OPENAI_FIRST_TOKEN_LATENCY.labels(model).observe(time.perf_counter() - start)
+                        first_token = False
+                    yield delta
+            outcome = False
+        except (asyncio.CancelledError, GeneratorExit):
+            raise
+        except Exception as e:
+            OPENAI_ERRORS.labels(model, type(e).__name__).inc()
+            outcome = is_upstream_failure(e)
+            raise
+        finally:
+            if stream is not None:
+                await stream.response.aclose()
+            OPENAI_LATENCY.labels(model).observe(time.perf_counter() - start)
+            # Streams report no usage; charge the prompt and the text actually generated
+            grant.release(estimate - kwargs.get("max_tokens", DEFAULT_MAX_TOKENS) + generated // CHARS_PER_TOKEN)
+            if outcome is None:
+                breaker.release()
+            else:
+                # Streams run long by design, so only the outcome counts
+                breaker.record(0.0, failed=outcome)
+
+
+async def attach_trace(request: httpx.Request):
+    """httpx request hook: record connection setup and time to first byte on the current trace"""
+    trace = current_trace()
+    if trace is None:
+        return
+    started = {}
+
+    async def on_event(event: str, info: dict):
+        # e.g. "connection.connect_tcp.started", "http11.receive_response_headers.complete"
+        step, _, phase = event.rpartition(".")
+        now = time.perf_counter()
+        if phase == "started":
+            started[step] = now
+            return
+        if phase != "complete":
+            return
+        if step in ("connection.connect_tcp", "connection.start_tls"):
+            trace.add("openai_connect", started.get(step, now), now - started.get(step, now))
+        elif step.endswith("receive_response_headers"):
+            sent = started.get(step.replace("receive_response_headers", "send_request_headers"), now)
+            trace.add("openai_ttfb", sent, now - sent)
+
+    request.extensions["trace"] = on_event
+
+
+def estimate_tokens(messages: list, kwargs: dict) -> int:
+    """Rough tokens for a call (prompt plus the completion limit), for the per-minute budget"""
+    prompt = sum(len(message.get("content") or "") for message in messages)
+    return prompt // CHARS_PER_TOKEN + kwargs.get("max_tokens", DEFAULT_MAX_TOKENS)
+
+
+def is_upstream_failure(error: Exception) -> bool:
+    """Whether an error says the upstream is unhealthy (as opposed to a bad request)"""
+    if isinstance(error, (asyncio.TimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code == 429
+    return False
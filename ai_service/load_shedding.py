@@ -0,0 +1,194 @@
+"""
+Overload detection for adaptive load shedding.
+
+The detector watches three signals of a worker running past its capacity:
+
+- event loop lag: how late a sleeping task is woken (sampled in a loop
+  and smoothed with an EWMA), i.e. how long callbacks wait for the loop
+- in flight: interactive moderation requests being handled right now
+- queue wait: how long the oldest interactive upstream call has been
+  waiting for a scheduler slot
+
+When any signal crosses its limit the worker is overloaded and
+/moderate answers in degraded mode (regex pre-filter, near-duplicate
+index, cache and local classifier; no LLM call). It returns to normal
+only once every signal has stayed below recover_ratio of its limit for
+recover_seconds, so it does not flap around a limit. A limit of 0
+disables that signal.
+
+Degraded verdicts are re-checked by the LLM later; wait_until_normal()
+lets those re-checks hold off until the load has dropped.
+"""
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from metrics import OVERLOAD_DEGRADED, OVERLOAD_EPISODES
+
+logger = logging.getLogger(__name__)
+
+LAG_SMOOTHING = 0.3  # EWMA weight of the newest lag sample
+
+
+class OverloadDetector:
+    """Tracks load signals and switches degraded mode on and off with hysteresis"""
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        max_event_loop_lag: float = 0.2,
+        max_in_flight: int = 200,
+        max_queue_wait: float = 2.0,
+        recover_ratio: float = 0.5,
+        recover_seconds: float = 10.0,
+        sample_interval: float = 0.1,
+        queue_wait: Optional[Callable[[], float]] = None
+    ):
+        self.enabled = enabled
+        self.max_event_loop_lag = max_event_loop_lag
+        self.max_in_flight = max_in_flight
+        self.max_queue_wait = max_queue_wait
+        self.recover_ratio = recover_ratio
+        self.recover_seconds = recover_seconds
+        self.sample_interval = sample_interval
+        self.queue_wait = queue_wait or (lambda: 0.0)
+
+        self.event_loop_lag = 0.0
+        self.in_flight = 0
+        self.degraded = False
+        self.degraded_since: Optional[float] = None
+        self.episodes = 0
+        self.trigger: Optional[str] = None
+
+        self._calm_since: Optional[float] = None
+        self._normal: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start sampling event loop lag (call from the running loop)"""
+        self._normal = asyncio.Event()
+        self._normal.set()
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._sample_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # Nothing should stay parked on a worker that is shutting down
+        if self._normal is not None:
+            self._normal.set()
+
+    @contextmanager
+    def track(self):
+        """Count a request as in flight while the block runs"""
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    @property
+    def overloaded(self) -> bool:
+        """Whether new work should be answered in degraded mode"""
+        if not self.enabled:
+            return False
+        self._evaluate()
+        return self.degraded
+
+    async def wait_until_normal(self):
+        """Return once the worker is out of degraded mode"""
+        if self._normal is not None:
+            await self._normal.wait()
+
+    def signals(self) -> dict:
+        return {
+            "event_loop_lag": self.event_loop_lag,
+            "in_flight": self.in_flight,
+            "queue_wait": self.queue_wait()
+        }
+
+    def _ratios(self) -> dict:
+        """Each enabled signal as a fraction of its limit"""
+        limits = {
+            "event_loop_lag": self.max_event_loop_lag,
+            "in_flight": self.max_in_flight,
+            "queue_wait": self.max_queue_wait
+        }
+        return {name: value / limits[name] for name, value in self.signals().items() if limits[name] > 0}
+
+    def _evaluate(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        ratios = self._ratios()
+        if not self.degraded:
+            over = [name for name, ratio in ratios.items() if ratio > 1]
+            if over:
+                self._enter(max(over, key=ratios.get), now)
+            return
+
+        if any(ratio > self.recover_ratio for ratio in ratios.values()):
+            self._calm_since = None
+        elif self._calm_since is None:
+            self._calm_since = now
+        elif now - self._calm_since >= self.recover_seconds:
+            self._exit(now)
+
+    def _enter(self, signal: str, now: float):
+        self.degraded = True
+        self.degraded_since = now
+        self.trigger = signal
+        self.episodes += 1
+        self._calm_since = None
+        if self._normal is not None:
+            self._normal.clear()
+        OVERLOAD_DEGRADED.set(1)
+        OVERLOAD_EPISODES.labels(signal).inc()
+        logger.warning(f"Overloaded ({signal}), switching to degraded moderation: {self._describe()}")
+
+    def _exit(self, now: float):
+        logger.info(f"Load back to normal after {now - self.degraded_since:.1f}s in degraded mode")
+        self.degraded = False
+        self.degraded_since = None
+        self.trigger = None
+        self._calm_since = None
+        if self._normal is not None:
+            self._normal.set()
+        OVERLOAD_DEGRADED.set(0)
+
+    def _describe(self) -> str:
+        signals = self.signals()
+        return (
+            f"event loop lag {signals['event_loop_lag'] * 1000:.0f}ms, "
+            f"{signals['in_flight']} in flight, queue wait {signals['queue_wait']:.2f}s"
+        )
+
+    async def _sample_loop(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.sample_interval)
+            lag = max(0.0, time.perf_counter() - start - self.sample_interval)
+            self.event_loop_lag += LAG_SMOOTHING * (lag - self.event_loop_lag)
+            self._evaluate()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        signals = self.signals()
+        return {
+            "enabled": self.enabled,
+            "degraded": self.degraded,
+            "degraded_seconds": round(now - self.degraded_since, 3) if self.degraded_since is not None else None,
+            "trigger": self.trigger,
+            "episodes": self.episodes,
+            "event_loop_lag_ms": round(signals["event_loop_lag"] * 1000, 2),
+            "in_flight": signals["in_flight"],
+            "queue_wait_seconds": round(signals["queue_wait"], 3),
+            "limits": {
+                "event_loop_lag_ms": self.max_event_loop_lag * 1000,
+                "in_flight": self.max_in_flight,
+                "queue_wait_seconds": self.max_queue_wait
+            },
+            "recover_ratio": self.recover_ratio,
+            "recover_seconds": self.recover_seconds
+        }
@@ -1,22 +1,67 @@
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Tuple
+from contextlib import asynccontextmanager
 import httpx
 import os
 import logging
 from datetime import datetime
 import json
 import asyncio
+import re
+import time
+import uuid
+
+from cache import ResultCache, normalize_content
+from classifier import CLEAN_LABEL, is_confident, load_classifier
+from cpu_pool import CPUPool, check_rules, classify
+from flag_outbox import FlagOutbox
+from llm import LLMClient
+from load_shedding import OverloadDetector
+from microbatch import MicroBatcher
+from near_duplicate import NearDuplicateIndex
+from metrics import (
+    DEGRADED_MODERATIONS, EDIT_CHARACTERS, EDIT_REMODERATIONS, HTTP_LATENCY, HTTP_REQUESTS, LOCAL_CLASSIFIER_DECISIONS,
+    MODERATION_CHUNKS, MODERATION_RECHECKS, NEAR_DUPLICATE_DETECTIONS, NEAR_DUPLICATE_INDEX_SIZE, REPLY_STREAMS,
+    MULTIPROCESS as METRICS_MULTIPROCESS, cache_metrics, mark_worker_dead, monitor_event_loop_lag, render_latest,
+    time_stage, update_queue_metrics
+)
+from prompts import (
+    MODERATION_BATCH_PROMPT, MODERATION_PROMPT, REPLY_PROMPT, VERIFICATION_PROMPT, VERIFICATION_USER_FIELDS,
+    prompt_registry
+)
+from rules import rule_engine
+from scheduler import BACKGROUND, INTERACTIVE, UpstreamScheduler, parse_model_limits, request_class, upstream_class
+from segments import diff_segments, segment_hash, split_segments
+from serialization import encode_response
+from singleflight import SingleFlight
+from startup import StartupState
+from tokens import TokenCounter
+from tracing import Tracer, span, traced_handler
+from work_queue import QueueFullError, WorkQueue
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+startup_state = StartupState()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build clients, load models and warm connections before serving; release them on shutdown"""
+    await startup()
+    startup_state.mark_ready()
+    yield
+    startup_state.mark_shutting_down()
+    await shutdown()
+
 app = FastAPI(
     title="Circle of Peers AI Service",
     description="AI moderation and peer response service for Circle of Peers platform",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -37,12 +82,25 @@ class PostContent(BaseModel):
     room_id: Optional[int] = None
     thread_id: Optional[int] = None
 
+class TokenUsage(BaseModel):
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    chunks: int = 1
+    chunks_skipped: int = 0  # chunks left unmoderated by the token budget
+
 class ModerationResult(BaseModel):
     flagged: bool
     violation_type: Optional[str] = None
     severity: Optional[int] = None
     reason: Optional[str] = None
     confidence: Optional[float] = None
+    tokens: Optional[TokenUsage] = None  # None when no LLM call was made
+    degraded: bool = False  # answered without the LLM under overload; re-checked later
+
+class BatchModerationItem(BaseModel):
+    post_id: int
+    result: Optional[ModerationResult] = None
+    error: Optional[str] = None
 
 class AIResponse(BaseModel):
     content: str
@@ -64,6 +122,274 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 DISCOURSE_API_KEY = os.getenv("DISCOURSE_API_KEY")
 DISCOURSE_API_USERNAME = os.getenv("DISCOURSE_API_USERNAME", "system")
 DISCOURSE_BASE_URL = os.getenv("DISCOURSE_BASE_URL", "http://discourse:80")
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Moderation model and prompt version (both feed the result cache key); verdicts from
+# single and micro-batched prompts share the cache, so both templates count
+MODERATION_MODEL = os.getenv("MODERATION_MODEL", "gpt-3.5-turbo")
+MODERATION_PROMPT_VERSION = f"{MODERATION_PROMPT.cache_version}+{MODERATION_BATCH_PROMPT.cache_version}"
+
+# Long posts are moderated in overlapping chunks, within a per-request token budget
+MODERATION_CHUNK_TOKENS = int(os.getenv("MODERATION_CHUNK_TOKENS", "3000"))
+MODERATION_CHUNK_OVERLAP_TOKENS = int(os.getenv("MODERATION_CHUNK_OVERLAP_TOKENS", "200"))
+MODERATION_TOKEN_BUDGET = int(os.getenv("MODERATION_TOKEN_BUDGET", "12000"))
+
+# The tiktoken encoding (a download on a cold cache) is loaded in load_models, not at import
+token_counter = TokenCounter(MODERATION_MODEL)
+
+# OpenAI client pool and limits
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "64"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30"))
+# Point at an OpenAI-compatible server instead of api.openai.com (e.g. benchmarks/fake_openai.py)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+
+# Per-model circuit breaker: open when too many calls in the window fail or run slow
+OPENAI_BREAKER_WINDOW_SECONDS = float(os.getenv("OPENAI_BREAKER_WINDOW_SECONDS", "30"))
+OPENAI_BREAKER_MIN_CALLS = int(os.getenv("OPENAI_BREAKER_MIN_CALLS", "10"))
+OPENAI_BREAKER_ERROR_RATE = float(os.getenv("OPENAI_BREAKER_ERROR_RATE", "0.5"))
+OPENAI_BREAKER_SLOW_CALL_SECONDS = float(os.getenv("OPENAI_BREAKER_SLOW_CALL_SECONDS", "8"))
+OPENAI_BREAKER_SLOW_CALL_RATE = float(os.getenv("OPENAI_BREAKER_SLOW_CALL_RATE", "0.5"))
+OPENAI_BREAKER_OPEN_SECONDS = float(os.getenv("OPENAI_BREAKER_OPEN_SECONDS", "15"))
+MODERATION_TIMEOUT_SECONDS = float(os.getenv("MODERATION_TIMEOUT_SECONDS", "15"))
+
+# Upstream scheduling: per-model "model=concurrency:tokens_per_minute,..." limits
+# (other models get OPENAI_MAX_CONCURRENCY and OPENAI_TOKENS_PER_MINUTE, 0 = no token
+# limit). Interactive calls go first; one background call is let through after every
+# UPSTREAM_BACKGROUND_AFTER interactive ones while both are waiting.
+OPENAI_MODEL_LIMITS = os.getenv("OPENAI_MODEL_LIMITS")
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "0"))
+UPSTREAM_BACKGROUND_AFTER = int(os.getenv("UPSTREAM_BACKGROUND_AFTER", "8"))
+upstream_scheduler = UpstreamScheduler(
+    default_concurrency=OPENAI_MAX_CONCURRENCY,
+    default_tokens_per_minute=OPENAI_TOKENS_PER_MINUTE,
+    model_limits=parse_model_limits(OPENAI_MODEL_LIMITS),
+    background_after=UPSTREAM_BACKGROUND_AFTER
+)
+
+# Shared OpenAI client, started with the app
+llm_client = LLMClient(
+    api_key=OPENAI_API_KEY,
+    max_connections=OPENAI_MAX_CONNECTIONS,
+    max_concurrency=OPENAI_MAX_CONCURRENCY,
+    timeout=OPENAI_TIMEOUT_SECONDS,
+    base_url=OPENAI_BASE_URL,
+    breaker_settings={
+        "window_seconds": OPENAI_BREAKER_WINDOW_SECONDS,
+        "min_calls": OPENAI_BREAKER_MIN_CALLS,
+        "error_rate_threshold": OPENAI_BREAKER_ERROR_RATE,
+        "slow_call_seconds": OPENAI_BREAKER_SLOW_CALL_SECONDS,
+        "slow_call_rate_threshold": OPENAI_BREAKER_SLOW_CALL_RATE,
+        "open_seconds": OPENAI_BREAKER_OPEN_SECONDS
+    },
+    scheduler=upstream_scheduler
+)
+
+# Near-duplicate spam detection over recent posts
+NEAR_DUP_ENABLED = os.getenv("NEAR_DUP_ENABLED", "true").lower() == "true"
+NEAR_DUP_WINDOW_SECONDS = float(os.getenv("NEAR_DUP_WINDOW_SECONDS", "86400"))
+NEAR_DUP_MAX_ENTRIES = int(os.getenv("NEAR_DUP_MAX_ENTRIES", "20000"))
+NEAR_DUP_MAX_PER_USER = int(os.getenv("NEAR_DUP_MAX_PER_USER", "50"))
+NEAR_DUP_SIMILARITY = float(os.getenv("NEAR_DUP_SIMILARITY", "0.5"))
+NEAR_DUP_SAME_USER_REPEATS = int(os.getenv("NEAR_DUP_SAME_USER_REPEATS", "1"))
+NEAR_DUP_OTHER_USERS = int(os.getenv("NEAR_DUP_OTHER_USERS", "3"))
+NEAR_DUP_INDEX_PATH = os.getenv("NEAR_DUP_INDEX_PATH")
+NEAR_DUP_SNAPSHOT_SECONDS = float(os.getenv("NEAR_DUP_SNAPSHOT_SECONDS", "300"))
+
+near_duplicate_index = NearDuplicateIndex(
+    window_seconds=NEAR_DUP_WINDOW_SECONDS,
+    max_entries=NEAR_DUP_MAX_ENTRIES,
+    max_per_user=NEAR_DUP_MAX_PER_USER,
+    similarity_threshold=NEAR_DUP_SIMILARITY
+)
+near_duplicate_snapshot_task = None
+
+# Event loop lag sampling for /metrics (0 disables)
+EVENT_LOOP_MONITOR_INTERVAL_SECONDS = float(os.getenv("EVENT_LOOP_MONITOR_INTERVAL_SECONDS", "0.5"))
+event_loop_monitor_task = None
+
+# Load shedding: while the event loop lags, too many /moderate requests are in flight or
+# interactive upstream calls queue too long (0 disables a signal), /moderate skips the LLM
+# and answers from the regex, near-duplicate, cache and local classifier stages. Posts
+# those stages cannot decide are answered unflagged, marked degraded with a scaled-down
+# confidence, and re-checked by the LLM once every signal has stayed below
+# LOAD_SHED_RECOVER_RATIO of its limit for a while.
+LOAD_SHED_ENABLED = os.getenv("LOAD_SHED_ENABLED", "true").lower() == "true"
+LOAD_SHED_MAX_EVENT_LOOP_LAG_MS = float(os.getenv("LOAD_SHED_MAX_EVENT_LOOP_LAG_MS", "200"))
+LOAD_SHED_MAX_IN_FLIGHT = int(os.getenv("LOAD_SHED_MAX_IN_FLIGHT", "200"))
+LOAD_SHED_MAX_QUEUE_WAIT_SECONDS = float(os.getenv("LOAD_SHED_MAX_QUEUE_WAIT_SECONDS", "2"))
+LOAD_SHED_RECOVER_RATIO = float(os.getenv("LOAD_SHED_RECOVER_RATIO", "0.5"))
+LOAD_SHED_RECOVER_SECONDS = float(os.getenv("LOAD_SHED_RECOVER_SECONDS", "10"))
+DEGRADED_CONFIDENCE_FACTOR = float(os.getenv("DEGRADED_CONFIDENCE_FACTOR", "0.5"))
+REGEX_ONLY_CONFIDENCE = 0.5  # no model looked at the post: no evidence either way
+RECHECK_QUEUE_SIZE = int(os.getenv("RECHECK_QUEUE_SIZE", "10000"))
+RECHECK_WORKERS = int(os.getenv("RECHECK_WORKERS", "2"))
+
+overload_detector = OverloadDetector(
+    enabled=LOAD_SHED_ENABLED,
+    max_event_loop_lag=LOAD_SHED_MAX_EVENT_LOOP_LAG_MS / 1000,
+    max_in_flight=LOAD_SHED_MAX_IN_FLIGHT,
+    max_queue_wait=LOAD_SHED_MAX_QUEUE_WAIT_SECONDS,
+    recover_ratio=LOAD_SHED_RECOVER_RATIO,
+    recover_seconds=LOAD_SHED_RECOVER_SECONDS,
+    queue_wait=lambda: upstream_scheduler.oldest_wait(INTERACTIVE)
+)
+
+# Startup warm-up: keep-alive connections opened to OpenAI (and one to Discourse) before the
+# worker reports ready (0 disables), and a sample post run through the local stages
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "2"))
+WARMUP_SAMPLE_TEXT = "Warm-up post: how are other CEOs handling board reporting this quarter?"
+
+# Per-request stage tracing: Server-Timing headers, and OpenTelemetry spans when an
+# OTLP endpoint is set (e.g. http://otel-collector:4318/v1/traces). Off by default.
+# Sampled requests carry Server-Timing, so only set a rate where callers are trusted.
+# A request whose TRACE_FORCE_HEADER equals TRACE_FORCE_TOKEN is traced regardless of
+# sampling; with no token set the header is ignored.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_FORCE_HEADER = os.getenv("TRACE_FORCE_HEADER", "X-Trace-Sample")
+TRACE_FORCE_TOKEN = os.getenv("TRACE_FORCE_TOKEN")
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "cop-ai-service")
+tracer = Tracer(
+    sample_rate=TRACE_SAMPLE_RATE,
+    otlp_endpoint=OTEL_EXPORTER_OTLP_ENDPOINT,
+    service_name=OTEL_SERVICE_NAME,
+    force_token=TRACE_FORCE_TOKEN
+)
+
+# Local classifier tier between the regex pre-filter and the LLM
+CLASSIFIER_MODEL_PATH = os.getenv("CLASSIFIER_MODEL_PATH")
+CLASSIFIER_CLEAN_THRESHOLD = float(os.getenv("CLASSIFIER_CLEAN_THRESHOLD", "0.95"))
+CLASSIFIER_VIOLATION_THRESHOLD = float(os.getenv("CLASSIFIER_VIOLATION_THRESHOLD", "0.97"))
+
+# Loaded once per worker by load_models() at startup; None disables the tier
+moderation_classifier = None
+
+# Multi-worker mode: WEB_CONCURRENCY uvicorn workers (read by uvicorn itself). The regex
+# scan and classifier run in CPU_POOL_WORKERS spawned processes per worker for posts of
+# CPU_POOL_MIN_CHARS+ characters, so a huge post does not block the event loop (0 disables).
+# With REDIS_URL, caches, in-flight dedupe and upstream limits are shared by all workers;
+# the near-duplicate index is not (each worker only compares the posts it saw). Metrics
+# need PROMETHEUS_MULTIPROC_DIR to cover all workers (see metrics.py); they are refreshed
+# every METRICS_REFRESH_SECONDS in each worker then.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+METRICS_REFRESH_SECONDS = float(os.getenv("METRICS_REFRESH_SECONDS", "5"))
+metrics_refresh_task = None
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", "1"))
+CPU_POOL_MIN_CHARS = int(os.getenv("CPU_POOL_MIN_CHARS", "20000"))
+UPSTREAM_LIMITS_SHARED = os.getenv("UPSTREAM_LIMITS_SHARED", "true").lower() == "true"
+cpu_pool = CPUPool(
+    workers=CPU_POOL_WORKERS,
+    min_chars=CPU_POOL_MIN_CHARS,
+    classifier_path=CLASSIFIER_MODEL_PATH
+)
+
+# Micro-batching of LLM moderation calls (several posts per completion)
+MODERATION_MICROBATCH_ENABLED = os.getenv("MODERATION_MICROBATCH_ENABLED", "false").lower() == "true"
+MODERATION_MICROBATCH_MAX_SIZE = int(os.getenv("MODERATION_MICROBATCH_MAX_SIZE", "8"))
+MODERATION_MICROBATCH_MAX_WAIT_MS = float(os.getenv("MODERATION_MICROBATCH_MAX_WAIT_MS", "50"))
+
+# Batch moderation limits
+MODERATION_BATCH_MAX_SIZE = int(os.getenv("MODERATION_BATCH_MAX_SIZE", "1000"))
+MODERATION_BATCH_CONCURRENCY = int(os.getenv("MODERATION_BATCH_CONCURRENCY", "16"))
+
+# Webhook moderation queue
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_MAX_RETRIES = int(os.getenv("WEBHOOK_MAX_RETRIES", "3"))
+WEBHOOK_RETRY_BACKOFF_SECONDS = float(os.getenv("WEBHOOK_RETRY_BACKOFF_SECONDS", "2"))
+WEBHOOK_QUEUE_BACKEND = os.getenv("WEBHOOK_QUEUE_BACKEND", "memory")  # "memory" or "redis"
+WEBHOOK_DRAIN_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT_SECONDS", "30"))
+WEBHOOK_RETRY_AFTER_SECONDS = int(os.getenv("WEBHOOK_RETRY_AFTER_SECONDS", "5"))
+
+# Moderation result cache
+MODERATION_CACHE_SIZE = int(os.getenv("MODERATION_CACHE_SIZE", "10000"))
+MODERATION_CACHE_TTL_SECONDS = float(os.getenv("MODERATION_CACHE_TTL_SECONDS", "86400"))
+MODERATION_CACHE_REDIS = os.getenv("MODERATION_CACHE_REDIS", "true").lower() == "true"
+
+moderation_cache = ResultCache(
+    namespace="moderation",
+    max_entries=MODERATION_CACHE_SIZE,
+    ttl_seconds=MODERATION_CACHE_TTL_SECONDS,
+    redis_url=REDIS_URL if MODERATION_CACHE_REDIS else None
+)
+cache_metrics.register("moderation", moderation_cache)
+
+# Vera verification results, keyed on the normalized applicant info and criteria
+VERIFICATION_MODEL = os.getenv("VERIFICATION_MODEL", "gpt-3.5-turbo")
+VERIFICATION_PROMPT_VERSION = VERIFICATION_PROMPT.cache_version
+VERIFICATION_CACHE_SIZE = int(os.getenv("VERIFICATION_CACHE_SIZE", "5000"))
+VERIFICATION_CACHE_TTL_SECONDS = float(os.getenv("VERIFICATION_CACHE_TTL_SECONDS", "604800"))
+VERIFICATION_CACHE_REDIS = os.getenv("VERIFICATION_CACHE_REDIS", "true").lower() == "true"
+VERIFICATION_BATCH_MAX_SIZE = int(os.getenv("VERIFICATION_BATCH_MAX_SIZE", "500"))
+VERIFICATION_BATCH_CONCURRENCY = int(os.getenv("VERIFICATION_BATCH_CONCURRENCY", "8"))
+
+verification_cache = ResultCache(
+    namespace="verification",
+    max_entries=VERIFICATION_CACHE_SIZE,
+    ttl_seconds=VERIFICATION_CACHE_TTL_SECONDS,
+    redis_url=REDIS_URL if VERIFICATION_CACHE_REDIS else None
+)
+cache_metrics.register("verification", verification_cache)
+
+# Streamed replies are kept briefly so the Rails side can fetch the final AIResponse
+REPLY_RESULT_TTL_SECONDS = float(os.getenv("REPLY_RESULT_TTL_SECONDS", "600"))
+
+reply_results = ResultCache(
+    namespace="reply",
+    max_entries=1000,
+    ttl_seconds=REPLY_RESULT_TTL_SECONDS,
+    redis_url=REDIS_URL if MODERATION_CACHE_REDIS else None
+)
+
+# Per-post paragraph hashes and verdict from the last moderation, so edits
+# only send new or changed paragraphs to review
+EDIT_SEGMENTS_ENABLED = os.getenv("EDIT_SEGMENTS_ENABLED", "true").lower() == "true"
+EDIT_SEGMENTS_SIZE = int(os.getenv("EDIT_SEGMENTS_SIZE", "50000"))
+EDIT_SEGMENTS_TTL_SECONDS = float(os.getenv("EDIT_SEGMENTS_TTL_SECONDS", "2592000"))
+
+post_segments = ResultCache(
+    namespace="segments",
+    max_entries=EDIT_SEGMENTS_SIZE,
+    ttl_seconds=EDIT_SEGMENTS_TTL_SECONDS,
+    redis_url=REDIS_URL if MODERATION_CACHE_REDIS else None
+)
+cache_metrics.register("segments", post_segments)
+
+# Who flags posts in Discourse: by default the ai-moderation plugin, which creates the
+# flag from its own /moderate call. FLAG_OUTBOX_ENABLED hands flagging to this service
+# instead (webhook verdicts and re-checks); turn it on only with the plugin job disabled,
+# or posts get flagged through both. The outbox sends flags in short batches over one
+# pooled client; flags that fail permanently are kept in Redis (with REDIS_URL) or
+# FLAG_DEAD_LETTER_PATH.
+FLAG_OUTBOX_ENABLED = os.getenv("FLAG_OUTBOX_ENABLED", "false").lower() == "true"
+DISCOURSE_MAX_CONNECTIONS = int(os.getenv("DISCOURSE_MAX_CONNECTIONS", "20"))
+DISCOURSE_TIMEOUT_SECONDS = float(os.getenv("DISCOURSE_TIMEOUT_SECONDS", "10"))
+FLAG_BATCH_WINDOW_MS = float(os.getenv("FLAG_BATCH_WINDOW_MS", "250"))
+FLAG_BATCH_MAX_SIZE = int(os.getenv("FLAG_BATCH_MAX_SIZE", "50"))
+FLAG_DELIVERY_CONCURRENCY = int(os.getenv("FLAG_DELIVERY_CONCURRENCY", "8"))
+FLAG_MAX_ATTEMPTS = int(os.getenv("FLAG_MAX_ATTEMPTS", "5"))
+FLAG_RETRY_BACKOFF_SECONDS = float(os.getenv("FLAG_RETRY_BACKOFF_SECONDS", "1"))
+FLAG_DEAD_LETTER_PATH = os.getenv("FLAG_DEAD_LETTER_PATH")
+
+flag_outbox = FlagOutbox(
+    base_url=DISCOURSE_BASE_URL,
+    api_key=DISCOURSE_API_KEY,
+    api_username=DISCOURSE_API_USERNAME,
+    window_ms=FLAG_BATCH_WINDOW_MS,
+    max_batch_size=FLAG_BATCH_MAX_SIZE,
+    concurrency=FLAG_DELIVERY_CONCURRENCY,
+    max_attempts=FLAG_MAX_ATTEMPTS,
+    retry_backoff_seconds=FLAG_RETRY_BACKOFF_SECONDS,
+    max_connections=DISCOURSE_MAX_CONNECTIONS,
+    timeout=DISCOURSE_TIMEOUT_SECONDS,
+    redis_url=REDIS_URL,
+    dead_letter_path=FLAG_DEAD_LETTER_PATH
+)
+
+# Concurrent identical moderation/verification calls share one upstream call
+moderation_flights = SingleFlight("moderation", redis_url=REDIS_URL if MODERATION_CACHE_REDIS else None)
+verification_flights = SingleFlight("verification", redis_url=REDIS_URL if VERIFICATION_CACHE_REDIS else None)
 
 # Violation types mapping
 VIOLATION_TYPES = {
@@ -77,6 +403,145 @@ VIOLATION_TYPES = {
     "inappropriate": "Inappropriate content for professional forum"
 }
 
+# Default severity per violation type (see FLAGGING_SYSTEM.md)
+VIOLATION_SEVERITIES = {
+    "solicitation": 3,
+    "pii": 4,
+    "harassment": 5,
+    "confidential": 4,
+    "off_topic": 2,
+    "spam": 3,
+    "identity_leak": 4,
+    "inappropriate": 3
+}
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Count requests, record latency per endpoint and attach stage timings to traced requests"""
+    start = time.perf_counter()
+    status = 500
+    trace = tracer.start(f"{request.method} {request.url.path}", force=tracer.forced(request.headers.get(TRACE_FORCE_HEADER)))
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        if trace is not None:
+            # Streamed bodies are still being produced, so their total covers headers only
+            finished = trace.finish()
+            response.headers["Server-Timing"] = trace.server_timing()
+            route = request.scope.get("route")
+            tracer.export(trace, finished, {
+                "http.method": request.method,
+                "http.route": route.path if route is not None else "unmatched",
+                "http.status_code": status
+            })
+        return response
+    finally:
+        # Label by route template, not raw path, to keep cardinality bounded
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+        HTTP_REQUESTS.labels(request.method, endpoint, str(status)).inc()
+        HTTP_LATENCY.labels(request.method, endpoint).observe(time.perf_counter() - start)
+
+async def startup():
+    """Load models, create long-lived clients and warm them up (runs once in every worker)"""
+    with startup_state.step("load_models"):
+        await load_models()
+    with startup_state.step("clients"):
+        if OPENAI_API_KEY:
+            await llm_client.start()
+        if DISCOURSE_API_KEY and FLAG_OUTBOX_ENABLED:
+            await flag_outbox.start()
+    with startup_state.step("redis"):
+        if UPSTREAM_LIMITS_SHARED:
+            await upstream_scheduler.start(REDIS_URL)
+        await asyncio.gather(
+            moderation_flights.start(),
+            verification_flights.start(),
+            moderation_cache.start(),
+            verification_cache.start(),
+            reply_results.start(),
+            post_segments.start()
+        )
+    with startup_state.step("webhook_queue"):
+        await webhook_queue.start()
+        await recheck_queue.start()
+    
+    global near_duplicate_snapshot_task, event_loop_monitor_task, metrics_refresh_task
+    if METRICS_MULTIPROCESS:
+        metrics_refresh_task = asyncio.create_task(refresh_metrics_periodically())
+    elif WEB_CONCURRENCY > 1:
+        logger.warning(
+            f"WEB_CONCURRENCY={WEB_CONCURRENCY} without PROMETHEUS_MULTIPROC_DIR: "
+            f"/metrics only reports the worker that answers each scrape"
+        )
+    if EVENT_LOOP_MONITOR_INTERVAL_SECONDS > 0:
+        event_loop_monitor_task = asyncio.create_task(monitor_event_loop_lag(EVENT_LOOP_MONITOR_INTERVAL_SECONDS))
+    overload_detector.start()
+    
+    if NEAR_DUP_ENABLED and NEAR_DUP_INDEX_PATH:
+        with startup_state.step("near_duplicate_index"):
+            if os.path.exists(NEAR_DUP_INDEX_PATH):
+                try:
+                    loaded = near_duplicate_index.load(NEAR_DUP_INDEX_PATH)
+                    logger.info(f"Loaded {loaded} near-duplicate index entries from {NEAR_DUP_INDEX_PATH}")
+                except Exception as e:
+                    logger.error(f"Failed to load near-duplicate index: {str(e)}")
+        near_duplicate_snapshot_task = asyncio.create_task(snapshot_near_duplicate_index())
+    
+    with startup_state.step("warm_up"):
+        await warm_up()
+
+async def warm_up():
+    """Open upstream connections and run the local stages once, so the first request pays for neither"""
+    if WARMUP_SAMPLE_TEXT:
+        check_basic_violations(WARMUP_SAMPLE_TEXT)
+        token_counter.count(WARMUP_SAMPLE_TEXT)
+        if moderation_classifier is not None:
+            moderation_classifier.predict(WARMUP_SAMPLE_TEXT)
+    
+    if WARMUP_CONNECTIONS > 0:
+        openai_connections, discourse_connected = await asyncio.gather(
+            llm_client.warm(WARMUP_CONNECTIONS),
+            flag_outbox.warm()
+        )
+        logger.info(f"Warm-up opened {openai_connections} OpenAI and {int(discourse_connected)} Discourse connections")
+
+async def shutdown():
+    """Release long-lived clients"""
+    if event_loop_monitor_task is not None:
+        event_loop_monitor_task.cancel()
+    # Re-checks parked until load drops run now while the queue drains (a Redis backlog waits for the next start)
+    overload_detector.stop()
+    await webhook_queue.stop(timeout=WEBHOOK_DRAIN_TIMEOUT_SECONDS)
+    await recheck_queue.stop(timeout=WEBHOOK_DRAIN_TIMEOUT_SECONDS)
+    await flag_outbox.close(timeout=DISCOURSE_TIMEOUT_SECONDS)
+    await moderation_batcher.close()
+    if near_duplicate_snapshot_task is not None:
+        near_duplicate_snapshot_task.cancel()
+        save_near_duplicate_index()
+    await llm_client.close()
+    await upstream_scheduler.close()
+    await moderation_flights.close()
+    await verification_flights.close()
+    await moderation_cache.close()
+    await verification_cache.close()
+    await reply_results.close()
+    await post_segments.close()
+    cpu_pool.close()
+    tracer.shutdown()
+    if metrics_refresh_task is not None:
+        metrics_refresh_task.cancel()
+    mark_worker_dead()
+
+async def load_models():
+    """Per-worker startup hook: load the classifier and token encoding and start the CPU pool"""
+    global moderation_classifier
+    if moderation_classifier is None:
+        moderation_classifier = load_classifier(CLASSIFIER_MODEL_PATH)
+    # Off the event loop: without a cached encoding tiktoken downloads it
+    await asyncio.to_thread(token_counter.load)
+    await cpu_pool.start()
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
@@ -87,70 +552,194 @@ async def root():
         "timestamp": datetime.utcnow().isoformat()
     }
 
+@app.get("/health/live")
+async def liveness():
+    """Liveness probe: the worker is serving HTTP (restart it if this fails)"""
+    return {"status": "alive", "uptime_seconds": startup_state.stats()["uptime_seconds"]}
+
+@app.get("/health/ready")
+async def readiness():
+    """Readiness probe: startup finished and not shutting down (route traffic only when 200)"""
+    if not startup_state.ready:
+        raise HTTPException(
+            status_code=503,
+            detail={"status": "shutting_down" if startup_state.shutting_down else "starting", **startup_state.stats()}
+        )
+    return {"status": "ready", **startup_state.stats()}
+
 @app.get("/health")
 async def health_check():
     """Detailed health check"""
     return {
         "status": "healthy",
+        "ready": startup_state.ready,
+        "startup": startup_state.stats(),
         "openai_configured": bool(OPENAI_API_KEY),
         "discourse_configured": bool(DISCOURSE_API_KEY),
         "services": {
             "openai": "configured" if OPENAI_API_KEY else "missing",
             "discourse": "configured" if DISCOURSE_API_KEY else "missing"
+        },
+        "moderation_cache": moderation_cache.stats(),
+        "verification_cache": verification_cache.stats(),
+        "webhook_queue": await webhook_queue.stats(),
+        "load_shedding": overload_detector.stats(),
+        "recheck_queue": await recheck_queue.stats(),
+        "flag_outbox": {
+            "enabled": FLAG_OUTBOX_ENABLED,
+            **flag_outbox.stats()
+        },
+        "circuit_breakers": llm_client.breaker_stats(),
+        "upstream_scheduler": upstream_scheduler.stats(),
+        "cpu_pool": cpu_pool.stats(),
+        "near_duplicate_index": {
+            "enabled": NEAR_DUP_ENABLED,
+            **near_duplicate_index.stats()
+        },
+        "local_classifier": {
+            "loaded": moderation_classifier is not None,
+            "version": moderation_classifier.version if moderation_classifier else None,
+            "clean_threshold": CLASSIFIER_CLEAN_THRESHOLD,
+            "violation_threshold": CLASSIFIER_VIOLATION_THRESHOLD
+        },
+        "moderation_microbatch": {
+            "enabled": MODERATION_MICROBATCH_ENABLED,
+            **moderation_batcher.stats()
+        },
+        "prompt_templates": prompt_registry.versions(),
+        "inflight_dedup": {
+            "moderation": moderation_flights.stats(),
+            "verification": verification_flights.stats()
         }
     }
 
+async def refresh_metrics():
+    """Copy values kept by components (queues, caches, the near-duplicate index) into metrics"""
+    await update_queue_metrics("webhook", webhook_queue)
+    await update_queue_metrics("recheck", recheck_queue)
+    NEAR_DUPLICATE_INDEX_SIZE.set(len(near_duplicate_index))
+    cache_metrics.update()
+
+async def refresh_metrics_periodically():
+    """Multiprocess metrics: a scrape reads every worker's files, so each worker refreshes its own"""
+    while True:
+        try:
+            await refresh_metrics()
+        except Exception as e:
+            logger.warning(f"Metrics refresh failed: {str(e)}")
+        await asyncio.sleep(METRICS_REFRESH_SECONDS)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    await refresh_metrics()
+    body, content_type = render_latest()
+    return Response(content=body, media_type=content_type)
+
 @app.post("/webhook", response_model=ModerationResult)
-async def webhook_handler(payload: WebhookPayload, background_tasks: BackgroundTasks):
+async def webhook_handler(payload: WebhookPayload, request: Request):
     """
     Handle webhooks from Discourse for real-time moderation
     """
     try:
         logger.info(f"Received webhook: {payload.event_type} for post {payload.post_id}")
         
-        # Process moderation in background
-        background_tasks.add_task(process_webhook_moderation, payload)
+        # Queue moderation for the worker pool
+        await webhook_queue.enqueue(payload.model_dump())
         
-        return ModerationResult(flagged=False)  # Immediate response
+        return encode_response(request, ModerationResult(flagged=False))  # Immediate response
         
+    except QueueFullError as e:
+        logger.warning(f"Webhook rejected for post {payload.post_id}: {str(e)}")
+        raise HTTPException(
+            status_code=503,
+            detail="Moderation queue full, retry later",
+            headers={"Retry-After": str(WEBHOOK_RETRY_AFTER_SECONDS)}
+        )
     except Exception as e:
         logger.error(f"Webhook processing error: {str(e)}")
         raise HTTPException(status_code=500, detail="Webhook processing error")
 
 @app.post("/moderate", response_model=ModerationResult)
-async def moderate_content(post: PostContent):
+@traced_handler
+@upstream_class(INTERACTIVE, "moderate")
+async def moderate_content(post: PostContent, request: Request):
     """
-    Moderate post content for violations
+    Moderate post content for violations (degraded, without the LLM, while overloaded)
     """
-    try:
-        # Basic content validation
-        if not post.content.strip():
-            return ModerationResult(flagged=False)
+    with overload_detector.track():
+        try:
+            # Empty content and obvious violations (regex-based)
+            prefiltered = await prefilter_content(post.content)
+            if prefiltered:
+                await remember_segments(post, prefiltered)
+                return encode_response(request, prefiltered)
+            
+        except Exception as e:
+            logger.error(f"Error in moderation: {str(e)}")
+            raise HTTPException(status_code=500, detail="Moderation service error")
         
-        # Check for obvious violations first (regex-based)
-        basic_violations = check_basic_violations(post.content)
-        if basic_violations:
-            return ModerationResult(
-                flagged=True,
-                violation_type=basic_violations["type"],
-                severity=basic_violations["severity"],
-                reason=basic_violations["reason"],
-                confidence=0.9
-            )
+        if OPENAI_API_KEY and overload_detector.overloaded:
+            return encode_response(request, await degraded_review(post))
         
-        # AI-based moderation if OpenAI is configured
-        if OPENAI_API_KEY:
-            ai_result = await moderate_with_ai(post.content)
-            return ai_result
-        
-        # Fallback to basic checks only
-        return ModerationResult(flagged=False)
+        try:
+            result = await review_post(post)
+            await remember_segments(post, result)
+            return encode_response(request, result)
+        except Exception as e:
+            # Failures fall back to unflagged and are never cached
+            logger.error(f"AI moderation error: {str(e)}")
+            return encode_response(request, ModerationResult(flagged=False))
+
+@app.post("/moderate/batch", response_model=List[BatchModerationItem])
+@traced_handler
+@upstream_class(BACKGROUND, "moderate_batch")
+async def moderate_batch(posts: List[PostContent], request: Request):
+    """
+    Moderate a batch of posts, returning one result per post in request order
+    """
+    if len(posts) > MODERATION_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large (max {MODERATION_BATCH_MAX_SIZE} posts)"
+        )
+    
+    items = [BatchModerationItem(post_id=post.post_id) for post in posts]
+    
+    # Regex pre-filter for the whole batch before any LLM call
+    pending = []
+    for index, post in enumerate(posts):
+        try:
+            prefiltered = await prefilter_content(post.content)
+        except Exception as e:
+            logger.error(f"Batch pre-filter error for post {post.post_id}: {str(e)}")
+            items[index].error = "Moderation service error"
+            continue
         
-    except Exception as e:
-        logger.error(f"Error in moderation: {str(e)}")
-        raise HTTPException(status_code=500, detail="Moderation service error")
+        if prefiltered:
+            items[index].result = prefiltered
+        else:
+            pending.append(index)
+    
+    # Surviving posts go to the LLM with bounded concurrency
+    semaphore = asyncio.Semaphore(MODERATION_BATCH_CONCURRENCY)
+    
+    async def moderate_item(index: int):
+        async with semaphore:
+            try:
+                items[index].result = await review_post(posts[index])
+            except Exception as e:
+                logger.error(f"Batch AI moderation error for post {posts[index].post_id}: {str(e)}")
+                items[index].error = "AI moderation error"
+    
+    await asyncio.gather(*(moderate_item(index) for index in pending))
+    
+    logger.info(f"Batch moderation: {len(posts)} posts, {len(pending)} past the pre-filter")
+    return encode_response(request, items)
 
 @app.post("/reply", response_model=AIResponse)
+@traced_handler
+@upstream_class(INTERACTIVE, "reply")
 async def generate_peer_response(post: PostContent):
     """
     Generate AI peer response for threads
@@ -172,6 +761,73 @@ async def generate_peer_response(post: PostContent):
         logger.error(f"Error generating AI response: {str(e)}")
         raise HTTPException(status_code=500, detail="AI response generation error")
 
+def sse_event(event: str, data: dict) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/reply/stream")
+async def stream_peer_response(post: PostContent):
+    """
+    Stream an AI peer response as Server-Sent Events.
+    
+    Emits "start" (with the reply_id), one "token" per text delta, then
+    "done" with the assembled AIResponse or "error". The final AIResponse is
+    also kept for REPLY_RESULT_TTL_SECONDS at GET /reply/{reply_id}. If the
+    client disconnects, the upstream completion is closed.
+    """
+    if not OPENAI_API_KEY:
+        raise HTTPException(status_code=500, detail="OpenAI not configured")
+    
+    reply_id = uuid.uuid4().hex
+    
+    async def events():
+        parts = []
+        yield sse_event("start", {"reply_id": reply_id, "post_id": post.post_id})
+        try:
+            # The body is sent after the endpoint returns, so the class is set here
+            with request_class(INTERACTIVE, "reply_stream"):
+                async for delta in stream_ai_response(post.content, post.room_id):
+                    parts.append(delta)
+                    yield sse_event("token", {"content": delta})
+        except asyncio.CancelledError:
+            REPLY_STREAMS.labels("cancelled").inc()
+            logger.info(f"Reply stream {reply_id} for post {post.post_id} cancelled by client disconnect")
+            raise
+        except Exception as e:
+            REPLY_STREAMS.labels("error").inc()
+            logger.error(f"Error streaming AI response: {str(e)}")
+            yield sse_event("error", {"reply_id": reply_id, "detail": "AI response generation error"})
+            return
+        
+        result = AIResponse(
+            content="".join(parts),
+            context_aware=True,
+            response_type="peer_insight"
+        )
+        await reply_results.set(reply_id, result.model_dump())
+        REPLY_STREAMS.labels("completed").inc()
+        yield sse_event("done", {"reply_id": reply_id, **result.model_dump()})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # stop nginx buffering the stream
+            "X-Reply-Id": reply_id
+        }
+    )
+
+@app.get("/reply/{reply_id}", response_model=AIResponse)
+async def get_streamed_reply(reply_id: str):
+    """
+    Final AIResponse of a completed /reply/stream call
+    """
+    result = await reply_results.get(reply_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Reply not found, still streaming, or expired")
+    return AIResponse(**result)
+
 @app.post("/flag", response_model=dict)
 async def create_user_flag(post: PostContent, violation_type: str, reason: str):
     """
@@ -240,8 +896,15 @@ class VerificationResult(BaseModel):
     risk_factors: List[dict]
     analysis: dict
 
+class BatchVerificationItem(BaseModel):
+    index: int
+    result: VerificationResult
+    fallback: bool  # True when Vera failed and fallback_verification_analysis answered
+
 @app.post("/verify", response_model=VerificationResult)
-async def verify_user(verification_data: UserVerificationData):
+@traced_handler
+@upstream_class(INTERACTIVE, "verify")
+async def verify_user(verification_data: UserVerificationData, request: Request):
     """
     AI-assisted user verification for registration
     """
@@ -249,198 +912,589 @@ async def verify_user(verification_data: UserVerificationData):
         if not OPENAI_API_KEY:
             raise HTTPException(status_code=500, detail="OpenAI not configured")
         
-        # Analyze user verification data
-        result = await analyze_user_verification(verification_data)
+        # Analyze user verification data (cached, and shared with identical in-flight requests)
+        result, _ = await analyze_user_verification(verification_data)
         
-        return VerificationResult(**result)
+        return encode_response(request, VerificationResult(**result))
         
     except Exception as e:
         logger.error(f"Error in Vera's user verification: {str(e)}")
         raise HTTPException(status_code=500, detail="Vera verification service error")
 
+@app.post("/verify/batch", response_model=List[BatchVerificationItem])
+@traced_handler
+@upstream_class(BACKGROUND, "verify_batch")
+async def verify_users_batch(applicants: List[UserVerificationData], request: Request):
+    """
+    Verify a batch of applicants, returning one result per applicant in request order
+    """
+    if not OPENAI_API_KEY:
+        raise HTTPException(status_code=500, detail="OpenAI not configured")
+    if len(applicants) > VERIFICATION_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large (max {VERIFICATION_BATCH_MAX_SIZE} applicants)"
+        )
+    
+    semaphore = asyncio.Semaphore(VERIFICATION_BATCH_CONCURRENCY)
+    
+    async def verify_item(index: int) -> BatchVerificationItem:
+        async with semaphore:
+            result, fallback = await analyze_user_verification(applicants[index])
+        return BatchVerificationItem(index=index, result=VerificationResult(**result), fallback=fallback)
+    
+    items = await asyncio.gather(*(verify_item(index) for index in range(len(applicants))))
+    
+    fallbacks = sum(item.fallback for item in items)
+    logger.info(f"Batch verification: {len(applicants)} applicants, {fallbacks} fallback analyses")
+    return encode_response(request, items)
+
+@app.post("/verify/invalidate")
+async def invalidate_verification(verification_data: UserVerificationData):
+    """
+    Drop the cached verification for this applicant info and criteria
+    """
+    cache_key = verification_cache_key(verification_data)
+    await verification_cache.invalidate(cache_key)
+    return {"invalidated": True, "cache_key": cache_key}
+
 # Background task for webhook processing
 async def process_webhook_moderation(payload: WebhookPayload):
-    """Process moderation for webhook events"""
+    """Process moderation for webhook events (raises so the queue can retry)"""
+    # Create post content object
+    post_content = PostContent(
+        post_id=payload.post_id,
+        user_id=payload.user_id,
+        peer_id=payload.peer_id,
+        content=payload.content,
+        room_id=payload.room_id,
+        thread_id=payload.thread_id
+    )
+    
+    # Moderate the content; edits only re-review what changed
+    if payload.event_type == "post_edited":
+        result = await moderate_edit(post_content)
+    else:
+        result = await moderate_post(post_content)
+        await remember_segments(post_content, result)
+    
+    if result.flagged:
+        logger.info(f"Webhook moderation flagged post {payload.post_id}: {result.violation_type}")
+        await notify_discourse_of_flag(payload.post_id, result)
+
+async def run_webhook_job(job: dict):
+    """Queue handler for webhook moderation jobs"""
+    with request_class(BACKGROUND, "webhook"):
+        await process_webhook_moderation(WebhookPayload(**job))
+
+webhook_queue = WorkQueue(
+    name="webhook",
+    handler=run_webhook_job,
+    max_size=WEBHOOK_QUEUE_SIZE,
+    workers=WEBHOOK_WORKERS,
+    max_retries=WEBHOOK_MAX_RETRIES,
+    retry_backoff_seconds=WEBHOOK_RETRY_BACKOFF_SECONDS,
+    redis_url=REDIS_URL if WEBHOOK_QUEUE_BACKEND == "redis" else None
+)
+
+async def queue_recheck(post: PostContent):
+    """Queue a post answered in degraded mode for a full LLM re-check once the load drops"""
     try:
-        # Create post content object
-        post_content = PostContent(
-            post_id=payload.post_id,
-            user_id=payload.user_id,
-            peer_id=payload.peer_id,
-            content=payload.content,
-            room_id=payload.room_id,
-            thread_id=payload.thread_id
-        )
-        
-        # Moderate the content
-        result = await moderate_content(post_content)
-        
-        if result.flagged:
-            logger.info(f"Webhook moderation flagged post {payload.post_id}: {result.violation_type}")
-            
-            # In a real implementation, you would create the flag in Discourse
-            # For now, we'll just log it
-            await notify_discourse_of_flag(payload.post_id, result)
-        
-    except Exception as e:
-        logger.error(f"Background webhook processing error: {str(e)}")
+        await recheck_queue.enqueue({"post": post.model_dump()})
+    except QueueFullError as e:
+        MODERATION_RECHECKS.labels("dropped").inc()
+        logger.warning(f"Re-check of degraded verdict for post {post.post_id} dropped: {str(e)}")
+
+async def run_recheck_job(job: dict):
+    """
+    Queue handler for re-checks: wait until the worker is out of degraded mode, then
+    run the classifier and LLM stages (raises so the queue can retry).
+    
+    The full verdict lands in the result cache and the edit segments, so the
+    ai-moderation plugin, which asks again after a degraded answer, gets it from
+    there. When the flag outbox owns flagging, a flagged verdict is sent from here.
+    Degraded answers are never flags, so there is nothing to take back when the
+    re-check finds the post clean.
+    """
+    await overload_detector.wait_until_normal()
+    post = PostContent(**job["post"])
+    
+    with request_class(BACKGROUND, "recheck"):
+        try:
+            # The regex and near-duplicate stages already ran on the degraded path
+            result = await review_content(post.content, post.post_id)
+        except Exception:
+            MODERATION_RECHECKS.labels("failed").inc()
+            raise
+    await remember_segments(post, result)
+    
+    MODERATION_RECHECKS.labels("flagged" if result.flagged else "clean").inc()
+    if result.flagged:
+        logger.info(f"Re-check flagged post {post.post_id}: {result.violation_type}")
+        await notify_discourse_of_flag(post.post_id, result)
+
+recheck_queue = WorkQueue(
+    name="recheck",
+    handler=run_recheck_job,
+    max_size=RECHECK_QUEUE_SIZE,
+    workers=RECHECK_WORKERS,
+    max_retries=WEBHOOK_MAX_RETRIES,
+    retry_backoff_seconds=WEBHOOK_RETRY_BACKOFF_SECONDS,
+    redis_url=REDIS_URL if WEBHOOK_QUEUE_BACKEND == "redis" else None
+)
 
 async def notify_discourse_of_flag(post_id: int, result: ModerationResult):
-    """Notify Discourse of AI flag (placeholder for webhook back to Discourse)"""
+    """Queue an AI flag for delivery to Discourse (the outbox retries and dead-letters it)"""
     try:
-        # This would be a webhook call back to Discourse to create the flag
-        logger.info(f"Would notify Discourse of flag for post {post_id}: {result.violation_type}")
+        if not flag_outbox.started:
+            # The ai-moderation plugin owns flagging (or the Discourse API is not configured)
+            logger.info(f"Flag outbox disabled, not flagging post {post_id}: {result.violation_type}")
+            return
+        flag_outbox.enqueue(post_id, result.violation_type, result.severity, result.reason)
         
     except Exception as e:
         logger.error(f"Error notifying Discourse of flag: {str(e)}")
 
+@app.get("/flags/dead-letters")
+async def list_flag_dead_letters(limit: int = 100):
+    """
+    AI flags that could not be delivered to Discourse, most recent first
+    """
+    return await flag_outbox.dead_letters(limit)
+
+@app.post("/flags/dead-letters/retry")
+async def retry_flag_dead_letters():
+    """
+    Queue every dead-lettered AI flag for delivery again
+    """
+    if not flag_outbox.started:
+        raise HTTPException(status_code=503, detail="Flag outbox disabled (FLAG_OUTBOX_ENABLED) or Discourse API not configured")
+    return {"requeued": await flag_outbox.retry_dead_letters()}
+
 # Helper functions
 def check_basic_violations(content: str) -> Optional[dict]:
     """Basic regex-based violation checking"""
-    import re
-    
-    # Solicitation patterns
-    solicitation_patterns = [
-        r"connect you with",
-        r"business opportunity",
-        r"let me introduce you to",
-        r"sales pitch",
-        r"promotional offer",
-        r"investment opportunity",
-        r"get rich quick",
-        r"make money fast"
-    ]
-    
-    # PII patterns
-    pii_patterns = [
-        r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',  # Email
-        r'\b\d{3}[-.]?\d{3}[-.]?\d{4}\b',  # Phone
-        r'\b\d{3}-\d{2}-\d{4}\b',  # SSN
-        r'\b\d{5}[-.]?\d{4}\b',  # ZIP+4
-    ]
-    
-    # Harassment patterns
-    harassment_patterns = [
-        r"you're an idiot",
-        r"you're all stupid",
-        r"this is worthless",
-        r"shut up",
-        r"you're incompetent",
-        r"this is garbage"
-    ]
-    
-    # Confidential information patterns
-    confidential_patterns = [
-        r"confidential",
-        r"internal only",
-        r"not for public",
-        r"company secret",
-        r"proprietary information"
-    ]
-    
-    content_lower = content.lower()
-    
-    # Check solicitation
-    for pattern in solicitation_patterns:
-        if re.search(pattern, content_lower):
-            return {
-                "type": "solicitation",
-                "severity": 3,
-                "reason": "Contains promotional or sales content"
-            }
+    return rule_engine.check(content)
+
+async def prefilter_content(content: str) -> Optional[ModerationResult]:
+    """Result for empty content or regex violations, None if the post needs AI review"""
+    if not content.strip():
+        return ModerationResult(flagged=False)
     
-    # Check PII
-    for pattern in pii_patterns:
-        if re.search(pattern, content):
-            return {
-                "type": "pii",
-                "severity": 4,
-                "reason": "Contains personal identifiable information"
-            }
+    with time_stage("check_basic_violations"):
+        if cpu_pool.offloads(content):
+            basic_violations = await cpu_pool.run("check_basic_violations", check_rules, content, check_basic_violations)
+        else:
+            basic_violations = check_basic_violations(content)
+    if basic_violations:
+        return ModerationResult(
+            flagged=True,
+            violation_type=basic_violations["type"],
+            severity=basic_violations["severity"],
+            reason=basic_violations["reason"],
+            confidence=0.9
+        )
     
-    # Check harassment
-    for pattern in harassment_patterns:
-        if re.search(pattern, content_lower):
-            return {
-                "type": "harassment",
-                "severity": 5,
-                "reason": "Contains hostile or inappropriate language"
-            }
+    return None
+
+def check_near_duplicates(post: PostContent) -> Optional[ModerationResult]:
+    """Spam verdict if the post repeats recent posts, None otherwise"""
+    if not NEAR_DUP_ENABLED:
+        return None
     
-    # Check confidential
-    for pattern in confidential_patterns:
-        if re.search(pattern, content_lower):
-            return {
-                "type": "confidential",
-                "severity": 4,
-                "reason": "Contains confidential or proprietary information"
-            }
+    with time_stage("near_duplicate"):
+        matches = near_duplicate_index.check_and_add(post.post_id, post.user_id, post.content)
+    if not matches:
+        return None
     
-    return None
+    if NEAR_DUP_SAME_USER_REPEATS and matches["same_user"] >= NEAR_DUP_SAME_USER_REPEATS:
+        NEAR_DUPLICATE_DETECTIONS.labels("same_user").inc()
+        reason = f"Near-duplicate of {matches['same_user']} recent post(s) by the same user"
+    elif NEAR_DUP_OTHER_USERS and matches["other_users"] >= NEAR_DUP_OTHER_USERS:
+        NEAR_DUPLICATE_DETECTIONS.labels("other_users").inc()
+        reason = f"Templated content also posted by {matches['other_users']} other user(s)"
+    else:
+        return None
+    
+    return ModerationResult(
+        flagged=True,
+        violation_type="spam",
+        severity=VIOLATION_SEVERITIES["spam"],
+        reason=reason,
+        confidence=0.85
+    )
 
-async def moderate_with_ai(content: str) -> ModerationResult:
-    """AI-based moderation using OpenAI"""
+def save_near_duplicate_index():
+    """Write the near-duplicate index snapshot"""
     try:
-        import openai
-        
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        
-        prompt = f"""
-        Analyze this post for violations. Return JSON with:
-        - flagged: boolean
-        - violation_type: string (solicitation, pii, harassment, confidential, off_topic, spam, identity_leak, inappropriate)
-        - severity: integer (1-5, 5 being most severe)
-        - reason: string
-        - confidence: float (0-1)
-        
-        Post content: "{content}"
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a content moderator for a professional executive forum. Be strict but fair."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.1
+        near_duplicate_index.save(NEAR_DUP_INDEX_PATH)
+    except Exception as e:
+        logger.error(f"Failed to save near-duplicate index: {str(e)}")
+
+async def snapshot_near_duplicate_index():
+    """Periodically snapshot the near-duplicate index so restarts keep recent history"""
+    while True:
+        await asyncio.sleep(NEAR_DUP_SNAPSHOT_SECONDS)
+        save_near_duplicate_index()
+
+async def predict_locally(content: str) -> Optional[Tuple[str, float]]:
+    """Local classifier (label, probability), None if no model is loaded"""
+    if moderation_classifier is None:
+        return None
+    
+    with time_stage("local_classifier"):
+        if cpu_pool.offloads(content):
+            # None if the pool processes could not load the model
+            return await cpu_pool.run("local_classifier", classify, content, moderation_classifier.predict)
+        return moderation_classifier.predict(content)
+
+async def classify_locally(content: str) -> Optional[ModerationResult]:
+    """Local classifier verdict if it is confident, None to escalate to the LLM"""
+    return local_verdict(await predict_locally(content))
+
+def local_verdict(prediction: Optional[Tuple[str, float]]) -> Optional[ModerationResult]:
+    """Verdict for a confident prediction, None to escalate to the LLM"""
+    if prediction is None:
+        return None
+    label, probability = prediction
+    
+    if not is_confident(label, probability, CLASSIFIER_CLEAN_THRESHOLD, CLASSIFIER_VIOLATION_THRESHOLD):
+        LOCAL_CLASSIFIER_DECISIONS.labels("escalated").inc()
+        return None
+    
+    if label == CLEAN_LABEL:
+        LOCAL_CLASSIFIER_DECISIONS.labels("clean").inc()
+        return ModerationResult(flagged=False, confidence=round(probability, 4))
+    
+    LOCAL_CLASSIFIER_DECISIONS.labels("violation").inc()
+    return ModerationResult(
+        flagged=True,
+        violation_type=label,
+        severity=VIOLATION_SEVERITIES.get(label, 3),
+        reason=f"Local classifier: {VIOLATION_TYPES.get(label, label)}",
+        confidence=round(probability, 4)
+    )
+
+async def degraded_review(post: PostContent) -> ModerationResult:
+    """
+    Moderation without the LLM, for overload (the regex pre-filter has already run).
+    
+    Near-duplicates, cached LLM verdicts and confident classifier verdicts are the
+    same answers the full pipeline would give. Anything else is a post the normal
+    path would send to the LLM: it is answered unflagged, marked degraded, with
+    the classifier's confidence that it is clean (a coin flip without a classifier)
+    scaled by DEGRADED_CONFIDENCE_FACTOR, and queued for an LLM re-check that
+    raises the flag if there is one. A guess is never a flag. Degraded verdicts
+    are never cached or stored for edits.
+    """
+    duplicate_result = check_near_duplicates(post)
+    if duplicate_result:
+        return duplicate_result
+    
+    cached = await cached_moderation(post.content)
+    if cached is not None:
+        return cached
+    
+    prediction = await predict_locally(post.content)
+    result = local_verdict(prediction)
+    if result:
+        await remember_segments(post, result)
+        return result
+    
+    if prediction is not None:
+        label, probability = prediction
+        DEGRADED_MODERATIONS.labels("classifier").inc()
+        clean_probability = probability if label == CLEAN_LABEL else 1 - probability
+    else:
+        DEGRADED_MODERATIONS.labels("regex").inc()
+        clean_probability = REGEX_ONLY_CONFIDENCE
+    
+    await queue_recheck(post)
+    return ModerationResult(
+        flagged=False,
+        confidence=round(clean_probability * DEGRADED_CONFIDENCE_FACTOR, 4),
+        degraded=True
+    )
+
+async def moderate_post(post: PostContent) -> ModerationResult:
+    """Full moderation pipeline (raises if AI moderation fails)"""
+    prefiltered = await prefilter_content(post.content)
+    if prefiltered:
+        return prefiltered
+    
+    return await review_post(post)
+
+async def review_post(post: PostContent) -> ModerationResult:
+    """Moderation stages after the regex pre-filter (raises if AI moderation fails)"""
+    # Repeated or templated posts are spam regardless of what the LLM thinks
+    duplicate_result = check_near_duplicates(post)
+    if duplicate_result:
+        return duplicate_result
+    
+    return await review_content(post.content, post.post_id)
+
+async def review_content(content: str, post_id: int) -> ModerationResult:
+    """Local classifier, then the LLM (raises if AI moderation fails)"""
+    # Confident local verdicts skip the LLM
+    local_result = await classify_locally(content)
+    if local_result:
+        return local_result
+    
+    if OPENAI_API_KEY:
+        return await moderate_with_cache(content, post_id)
+    
+    # Fallback to basic checks only
+    return ModerationResult(flagged=False)
+
+async def moderate_edit(post: PostContent) -> ModerationResult:
+    """
+    Re-moderate an edited post, reviewing only new or changed paragraphs
+    (raises if AI moderation fails)
+    """
+    previous = await post_segments.get(str(post.post_id)) if EDIT_SEGMENTS_ENABLED else None
+    if previous is None or previous.get("version") != segments_version():
+        EDIT_REMODERATIONS.labels("full").inc()
+        result = await moderate_post(post)
+        await remember_segments(post, result)
+        return result
+    
+    with time_stage("diff_segments"):
+        diff = diff_segments(previous["segments"], split_segments(post.content))
+    previous_result = stored_moderation_result(previous["result"])
+    
+    # The regex pre-filter and near-duplicate check are cheap, so they see the whole post
+    result = await prefilter_content(post.content) or check_near_duplicates(post)
+    if result:
+        path = "prefilter"
+    elif previous_result.flagged and diff["removed"]:
+        # A flag cannot be pinned to a paragraph, and the removed text may have been the violation
+        path = "full"
+        result = await review_content(post.content, post.post_id)
+    elif not diff["changed"]:
+        path = "reused"
+        result = previous_result
+    else:
+        path = "partial"
+        changed = "\n\n".join(diff["changed"])
+        result = most_severe(previous_result, await review_content(changed, post.post_id))
+        EDIT_CHARACTERS.labels("reviewed").inc(len(changed))
+        EDIT_CHARACTERS.labels("skipped").inc(max(0, len(post.content) - len(changed)))
+    
+    EDIT_REMODERATIONS.labels(path).inc()
+    await remember_segments(post, result, diff["hashes"])
+    return result
+
+def most_severe(first: ModerationResult, second: ModerationResult) -> ModerationResult:
+    """The more severe of two verdicts"""
+    if not second.flagged:
+        return first
+    if not first.flagged:
+        return second
+    return second if (second.severity or 0) > (first.severity or 0) else first
+
+def segments_version() -> str:
+    """Stored segment verdicts are only reused under the same model and prompt"""
+    return f"{MODERATION_MODEL}:{MODERATION_PROMPT_VERSION}"
+
+async def remember_segments(post: PostContent, result: ModerationResult, hashes: Optional[List[str]] = None):
+    """Store the post's paragraph hashes and verdict for later edits"""
+    if not EDIT_SEGMENTS_ENABLED:
+        return
+    if hashes is None:
+        hashes = [segment_hash(segment) for segment in split_segments(post.content)]
+    await post_segments.set(str(post.post_id), {
+        "version": segments_version(),
+        "segments": hashes,
+        "result": result.model_dump()
+    })
+
+async def moderate_with_cache(content: str, post_id: Optional[int] = None) -> ModerationResult:
+    """AI moderation behind the result cache (raises on failure, failures are not cached)"""
+    with time_stage("count_tokens"):
+        content_tokens = token_counter.count(content)
+    if content_tokens > MODERATION_CHUNK_TOKENS:
+        return await moderate_in_chunks(content, post_id)
+    return await moderate_cached(content, post_id)
+
+def stored_moderation_result(data: dict) -> ModerationResult:
+    """Rebuild a result this service validated and stored itself, without validating it again"""
+    tokens = data.get("tokens")
+    return ModerationResult.model_construct(**{
+        **data,
+        "tokens": TokenUsage.model_construct(**tokens) if tokens is not None else None
+    })
+
+async def moderate_cached(content: str, post_id: Optional[int] = None) -> ModerationResult:
+    """One LLM moderation call behind the result cache and in-flight dedup"""
+    cache_key = moderation_cache.make_key(content, MODERATION_MODEL, MODERATION_PROMPT_VERSION)
+    with span("cache_get"):
+        cached = await moderation_cache.get(cache_key)
+    if cached is not None:
+        return stored_moderation_result(cached)
+    
+    async def cached_result() -> Optional[ModerationResult]:
+        cached = await moderation_cache.get(cache_key)
+        return stored_moderation_result(cached) if cached is not None else None
+    
+    # Identical requests for the same post share one upstream call (across workers with Redis)
+    return await moderation_flights.do(
+        f"{post_id}:{cache_key}",
+        lambda: run_ai_moderation(content, cache_key),
+        cached_result
+    )
+
+async def run_ai_moderation(content: str, cache_key: str) -> ModerationResult:
+    """Call the LLM and store the verdict in the result cache"""
+    with time_stage("moderate_with_ai"):
+        if MODERATION_MICROBATCH_ENABLED:
+            ai_result = await moderation_batcher.submit(content)
+        else:
+            ai_result = await moderate_with_ai(content)
+    await moderation_cache.set(cache_key, ai_result.model_dump(exclude={"tokens"}))
+    return ai_result
+
+async def cached_moderation(content: str) -> Optional[ModerationResult]:
+    """
+    The LLM verdict the cache already holds for a post, without calling the LLM.
+    Long posts are cached per chunk, so every chunk the full pipeline would
+    send must be cached; the most severe chunk verdict wins. None if any is missing.
+    """
+    with time_stage("count_tokens"):
+        content_tokens = token_counter.count(content)
+    chunks = budget_chunks(content)[0] if content_tokens > MODERATION_CHUNK_TOKENS else [content]
+    
+    keys = [moderation_cache.make_key(chunk, MODERATION_MODEL, MODERATION_PROMPT_VERSION) for chunk in chunks]
+    with span("cache_get"):
+        cached = await asyncio.gather(*(moderation_cache.get(key) for key in keys))
+    if any(entry is None for entry in cached):
+        return None
+    
+    merged = stored_moderation_result(cached[0])
+    for entry in cached[1:]:
+        merged = most_severe(merged, stored_moderation_result(entry))
+    return merged
+
+def budget_chunks(content: str) -> Tuple[List[str], int]:
+    """The overlapping chunks of a long post that fit the token budget, and how many did not"""
+    with time_stage("split_chunks"):
+        chunks = token_counter.split(content, MODERATION_CHUNK_TOKENS, MODERATION_CHUNK_OVERLAP_TOKENS)
+    
+    # Chunks beyond the budget are not sent; the first is always sent
+    selected, spent = [], 0
+    for chunk, chunk_tokens in chunks:
+        if selected and spent + chunk_tokens > MODERATION_TOKEN_BUDGET:
+            break
+        selected.append(chunk)
+        spent += chunk_tokens
+    return selected, len(chunks) - len(selected)
+
+async def moderate_in_chunks(content: str, post_id: Optional[int] = None) -> ModerationResult:
+    """
+    Moderate a long post as overlapping chunks, concurrently, keeping the most
+    severe verdict (raises if any chunk fails)
+    """
+    selected, skipped = budget_chunks(content)
+    chunks = len(selected) + skipped
+    
+    MODERATION_CHUNKS.labels("moderated").inc(len(selected))
+    if skipped:
+        MODERATION_CHUNKS.labels("skipped").inc(skipped)
+        logger.warning(
+            f"Post {post_id}: token budget {MODERATION_TOKEN_BUDGET} covers {len(selected)} of {chunks} chunks"
         )
-        
+    
+    results = await asyncio.gather(*(moderate_cached(chunk, post_id) for chunk in selected))
+    
+    merged = results[0]
+    for result in results[1:]:
+        merged = most_severe(merged, result)
+    return merged.model_copy(update={"tokens": TokenUsage(
+        prompt_tokens=sum(result.tokens.prompt_tokens for result in results if result.tokens),
+        completion_tokens=sum(result.tokens.completion_tokens for result in results if result.tokens),
+        chunks=len(selected),
+        chunks_skipped=skipped
+    )})
+
+def token_usage(response, prompt: str, share: int = 1) -> TokenUsage:
+    """Token usage of a completion (estimated without a usage block), split evenly across share results"""
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        prompt_tokens, completion_tokens = usage.prompt_tokens or 0, usage.completion_tokens or 0
+    else:
+        prompt_tokens = token_counter.count(prompt)
+        completion_tokens = token_counter.count(response.choices[0].message.content or "")
+    return TokenUsage(prompt_tokens=prompt_tokens // share, completion_tokens=completion_tokens // share)
+
+async def moderate_with_ai(content: str) -> ModerationResult:
+    """AI-based moderation using OpenAI (raises on upstream or parse errors)"""
+    with time_stage("build_prompt"):
+        messages = MODERATION_PROMPT.messages(content=content)
+        prompt = messages[-1]["content"]
+    
+    response = await llm_client.chat(
+        model=MODERATION_MODEL,
+        messages=messages,
+        temperature=0.1,
+        timeout=MODERATION_TIMEOUT_SECONDS
+    )
+    
+    with span("parse_response"):
         result_text = response.choices[0].message.content
         result = json.loads(result_text)
+        result["tokens"] = token_usage(response, prompt)
         
         return ModerationResult(**result)
-        
-    except Exception as e:
-        logger.error(f"AI moderation error: {str(e)}")
-        return ModerationResult(flagged=False)
+
+async def moderate_batch_with_ai(contents: List[str]) -> List[ModerationResult]:
+    """AI-based moderation of several posts in one completion (raises if the output does not parse)"""
+    with time_stage("build_prompt"):
+        posts = "\n".join(f"[{index}] {json.dumps(content)}" for index, content in enumerate(contents, 1))
+        messages = MODERATION_BATCH_PROMPT.messages(posts=posts)
+        prompt = messages[-1]["content"]
+    
+    response = await llm_client.chat(
+        model=MODERATION_MODEL,
+        messages=messages,
+        temperature=0.1,
+        timeout=MODERATION_TIMEOUT_SECONDS
+    )
+    
+    parsed = json.loads(response.choices[0].message.content)
+    if isinstance(parsed, dict):
+        # Models sometimes wrap the array in an object
+        parsed = next((value for value in parsed.values() if isinstance(value, list)), None)
+    if not isinstance(parsed, list) or len(parsed) != len(contents):
+        raise ValueError(f"Expected a JSON array of {len(contents)} results")
+    
+    tokens = token_usage(response, prompt, share=len(contents))
+    results = {}
+    for position, entry in enumerate(parsed, 1):
+        index = entry.pop("index", position)
+        entry["tokens"] = tokens
+        results[index] = ModerationResult(**entry)
+    
+    return [results[index] for index in range(1, len(contents) + 1)]
+
+moderation_batcher = MicroBatcher(
+    name="moderation",
+    process_batch=moderate_batch_with_ai,
+    process_one=moderate_with_ai,
+    max_batch_size=MODERATION_MICROBATCH_MAX_SIZE,
+    max_wait_ms=MODERATION_MICROBATCH_MAX_WAIT_MS
+)
+
+def build_reply_messages(content: str, room_id: Optional[int]) -> list:
+    """Chat messages for a peer response (the room's prompt prefix is rendered once, at import)"""
+    with time_stage("build_prompt"):
+        return REPLY_PROMPT.messages(room_id, content=content)
 
 async def generate_ai_response(content: str, room_id: Optional[int]) -> dict:
     """Generate AI peer response"""
     try:
-        import openai
-        
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        
-        # Context based on room type
-        room_context = get_room_context(room_id)
-        
-        prompt = f"""
-        You are Peer AI #0000, an AI assistant in a private C-level executive forum.
-        Provide a thoughtful, strategic response that adds value to this discussion.
-        Keep it professional, constructive, and focused on leadership/strategy.
-        
-        Room context: {room_context}
-        Discussion: "{content}"
-        
-        Respond as a helpful peer, not as an AI.
-        """
-        
-        response = client.chat.completions.create(
+        messages = build_reply_messages(content, room_id)
+        response = await llm_client.chat(
             model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are Peer AI #0000, a strategic advisor and peer in an executive forum."},
-                {"role": "user", "content": prompt}
-            ],
+            messages=messages,
             temperature=0.7,
             max_tokens=300
         )
@@ -454,112 +1508,104 @@ async def generate_ai_response(content: str, room_id: Optional[int]) -> dict:
         logger.error(f"AI response generation error: {str(e)}")
         raise
 
-def get_room_context(room_id: Optional[int]) -> str:
-    """Get context based on room type"""
-    room_contexts = {
-        1: "HR & People - Leadership, talent management, organizational culture",
-        2: "Finance & Capital - Financial strategy, fundraising, M&A",
-        3: "Corporate Strategy - Growth planning, competitive dynamics, transformation",
-        4: "Sales & GTM - Go-to-market strategy, customer acquisition",
-        5: "Mergers & Acquisitions - Due diligence, integration, deal strategy",
-        6: "Leadership & Mental Load - Executive challenges, work-life balance"
-    }
-    
-    return room_contexts.get(room_id, "General executive discussion")
+async def stream_ai_response(content: str, room_id: Optional[int]):
+    """Stream an AI peer response as text deltas"""
+    async for delta in llm_client.chat_stream(
+        model="gpt-4",
+        messages=build_reply_messages(content, room_id),
+        temperature=0.7,
+        max_tokens=300
+    ):
+        yield delta
 
-async def analyze_user_verification(verification_data: UserVerificationData) -> dict:
+async def analyze_user_verification(verification_data: UserVerificationData) -> Tuple[dict, bool]:
     """
     Analyze user verification data using AI
+    
+    Returns the result and whether it came from fallback_verification_analysis.
     """
+    user_info = verification_data.user_info
     try:
-        user_info = verification_data.user_info
-        criteria = verification_data.criteria
-        
-        # Build analysis prompt
-        prompt = build_verification_prompt(user_info, criteria)
-        
-        # Call OpenAI for analysis
-        response = await call_openai_for_verification(prompt)
-        
-        # Parse and structure the response
-        result = parse_verification_response(response, user_info)
-        
-        return result
+        return await verify_with_cache(verification_data), False
         
     except Exception as e:
         logger.error(f"Error in Vera's user verification analysis: {str(e)}")
-        return fallback_verification_analysis(user_info)
-
-def build_verification_prompt(user_info: dict, criteria: List[dict]) -> str:
-    """Build the verification analysis prompt"""
-    
-    prompt = f"""
-You are Vera, an AI verification specialist for Circle of Peers, a private forum for C-level executives. Your role is to thoroughly analyze applications and provide detailed assessments with confidence scores.
-
-**User Information:**
-- Name: {user_info.get('name', 'Not provided')}
-- Email: {user_info.get('email', 'Not provided')}
-- Company: {user_info.get('company', 'Not provided')}
-- Title: {user_info.get('title', 'Not provided')}
-- LinkedIn: {user_info.get('linkedin_url', 'Not provided')}
-- Bio: {user_info.get('bio', 'Not provided')}
-- Location: {user_info.get('location', 'Not provided')}
-
-**Verification Criteria:**
-"""
-    
-    for criterion in criteria:
-        prompt += f"- {criterion['name']}: {criterion['description']} (Weight: {criterion['weight']})\n"
-    
-    prompt += """
-**Analysis Instructions:**
-1. Evaluate if this person appears to be a legitimate C-level executive or equivalent senior leader
-2. Check for consistency in professional information
-3. Identify any risk factors or red flags
-4. Assess the overall credibility and suitability for the platform
-
-**Response Format:**
-Provide your analysis in the following JSON format:
-{
-    "recommendation": "approve|reject|review_required",
-    "confidence_score": 0.0-1.0,
-    "risk_factors": [
-        {
-            "name": "Risk factor name",
-            "description": "Description of the risk",
-            "severity": "high|medium|low"
-        }
-    ],
-    "analysis": {
-        "executive_role_verified": true/false,
-        "professional_credibility": "high|medium|low",
-        "risk_level": "high|medium|low",
-        "notes": "Additional analysis notes"
-    }
-}
+        result = fallback_verification_analysis(user_info)
+        if isinstance(e, ValueError):
+            result['analysis']['notes'] = str(e)
+        return result, True
+
+def normalize_for_key(value):
+    """Case- and whitespace-insensitive copy of JSON-like data for cache keys"""
+    if isinstance(value, dict):
+        return {str(key).strip().casefold(): normalize_for_key(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [normalize_for_key(item) for item in value]
+    if isinstance(value, str):
+        return normalize_content(value).casefold()
+    return value
+
+def verification_cache_key(verification_data: UserVerificationData) -> str:
+    """Cache key for the inputs Vera's prompt is built from (user_info and criteria)"""
+    normalized = normalize_for_key({
+        "user_info": verification_data.user_info,
+        "criteria": verification_data.criteria
+    })
+    return verification_cache.make_key(
+        json.dumps(normalized, sort_keys=True, default=str),
+        VERIFICATION_MODEL,
+        VERIFICATION_PROMPT_VERSION
+    )
+
+async def verify_with_cache(verification_data: UserVerificationData) -> dict:
+    """Vera's analysis behind the verification cache (raises on failure, failures are not cached)"""
+    cache_key = verification_cache_key(verification_data)
+    with span("cache_get"):
+        cached = await verification_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    # Identical applicants in flight share one upstream call
+    return await verification_flights.do(
+        cache_key,
+        lambda: run_vera_verification(verification_data, cache_key),
+        lambda: verification_cache.get(cache_key)
+    )
 
-**Important Guidelines:**
-- Only approve if there's strong evidence of C-level or equivalent executive role
-- Reject if there are significant red flags or inconsistencies
-- Request review if the case is unclear or borderline
-- Be conservative in approvals to maintain platform quality
-"""
+async def run_vera_verification(verification_data: UserVerificationData, cache_key: str) -> dict:
+    """Build the prompt, call Vera and store the parsed result in the verification cache"""
+    user_info = verification_data.user_info
+    
+    # Build analysis prompt
+    with time_stage("build_prompt"):
+        messages = build_verification_messages(user_info, verification_data.criteria)
+    
+    # Call OpenAI for analysis
+    response = await call_openai_for_verification(messages)
+    
+    # Parse and structure the response
+    with span("parse_response"):
+        result = parse_verification_response(response, user_info)
     
-    return prompt
+    await verification_cache.set(cache_key, result)
+    return result
+
+def build_verification_messages(user_info: dict, criteria: List[dict]) -> list:
+    """Chat messages for the verification analysis (applicant details after the fixed instructions)"""
+    return VERIFICATION_PROMPT.messages(
+        **{field: user_info.get(field, 'Not provided') for field in VERIFICATION_USER_FIELDS},
+        criteria="".join(
+            f"- {criterion['name']}: {criterion['description']} (Weight: {criterion['weight']})\n"
+            for criterion in criteria
+        )
+    )
 
-async def call_openai_for_verification(prompt: str) -> str:
+async def call_openai_for_verification(messages: list) -> str:
     """Call OpenAI API for verification analysis"""
     try:
-        import openai
-        
-        client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
-        
-        response = await client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are Vera, a professional verification specialist for Circle of Peers. You provide accurate, conservative assessments with detailed reasoning and confidence scores."},
-                {"role": "user", "content": prompt}
-            ],
+        response = await llm_client.chat(
+            model=VERIFICATION_MODEL,
+            messages=messages,
             temperature=0.1,
             max_tokens=1000
         )
@@ -570,21 +1616,19 @@ async def call_openai_for_verification(prompt: str) -> str:
         logger.error(f"Vera OpenAI API error: {str(e)}")
         raise
 
+# First "{" to last "}" of a reply, which may wrap its JSON in prose
+JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
 def parse_verification_response(response: str, user_info: dict) -> dict:
     """Parse the AI verification response"""
     try:
-        # Try to extract JSON from response
-        import re
-        
         # Find JSON in the response
-        json_match = re.search(r'\{.*\}', response, re.DOTALL)
+        json_match = JSON_OBJECT_RE.search(response)
         if json_match:
             result = json.loads(json_match.group())
         else:
-            # Fallback parsing
-            result = fallback_verification_analysis(user_info)
-            result['analysis']['notes'] = f"Failed to parse Vera's response: {response[:200]}"
-            return result
+            # Not cached: raising sends the caller to fallback_verification_analysis
+            raise ValueError(f"Failed to parse Vera's response: {response[:200]}")
         
         # Validate and structure the response
         return {
@@ -596,7 +1640,7 @@ def parse_verification_response(response: str, user_info: dict) -> dict:
         
     except Exception as e:
         logger.error(f"Error parsing Vera's verification response: {str(e)}")
-        return fallback_verification_analysis(user_info)
+        raise
 
 def fallback_verification_analysis(user_info: dict) -> dict:
     """Fallback verification analysis when Vera is unavailable"""
@@ -663,5 +1707,11 @@ def fallback_verification_analysis(user_info: dict) -> dict:
     }
 
 if __name__ == "__main__":
+    import shutil
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # Metric files left by a previous run would be counted as live workers' values
+    if METRICS_MULTIPROCESS:
+        shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+        os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+    # An import string lets uvicorn start WEB_CONCURRENCY worker processes
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=WEB_CONCURRENCY) 
\ No newline at end of file
@@ -0,0 +1,306 @@
+"""
+Prometheus metrics for the AI service, scraped from /metrics
+(see monitoring/prometheus.yml).
+
+Every process keeps its own metric values. With several uvicorn workers
+(WEB_CONCURRENCY > 1) a scrape reaches one of them at random, so
+PROMETHEUS_MULTIPROC_DIR must point at a directory shared by the workers
+and emptied before they start (the Docker image does this): each worker
+then writes its values to files there and /metrics aggregates all of
+them. Gauges say how workers combine (multiprocess_mode): summed, the
+maximum, or one series per worker (pid label). Values read from
+components at scrape time (queues, caches, the near-duplicate index) are
+also refreshed in every worker every few seconds in that mode.
+"""
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from prometheus_client.core import REGISTRY
+
+from tracing import record_span
+
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+# Stage timings span from microsecond regex scans to multi-second LLM calls
+STAGE_BUCKETS = (
+    0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+UPSTREAM_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0)
+
+EVENT_LOOP_LAG = Histogram(
+    "cop_ai_event_loop_lag_seconds",
+    "How late the event loop woke a sleeping task (time the loop was blocked)",
+    buckets=STAGE_BUCKETS
+)
+STARTUP_SECONDS = Gauge(
+    "cop_ai_startup_seconds",
+    "Duration of each startup step, plus imports and cold_start (process start to ready)",
+    ["phase"],
+    multiprocess_mode="liveall"
+)
+HTTP_REQUESTS = Counter(
+    "cop_ai_http_requests_total",
+    "HTTP requests by endpoint and status",
+    ["method", "endpoint", "status"]
+)
+HTTP_LATENCY = Histogram(
+    "cop_ai_http_request_duration_seconds",
+    "HTTP request latency by endpoint",
+    ["method", "endpoint"]
+)
+STAGE_LATENCY = Histogram(
+    "cop_ai_stage_duration_seconds",
+    "Time spent in each moderation pipeline stage",
+    ["stage"],
+    buckets=STAGE_BUCKETS
+)
+OPENAI_LATENCY = Histogram(
+    "cop_ai_openai_request_duration_seconds",
+    "OpenAI chat completion latency by model",
+    ["model"],
+    buckets=UPSTREAM_BUCKETS
+)
+OPENAI_FIRST_TOKEN_LATENCY = Histogram(
+    "cop_ai_openai_first_token_seconds",
+    "Time to the first streamed token by model",
+    ["model"],
+    buckets=UPSTREAM_BUCKETS
+)
+OPENAI_ERRORS = Counter(
+    "cop_ai_openai_errors_total",
+    "OpenAI chat completion errors by model and exception type",
+    ["model", "error"]
+)
+OPENAI_TOKENS = Counter(
+    "cop_ai_openai_tokens_total",
+    "OpenAI tokens used by model and kind (prompt or completion)",
+    ["model", "kind"]
+)
+CIRCUIT_STATE = Gauge(
+    "cop_ai_circuit_state",
+    "Circuit breaker state by circuit (0 closed, 1 half-open, 2 open; the worst worker's)",
+    ["circuit"],
+    multiprocess_mode="livemax"
+)
+CIRCUIT_REJECTIONS = Counter(
+    "cop_ai_circuit_rejections_total",
+    "Calls rejected without reaching upstream because the circuit was open",
+    ["circuit"]
+)
+UPSTREAM_QUEUE_WAIT = Histogram(
+    "cop_ai_upstream_queue_wait_seconds",
+    "Time upstream calls waited for a scheduler slot by model and priority",
+    ["model", "priority"],
+    buckets=STAGE_BUCKETS
+)
+UPSTREAM_QUEUE_DEPTH = Gauge(
+    "cop_ai_upstream_queue_depth",
+    "Upstream calls waiting for a scheduler slot by model and priority",
+    ["model", "priority"],
+    multiprocess_mode="livesum"
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "cop_ai_upstream_in_flight",
+    "Upstream calls holding a scheduler slot by model",
+    ["model"],
+    multiprocess_mode="livesum"
+)
+UPSTREAM_TOKENS_AVAILABLE = Gauge(
+    "cop_ai_upstream_tokens_available",
+    "Tokens left in the per-minute budget by model",
+    ["model"],
+    multiprocess_mode="livesum"
+)
+CPU_POOL_TASKS = Counter(
+    "cop_ai_cpu_pool_tasks_total",
+    "CPU-bound stages of large posts run in the process pool, or inline because the pool broke",
+    ["stage", "outcome"]
+)
+MODERATION_CHUNKS = Counter(
+    "cop_ai_moderation_chunks_total",
+    "Chunks of long posts moderated, or skipped because the token budget ran out",
+    ["kind"]
+)
+SINGLEFLIGHT_CALLS = Counter(
+    "cop_ai_singleflight_calls_total",
+    "Coalesced calls by flight and role (leader made the upstream call, shared reused it, remote waited on another process)",
+    ["flight", "role"]
+)
+REPLY_STREAMS = Counter(
+    "cop_ai_reply_streams_total",
+    "Streamed peer replies by outcome (completed, cancelled or error)",
+    ["outcome"]
+)
+MICROBATCH_SIZE = Histogram(
+    "cop_ai_microbatch_size",
+    "Items per micro-batched upstream call",
+    ["batcher"],
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+MICROBATCH_FALLBACKS = Counter(
+    "cop_ai_microbatch_fallbacks_total",
+    "Micro-batches that failed and fell back to single calls",
+    ["batcher"]
+)
+LOCAL_CLASSIFIER_DECISIONS = Counter(
+    "cop_ai_local_classifier_decisions_total",
+    "Local classifier routing decisions (clean, violation, escalated)",
+    ["outcome"]
+)
+EDIT_REMODERATIONS = Counter(
+    "cop_ai_edit_remoderations_total",
+    "Edited posts by re-moderation path (reused, partial, full or prefilter)",
+    ["path"]
+)
+EDIT_CHARACTERS = Counter(
+    "cop_ai_edit_characters_total",
+    "Characters of edited posts sent to review versus skipped as unchanged",
+    ["kind"]
+)
+NEAR_DUPLICATE_DETECTIONS = Counter(
+    "cop_ai_near_duplicate_detections_total",
+    "Posts flagged as spam by the near-duplicate index",
+    ["kind"]
+)
+NEAR_DUPLICATE_INDEX_SIZE = Gauge(
+    "cop_ai_near_duplicate_index_entries",
+    "Posts held in the near-duplicate index (summed over workers, each has its own)",
+    multiprocess_mode="livesum"
+)
+FLAG_DELIVERIES = Counter(
+    "cop_ai_flag_deliveries_total",
+    "AI flags sent to Discourse by outcome (delivered, duplicate, retried or dead_letter)",
+    ["outcome"]
+)
+FLAG_BATCH_SIZE = Histogram(
+    "cop_ai_flag_batch_size",
+    "Flags per outbox batch sent to Discourse",
+    buckets=(1, 2, 5, 10, 20, 50, 100)
+)
+OVERLOAD_DEGRADED = Gauge(
+    "cop_ai_overload_degraded",
+    "Workers overloaded and answering /moderate in degraded mode (1 per worker)",
+    multiprocess_mode="livesum"
+)
+OVERLOAD_EPISODES = Counter(
+    "cop_ai_overload_episodes_total",
+    "Switches into degraded mode by the signal that crossed its limit (event_loop_lag, in_flight or queue_wait)",
+    ["signal"]
+)
+DEGRADED_MODERATIONS = Counter(
+    "cop_ai_degraded_moderations_total",
+    "Posts answered without the LLM under overload, by source (classifier or regex)",
+    ["source"]
+)
+MODERATION_RECHECKS = Counter(
+    "cop_ai_moderation_rechecks_total",
+    "Full LLM re-checks of degraded answers by outcome (clean, flagged, failed or dropped)",
+    ["outcome"]
+)
+QUEUE_DEPTH = Gauge(
+    "cop_ai_queue_depth",
+    "Jobs waiting in a work queue (per worker: its own queue, or the shared Redis list)",
+    ["queue"],
+    multiprocess_mode="liveall"
+)
+QUEUE_IN_FLIGHT = Gauge(
+    "cop_ai_queue_in_flight",
+    "Jobs currently being processed by a work queue",
+    ["queue"],
+    multiprocess_mode="livesum"
+)
+CACHE_LOOKUPS = Counter(
+    "cop_ai_cache_lookups_total",
+    "Result cache lookups by outcome",
+    ["cache", "result"]
+)
+CACHE_HIT_RATIO = Gauge(
+    "cop_ai_cache_hit_ratio",
+    "Result cache hit ratio since the worker started",
+    ["cache"],
+    multiprocess_mode="liveall"
+)
+CACHE_ENTRIES = Gauge(
+    "cop_ai_cache_entries",
+    "Entries in the in-process cache tier (summed over workers)",
+    ["cache"],
+    multiprocess_mode="livesum"
+)
+
+
+@contextmanager
+def time_stage(stage: str):
+    """Record the duration of a pipeline stage (and a span, if the request is traced)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_LATENCY.labels(stage).observe(duration)
+        record_span(stage, start, duration)
+
+
+def record_openai_usage(model: str, usage):
+    """Count prompt and completion tokens from a completion's usage block"""
+    if usage is None:
+        return
+    OPENAI_TOKENS.labels(model, "prompt").inc(usage.prompt_tokens or 0)
+    OPENAI_TOKENS.labels(model, "completion").inc(usage.completion_tokens or 0)
+
+
+class CacheMetrics:
+    """Copies ResultCache counters into metrics; call update() before a scrape"""
+
+    def __init__(self):
+        self.caches: Dict[str, object] = {}
+        self._counted: Dict[str, tuple] = {}
+
+    def register(self, name: str, cache):
+        self.caches[name] = cache
+
+    def update(self):
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            hits, misses = self._counted.get(name, (0, 0))
+            CACHE_LOOKUPS.labels(name, "hit").inc(stats["hits"] - hits)
+            CACHE_LOOKUPS.labels(name, "miss").inc(stats["misses"] - misses)
+            self._counted[name] = (stats["hits"], stats["misses"])
+            CACHE_HIT_RATIO.labels(name).set(stats["hit_ratio"])
+            CACHE_ENTRIES.labels(name).set(stats["entries"])
+
+
+cache_metrics = CacheMetrics()
+
+
+async def update_queue_metrics(name: str, queue):
+    """Refresh queue gauges; called at scrape time"""
+    QUEUE_DEPTH.labels(name).set(await queue.depth())
+    QUEUE_IN_FLIGHT.labels(name).set(queue.in_flight)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Sleep in a loop and record how late each wake-up was"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+def render_latest():
+    """Return (body, content type) for the /metrics response (all workers' values in multiprocess mode)"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def mark_worker_dead():
+    """Drop this worker's live gauges from the shared files (multiprocess mode) as it exits"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
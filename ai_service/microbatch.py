@@ -0,0 +1,130 @@
+"""
+Micro-batching scheduler for LLM calls.
+
+Callers submit one item and await its result. Items are collected until
+max_batch_size are pending or max_wait_ms has passed since the first one,
+then sent upstream together through process_batch. If the batched call
+fails or returns the wrong number of results, every item in that batch
+falls back to process_one so callers still get an individual answer.
+
+A batch runs in the most urgent upstream scheduler class of its callers,
+so one interactive caller is not held back by background neighbours.
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Generic, List, Tuple, TypeVar
+
+from metrics import MICROBATCH_FALLBACKS, MICROBATCH_SIZE
+from scheduler import current_request_class, request_class
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MicroBatcher(Generic[T, R]):
+    """Coalesces individual submissions into batched upstream calls"""
+
+    def __init__(
+        self,
+        name: str,
+        process_batch: Callable[[List[T]], Awaitable[List[R]]],
+        process_one: Callable[[T], Awaitable[R]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 50
+    ):
+        self.name = name
+        self.process_batch = process_batch
+        self.process_one = process_one
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._pending: List[Tuple[T, asyncio.Future]] = []
+        self._classes: List[Tuple[int, str]] = []
+        self._timer = None
+        self._tasks = set()
+
+        self.batches = 0
+        self.fallbacks = 0
+
+    async def submit(self, item: T) -> R:
+        """Queue an item for the next batch and wait for its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        self._classes.append(current_request_class())
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    async def close(self):
+        """Send anything still pending and wait for running batches"""
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        classes, self._classes = self._classes, []
+        # The task copies the context, so it schedules its calls in this class
+        with request_class(*min(classes)):
+            task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[T, asyncio.Future]]):
+        # Callers that went away do not need an answer
+        batch = [(item, future) for item, future in batch if not future.done()]
+        if not batch:
+            return
+
+        MICROBATCH_SIZE.labels(self.name).observe(len(batch))
+        if len(batch) == 1:
+            await self._run_one(*batch[0])
+            return
+
+        self.batches += 1
+        try:
+            results = await self.process_batch([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"expected {len(batch)} results, got {len(results)}")
+        except Exception as e:
+            self.fallbacks += 1
+            MICROBATCH_FALLBACKS.labels(self.name).inc()
+            logger.warning(f"{self.name} batch of {len(batch)} failed, falling back to single calls: {str(e)}")
+            await asyncio.gather(*(self._run_one(item, future) for item, future in batch))
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _run_one(self, item: T, future: asyncio.Future):
+        try:
+            result = await self.process_one(item)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "fallbacks": self.fallbacks,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000
+        }
@@ -0,0 +1,248 @@
+"""
+Near-duplicate index of recent posts, used to detect "spam" (repeated or
+templated content) before the LLM sees the post.
+
+Posts are compared by the Jaccard similarity of their word-bigram sets,
+estimated with a MinHash signature. The signature uses one-permutation
+hashing: every bigram is hashed once and kept only if it is the minimum of
+its bin, and empty bins are filled from their right-hand neighbour
+(rotation densification). That costs one hash per bigram instead of one per
+bigram per permutation.
+
+Candidates come from LSH band tables: the signature is cut into bands and
+posts sharing any whole band are compared in full. SimHash was measured
+first, but a one-word edit of a short post moved its fingerprint by
+7-12 bits, too far for band lookups to find cheaply.
+
+Memory is bounded three ways: entries older than the time window are
+evicted, each user keeps at most max_per_user entries, and the whole index
+keeps at most max_entries. The index can be saved to and reloaded from a
+JSONL snapshot across restarts.
+
+The index lives in process memory and is not shared through Redis: with
+several uvicorn workers (WEB_CONCURRENCY > 1) each worker only compares a
+post with the posts it moderated itself, so repeats spread across workers
+are caught less often (by about 1/WEB_CONCURRENCY for a pair of posts).
+Every worker snapshots its own index to the same path, so after a restart
+all workers start from whichever snapshot was written last.
+"""
+import json
+import logging
+import os
+import re
+import time
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r"\w+")
+SALT = 0x9747B28C
+EMPTY = 1 << 64
+VALUE_MASK = 0xFFFFFFFF
+ROTATION_OFFSET = 0x9E3779B1
+
+
+class NearDuplicateIndex:
+    """Time-windowed MinHash LSH index with per-user buckets"""
+
+    def __init__(
+        self,
+        window_seconds: float = 86400,
+        max_entries: int = 20000,
+        max_per_user: int = 50,
+        similarity_threshold: float = 0.5,
+        min_tokens: int = 8,
+        bins: int = 32,
+        bands: int = 8
+    ):
+        if bins % bands:
+            raise ValueError("bins must be a multiple of bands")
+
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self.max_per_user = max_per_user
+        self.similarity_threshold = similarity_threshold
+        self.min_tokens = min_tokens
+        self.bins = bins
+        self.bands = bands
+        self.rows = bins // bands
+
+        # post_id -> (signature, user_id, timestamp), oldest first
+        self._entries: "OrderedDict[int, Tuple[array, int, float]]" = OrderedDict()
+        # band key -> post_id, or a set of post_ids once a band is shared
+        self._bands: Dict[int, object] = {}
+        self._by_user: Dict[int, deque] = {}
+
+        self.checks = 0
+        self.matches = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def signature(self, content: str) -> Optional[array]:
+        """MinHash signature of the content's word bigrams, or None if it is too short"""
+        tokens = TOKEN_RE.findall(content.lower())
+        if len(tokens) < self.min_tokens:
+            return None
+
+        bins = self.bins
+        mins = [EMPTY] * bins
+        for shingle in {f"{a} {b}" for a, b in zip(tokens, tokens[1:])}:
+            data = shingle.encode("utf-8")
+            value = (zlib.crc32(data) << 32) | zlib.crc32(data, SALT)
+            slot = value % bins
+            value //= bins
+            if value < mins[slot]:
+                mins[slot] = value
+
+        # Rotation densification: an empty bin takes the next non-empty bin
+        # to its right, offset by the distance so the two stay distinct
+        signature = array("I", [0]) * bins
+        for slot in range(bins):
+            distance = 0
+            while mins[(slot + distance) % bins] == EMPTY:
+                distance += 1
+            signature[slot] = (mins[(slot + distance) % bins] + distance * ROTATION_OFFSET) & VALUE_MASK
+        return signature
+
+    def similarity(self, first: array, second: array) -> float:
+        """Estimated Jaccard similarity of two signatures"""
+        return sum(a == b for a, b in zip(first, second)) / self.bins
+
+    def _band_keys(self, signature: array) -> Iterable[int]:
+        rows = self.rows
+        for band in range(self.bands):
+            yield hash((band, *signature[band * rows:(band + 1) * rows]))
+
+    def check_and_add(self, post_id: int, user_id: int, content: str, now: Optional[float] = None) -> Optional[dict]:
+        """
+        Record the post and report recent near-duplicates of it.
+
+        Returns None if the post is too short to compare, otherwise a dict
+        with the number of matching posts by the same user and the number of
+        distinct other users who posted a match.
+        """
+        signature = self.signature(content)
+        if signature is None:
+            return None
+
+        now = time.time() if now is None else now
+        self._evict_expired(now)
+        self.checks += 1
+
+        candidates: Set[int] = set()
+        for key in self._band_keys(signature):
+            members = self._bands.get(key)
+            if members is None:
+                continue
+            if isinstance(members, set):
+                candidates.update(members)
+            else:
+                candidates.add(members)
+        candidates.discard(post_id)  # edits of the same post are not repeats
+
+        same_user = 0
+        other_users: Set[int] = set()
+        for candidate in candidates:
+            other_signature, other_user, _ = self._entries[candidate]
+            if self.similarity(signature, other_signature) >= self.similarity_threshold:
+                if other_user == user_id:
+                    same_user += 1
+                else:
+                    other_users.add(other_user)
+
+        self._add(post_id, user_id, signature, now)
+        if same_user or other_users:
+            self.matches += 1
+        return {"same_user": same_user, "other_users": len(other_users)}
+
+    def _add(self, post_id: int, user_id: int, signature: array, timestamp: float):
+        if post_id in self._entries:
+            self._remove(post_id)
+
+        self._entries[post_id] = (signature, user_id, timestamp)
+        for key in self._band_keys(signature):
+            members = self._bands.get(key)
+            if members is None:
+                self._bands[key] = post_id
+            elif isinstance(members, set):
+                members.add(post_id)
+            else:
+                self._bands[key] = {members, post_id}
+
+        bucket = self._by_user.setdefault(user_id, deque())
+        bucket.append(post_id)
+        while len(bucket) > self.max_per_user:
+            self._remove(bucket[0])
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, post_id: int):
+        entry = self._entries.pop(post_id, None)
+        if entry is None:
+            return
+        signature, user_id, _ = entry
+
+        for key in self._band_keys(signature):
+            members = self._bands.get(key)
+            if isinstance(members, set):
+                members.discard(post_id)
+                if len(members) == 1:
+                    self._bands[key] = members.pop()
+            elif members == post_id:
+                del self._bands[key]
+
+        bucket = self._by_user.get(user_id)
+        if bucket is not None:
+            try:
+                bucket.remove(post_id)
+            except ValueError:
+                pass
+            if not bucket:
+                del self._by_user[user_id]
+
+    def _evict_expired(self, now: float):
+        cutoff = now - self.window_seconds
+        while self._entries:
+            post_id, (_, _, timestamp) = next(iter(self._entries.items()))
+            if timestamp >= cutoff:
+                break
+            self._remove(post_id)
+
+    def save(self, path: str):
+        """Write a JSONL snapshot (atomically replaces the previous one)"""
+        # Per-process temp file: several workers may snapshot to the same path
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for post_id, (signature, user_id, timestamp) in self._entries.items():
+                f.write(json.dumps([post_id, user_id, timestamp, signature.tolist()]) + "\n")
+        os.replace(temp_path, path)
+
+    def load(self, path: str) -> int:
+        """Reload a snapshot written by save(), skipping expired or incompatible entries"""
+        loaded = 0
+        cutoff = time.time() - self.window_seconds
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                post_id, user_id, timestamp, values = json.loads(line)
+                if timestamp < cutoff or len(values) != self.bins:
+                    continue
+                self._add(post_id, user_id, array("I", values), timestamp)
+                loaded += 1
+        return loaded
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "users": len(self._by_user),
+            "band_keys": len(self._bands),
+            "checks": self.checks,
+            "matches": self.matches,
+            "window_seconds": self.window_seconds
+        }
@@ -0,0 +1,196 @@
+"""
+Prompt template registry.
+
+Every LLM prompt the service sends is a PromptTemplate, built once at
+import:
+
+- system: the system message, identical for every request
+- prefix: the fixed instructions that open the user message
+- contexts: optional per-key sections (the forum room, for peer replies),
+  rendered onto the prefix once so a request only looks its prefix up
+- body: the per-request part, a str.format template filled last
+
+Everything that varies per request comes at the end of the prompt, so
+requests with the same template (and room) share a byte-identical prefix
+that providers with prompt-prefix caching can reuse.
+
+A template's cache_version combines its version with a fingerprint of its
+text. Result caches put it in their keys, so a changed prompt never serves
+verdicts produced by the old one, even if the version was not bumped.
+"""
+import hashlib
+from typing import Dict, Hashable, List, Optional
+
+
+class PromptTemplate:
+    """A versioned prompt: fixed system message and prefix, per-request body last"""
+
+    def __init__(
+        self,
+        name: str,
+        version: str,
+        system: str,
+        prefix: str,
+        body: str,
+        contexts: Optional[Dict[Hashable, str]] = None,
+        default_context: str = ""
+    ):
+        self.name = name
+        self.version = version
+        self.system = system
+        self.prefix = prefix
+        self.body = body
+        self._prefixes = {key: prefix + context for key, context in (contexts or {}).items()}
+        self._default_prefix = prefix + default_context
+
+        text = "\x00".join([system, prefix, body, default_context, *sorted(self._prefixes.values())])
+        self.fingerprint = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+    @property
+    def cache_version(self) -> str:
+        return f"{self.version}-{self.fingerprint}"
+
+    def render(self, context: Optional[Hashable] = None, **values) -> str:
+        """The user message: the (context) prefix followed by the filled-in body"""
+        return self._prefixes.get(context, self._default_prefix) + self.body.format(**values)
+
+    def messages(self, context: Optional[Hashable] = None, **values) -> List[dict]:
+        """Chat messages for one request"""
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.render(context, **values)}
+        ]
+
+
+class PromptRegistry:
+    """The service's prompt templates by name"""
+
+    def __init__(self):
+        self._templates: Dict[str, PromptTemplate] = {}
+
+    def register(self, template: PromptTemplate) -> PromptTemplate:
+        if template.name in self._templates:
+            raise ValueError(f"Prompt template {template.name!r} is already registered")
+        self._templates[template.name] = template
+        return template
+
+    def get(self, name: str) -> PromptTemplate:
+        return self._templates[name]
+
+    def versions(self) -> Dict[str, str]:
+        return {name: template.cache_version for name, template in self._templates.items()}
+
+
+prompt_registry = PromptRegistry()
+
+MODERATOR_SYSTEM = "You are a content moderator for a professional executive forum. Be strict but fair."
+
+VERDICT_FIELDS = """- flagged: boolean
+- violation_type: string (solicitation, pii, harassment, confidential, off_topic, spam, identity_leak, inappropriate)
+- severity: integer (1-5, 5 being most severe)
+- reason: string
+- confidence: float (0-1)
+"""
+
+MODERATION_PROMPT = prompt_registry.register(PromptTemplate(
+    name="moderation",
+    version="2",
+    system=MODERATOR_SYSTEM,
+    prefix=f"Analyze this post for violations. Return JSON with:\n{VERDICT_FIELDS}\n",
+    body='Post content: "{content}"\n'
+))
+
+MODERATION_BATCH_PROMPT = prompt_registry.register(PromptTemplate(
+    name="moderation_batch",
+    version="2",
+    system=MODERATOR_SYSTEM,
+    prefix=(
+        "Analyze each of the following posts for violations. Return a JSON array with\n"
+        "exactly one object per post, in the same order, each with:\n"
+        f"- index: integer (the post number in brackets)\n{VERDICT_FIELDS}\n"
+    ),
+    body="Posts:\n{posts}\n"
+))
+
+# Forum rooms (Discourse category ids) and what they discuss
+ROOM_CONTEXTS = {
+    1: "HR & People - Leadership, talent management, organizational culture",
+    2: "Finance & Capital - Financial strategy, fundraising, M&A",
+    3: "Corporate Strategy - Growth planning, competitive dynamics, transformation",
+    4: "Sales & GTM - Go-to-market strategy, customer acquisition",
+    5: "Mergers & Acquisitions - Due diligence, integration, deal strategy",
+    6: "Leadership & Mental Load - Executive challenges, work-life balance"
+}
+DEFAULT_ROOM_CONTEXT = "General executive discussion"
+
+REPLY_PROMPT = prompt_registry.register(PromptTemplate(
+    name="reply",
+    version="2",
+    system="You are Peer AI #0000, a strategic advisor and peer in an executive forum.",
+    prefix=(
+        "You are Peer AI #0000, an AI assistant in a private C-level executive forum.\n"
+        "Provide a thoughtful, strategic response that adds value to this discussion.\n"
+        "Keep it professional, constructive, and focused on leadership/strategy.\n"
+        "Respond as a helpful peer, not as an AI.\n\n"
+    ),
+    body='Discussion: "{content}"\n',
+    contexts={room_id: f"Room context: {context}\n" for room_id, context in ROOM_CONTEXTS.items()},
+    default_context=f"Room context: {DEFAULT_ROOM_CONTEXT}\n"
+))
+
+VERIFICATION_PROMPT = prompt_registry.register(PromptTemplate(
+    name="verification",
+    version="2",
+    system=(
+        "You are Vera, a professional verification specialist for Circle of Peers. You provide accurate, "
+        "conservative assessments with detailed reasoning and confidence scores."
+    ),
+    prefix="""You are Vera, an AI verification specialist for Circle of Peers, a private forum for C-level executives. Your role is to thoroughly analyze applications and provide detailed assessments with confidence scores.
+
+**Analysis Instructions:**
+1. Evaluate if this person appears to be a legitimate C-level executive or equivalent senior leader
+2. Check for consistency in professional information
+3. Identify any risk factors or red flags
+4. Assess the overall credibility and suitability for the platform
+
+**Response Format:**
+Provide your analysis in the following JSON format:
+{
+    "recommendation": "approve|reject|review_required",
+    "confidence_score": 0.0-1.0,
+    "risk_factors": [
+        {
+            "name": "Risk factor name",
+            "description": "Description of the risk",
+            "severity": "high|medium|low"
+        }
+    ],
+    "analysis": {
+        "executive_role_verified": true/false,
+        "professional_credibility": "high|medium|low",
+        "risk_level": "high|medium|low",
+        "notes": "Additional analysis notes"
+    }
+}
+
+**Important Guidelines:**
+- Only approve if there's strong evidence of C-level or equivalent executive role
+- Reject if there are significant red flags or inconsistencies
+- Request review if the case is unclear or borderline
+- Be conservative in approvals to maintain platform quality
+
+""",
+    body="""**User Information:**
+- Name: {name}
+- Email: {email}
+- Company: {company}
+- Title: {title}
+- LinkedIn: {linkedin_url}
+- Bio: {bio}
+- Location: {location}
+
+**Verification Criteria:**
+{criteria}"""
+))
+
+VERIFICATION_USER_FIELDS = ("name", "email", "company", "title", "linkedin_url", "bio", "location")
@@ -0,0 +1,341 @@
+"""
+Bulk rescoring of existing posts through the moderation pipeline.
+
+Usage:
+    python rescore.py posts.jsonl --output results.jsonl [--resume]
+    python rescore.py posts.csv --output results.jsonl --concurrency 32
+    python rescore.py --postgres --output results.jsonl [--database-url URL]
+
+Posts are read as a stream from JSONL or CSV (a "content" or "raw" column
+and a "post_id" or "id" column), or paged from the Discourse posts table
+by id using DATABASE_URL. Each post goes through the same stages as
+/moderate, minus near-duplicate detection (historical posts would all look
+like repeats): the regex pre-filter, the local classifier, then the LLM
+behind the moderation cache. LLM calls run as background work in the
+upstream scheduler, so a rescore never starves live traffic in the same
+process's limits.
+
+Results are written as JSONL in input order, one line per post. Transient
+upstream failures (an open circuit breaker, timeouts, connection errors,
+429 and 5xx responses) are retried with exponential backoff, --retries
+times. A post that still fails, or fails for another reason, gets an
+"error" field instead of stopping the run.
+
+An upstream outage would otherwise turn every post into an error line that
+--resume never revisits. So when more than --max-error-rate of the last
+--error-window posts failed, the run stops. The checkpoint is rolled back to
+just before the first failure in that window, and a later --resume redoes
+those posts.
+
+Memory use is constant: at most --window posts are read ahead of the
+output, and only --concurrency of them are being moderated at once.
+
+Every --checkpoint-every posts the output is flushed and a checkpoint file
+records how many posts are done, the output size and the last post id.
+With --resume the output is truncated back to the checkpoint and the
+input skips ahead (by count for files, by id for Postgres), so an
+interrupted run continues without gaps or duplicate lines.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import deque
+from typing import AsyncIterator, Optional, Tuple
+
+from circuit_breaker import CircuitOpenError
+from llm import is_upstream_failure
+from main import (
+    MODERATION_BATCH_CONCURRENCY, OPENAI_API_KEY, ModerationResult, cpu_pool, llm_client, load_models,
+    moderation_batcher, moderation_cache, moderation_flights, prefilter_content, review_content
+)
+from scheduler import BACKGROUND, request_class
+
+logger = logging.getLogger("rescore")
+
+RETRY_BACKOFF_MAX_SECONDS = 60.0
+
+POSTGRES_QUERY = """
+    SELECT id, user_id, raw
+    FROM posts
+    WHERE id > %s AND deleted_at IS NULL
+    ORDER BY id
+    LIMIT %s
+"""
+
+
+def post_from_record(record: dict) -> Tuple[Optional[int], str]:
+    """(post id, content) from an exported row"""
+    post_id = record.get("post_id", record.get("id"))
+    content = record.get("content", record.get("raw")) or ""
+    return (int(post_id) if post_id not in (None, "") else None), content
+
+
+def raise_csv_field_limit():
+    """Lift the csv module's 131072-character field limit, which long posts exceed"""
+    limit = sys.maxsize
+    while True:
+        try:
+            csv.field_size_limit(limit)
+            return
+        except OverflowError:
+            # The limit is a C long, which is 32 bits on some platforms
+            limit //= 2
+
+
+async def read_file(path: str, skip: int) -> AsyncIterator[Tuple[Optional[int], str]]:
+    """Posts from a JSONL or CSV file, one at a time, after the first skip records"""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            raise_csv_field_limit()
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for index, record in enumerate(records):
+            if index < skip:
+                continue
+            yield post_from_record(record)
+            if index % 1000 == 0:
+                # Reading is synchronous; let in-flight moderation progress
+                await asyncio.sleep(0)
+
+
+async def read_postgres(database_url: str, after_id: int, page_size: int) -> AsyncIterator[Tuple[Optional[int], str]]:
+    """Posts from the Discourse database in id order, one page at a time"""
+    import psycopg2
+
+    connection = await asyncio.to_thread(psycopg2.connect, database_url)
+    try:
+        while True:
+            def fetch_page():
+                with connection.cursor() as cursor:
+                    cursor.execute(POSTGRES_QUERY, (after_id, page_size))
+                    return cursor.fetchall()
+
+            rows = await asyncio.to_thread(fetch_page)
+            if not rows:
+                return
+            for post_id, _, raw in rows:
+                yield post_id, raw or ""
+            after_id = rows[-1][0]
+    finally:
+        connection.close()
+
+
+class ErrorRateExceeded(Exception):
+    """Too many recent posts failed; carries the checkpoint from before the first of them"""
+
+    def __init__(self, errors: int, posts: int, checkpoint: dict):
+        super().__init__(f"{errors} of the last {posts} posts failed")
+        self.checkpoint = checkpoint
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether retrying later may succeed (the upstream is down, not the post bad)"""
+    return isinstance(error, CircuitOpenError) or is_upstream_failure(error)
+
+
+def retry_delay(error: Exception, attempt: int, backoff: float) -> float:
+    """Seconds before retry number attempt (from 1), with jitter; at least until an open circuit may close"""
+    delay = min(backoff * 2 ** (attempt - 1), RETRY_BACKOFF_MAX_SECONDS) * random.uniform(0.5, 1.0)
+    if isinstance(error, CircuitOpenError):
+        delay = max(delay, error.retry_after)
+    return delay
+
+
+async def rescore_post(post_id: Optional[int], content: str, retries: int = 0, backoff: float = 2.0) -> dict:
+    """One output line: the moderation result, or the error that prevented it"""
+    attempt = 0
+    while True:
+        try:
+            result = await prefilter_content(content)
+            if result is None:
+                result = await review_content(content, post_id)
+            return {"post_id": post_id, **result.model_dump(), "error": None}
+        except Exception as e:
+            if attempt < retries and is_transient(e):
+                attempt += 1
+                delay = retry_delay(e, attempt, backoff)
+                logger.warning(f"Post {post_id} attempt {attempt} failed, retrying in {delay:.1f}s: {str(e)}")
+                await asyncio.sleep(delay)
+                continue
+            return {"post_id": post_id, **ModerationResult(flagged=False).model_dump(), "error": f"{type(e).__name__}: {str(e)}"}
+
+
+def load_checkpoint(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    """Write the checkpoint atomically, so a crash leaves the old or the new one"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+async def rescore(args) -> dict:
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint"
+    checkpoint = load_checkpoint(checkpoint_path) if args.resume else None
+    if args.resume and checkpoint is None:
+        logger.info(f"No checkpoint at {checkpoint_path}, starting from the beginning")
+    checkpoint = checkpoint or {"done": 0, "output_bytes": 0, "last_post_id": 0, "flagged": 0, "errors": 0}
+
+    if checkpoint["done"] and not os.path.exists(args.output):
+        raise SystemExit(f"Checkpoint {checkpoint_path} has {checkpoint['done']} posts but {args.output} is missing")
+
+    # Drop anything written after the last checkpoint; those posts are redone
+    output = open(args.output, "r+b" if checkpoint["done"] and os.path.exists(args.output) else "wb")
+    output.truncate(checkpoint["output_bytes"])
+    output.seek(checkpoint["output_bytes"])
+
+    if args.postgres:
+        posts = read_postgres(args.database_url, checkpoint["last_post_id"] or 0, args.page_size)
+    else:
+        posts = read_file(args.input, checkpoint["done"])
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    window = deque()
+    # (failed, checkpoint before the line) for the last error_window lines; the
+    # checkpoint is only kept for failed lines, to roll back to on abort
+    recent = deque()
+    recent_errors = 0
+    started = time.monotonic()
+    start_done = checkpoint["done"]
+
+    async def moderate(post_id: Optional[int], content: str) -> dict:
+        async with semaphore:
+            return await rescore_post(post_id, content, args.retries, args.retry_backoff)
+
+    def write(line: dict):
+        nonlocal recent_errors
+        failed = line["error"] is not None
+        if args.max_error_rate > 0:
+            recent.append((failed, {**checkpoint, "output_bytes": output.tell()} if failed else None))
+            recent_errors += failed
+            if len(recent) > args.error_window:
+                recent_errors -= recent.popleft()[0]
+            if len(recent) >= args.error_window and recent_errors > args.max_error_rate * len(recent):
+                first_failure = next(before for failed, before in recent if failed)
+                raise ErrorRateExceeded(recent_errors, len(recent), first_failure)
+
+        output.write(json.dumps(line, default=str).encode("utf-8") + b"\n")
+        checkpoint["done"] += 1
+        checkpoint["flagged"] += bool(line["flagged"])
+        checkpoint["errors"] += failed
+        if line["post_id"] is not None:
+            checkpoint["last_post_id"] = line["post_id"]
+
+        if checkpoint["done"] % args.checkpoint_every == 0:
+            output.flush()
+            checkpoint["output_bytes"] = output.tell()
+            save_checkpoint(checkpoint_path, checkpoint)
+            rate = (checkpoint["done"] - start_done) / max(time.monotonic() - started, 1e-9)
+            logger.info(
+                f"{checkpoint['done']} posts, {checkpoint['flagged']} flagged, "
+                f"{checkpoint['errors']} errors ({rate:.1f} posts/s)"
+            )
+
+    with request_class(BACKGROUND, "rescore"):
+        rollback = None
+        try:
+            async for post_id, content in posts:
+                window.append(asyncio.create_task(moderate(post_id, content)))
+                # Results leave in input order; the window bounds read-ahead
+                if len(window) >= args.window:
+                    write(await window.popleft())
+                while window and window[0].done():
+                    write(window.popleft().result())
+                if args.limit and checkpoint["done"] + len(window) - start_done >= args.limit:
+                    break
+
+            while window:
+                write(await window.popleft())
+        except ErrorRateExceeded as e:
+            rollback = e.checkpoint
+            raise
+        finally:
+            for task in window:
+                task.cancel()
+            output.flush()
+            if rollback is not None:
+                # Lines written after this point are truncated away by --resume
+                checkpoint.clear()
+                checkpoint.update(rollback)
+            else:
+                checkpoint["output_bytes"] = output.tell()
+            save_checkpoint(checkpoint_path, checkpoint)
+            output.close()
+
+    checkpoint["elapsed_seconds"] = round(time.monotonic() - started, 2)
+    return checkpoint
+
+
+async def run(args) -> dict:
+    await load_models()
+    if OPENAI_API_KEY:
+        await llm_client.start()
+    await moderation_flights.start()
+    await moderation_cache.start()
+    try:
+        return await rescore(args)
+    finally:
+        await moderation_batcher.close()
+        await llm_client.close()
+        await moderation_flights.close()
+        await moderation_cache.close()
+        cpu_pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", nargs="?", help="JSONL or CSV file of posts")
+    parser.add_argument("--postgres", action="store_true", help="read the posts table instead of a file")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"))
+    parser.add_argument("--page-size", type=int, default=1000, help="posts per Postgres query")
+    parser.add_argument("--output", required=True, help="JSONL results file")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument("--checkpoint-every", type=int, default=500, help="posts between checkpoints")
+    parser.add_argument("--resume", action="store_true", help="continue from the checkpoint")
+    parser.add_argument("--concurrency", type=int, default=MODERATION_BATCH_CONCURRENCY, help="posts moderated at once")
+    parser.add_argument("--window", type=int, help="posts read ahead of the output (default: 4x concurrency)")
+    parser.add_argument("--limit", type=int, default=0, help="stop after this many posts (0 = all)")
+    parser.add_argument("--retries", type=int, default=5, help="retries of a post after a transient upstream error")
+    parser.add_argument("--retry-backoff", type=float, default=2.0, help="seconds before the first retry, doubled after each")
+    parser.add_argument("--max-error-rate", type=float, default=0.5, help="stop when more of the recent posts failed (0 = never)")
+    parser.add_argument("--error-window", type=int, default=200, help="recent posts the error rate is measured over")
+    args = parser.parse_args()
+
+    if args.postgres == bool(args.input):
+        parser.error("give an input file or --postgres, not both")
+    if args.postgres and not args.database_url:
+        parser.error("--postgres needs DATABASE_URL or --database-url")
+    args.window = max(args.window or args.concurrency * 4, args.concurrency)
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if not OPENAI_API_KEY:
+        logger.warning("OPENAI_API_KEY is not set: only the regex pre-filter and local classifier will run")
+
+    try:
+        summary = asyncio.run(run(args))
+    except ErrorRateExceeded as e:
+        logger.error(
+            f"Stopping: {str(e)}. Checkpoint rolled back to {e.checkpoint['done']} posts; "
+            f"run again with --resume once the upstream has recovered"
+        )
+        sys.exit(1)
+    print(json.dumps(summary), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
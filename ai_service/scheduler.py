@@ -0,0 +1,384 @@
+"""
+Central scheduler for upstream LLM calls.
+
+Every chat completion takes a slot from its model's limiter before it is
+sent. A limiter caps the calls in flight and, optionally, the tokens sent
+per minute (a token bucket refilled continuously; a call is charged its
+estimate up front and corrected with the real usage when it finishes).
+
+Waiting calls are ordered by:
+
+- priority class: interactive calls (a user or the Rails app is waiting on
+  the response) go before background work (webhooks, batches). So that a
+  steady stream of interactive calls cannot starve background work
+  forever, one background call is let through after every
+  background_after interactive grants while both are waiting.
+- fair queuing within a class: each flow (usually the endpoint) has its own
+  FIFO and flows are served round-robin, so one busy flow cannot push the
+  others to the back of the queue.
+
+The class of a call comes from a context variable, set per endpoint with
+upstream_class() or around background work with request_class().
+
+Limits are for the whole deployment. With a Redis URL, each process
+(uvicorn worker or replica) keeps a heartbeat key in Redis and takes an
+equal share of every limit, rebalanced as processes come and go. Without
+Redis each process applies the full limits.
+"""
+import asyncio
+import functools
+import logging
+import os
+import socket
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional, Tuple
+
+from metrics import UPSTREAM_IN_FLIGHT, UPSTREAM_QUEUE_DEPTH, UPSTREAM_QUEUE_WAIT, UPSTREAM_TOKENS_AVAILABLE
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+_request_class: ContextVar[Tuple[int, str]] = ContextVar("upstream_class", default=(INTERACTIVE, "default"))
+
+
+def current_request_class() -> Tuple[int, str]:
+    """(priority, flow) of upstream calls made from the current context"""
+    return _request_class.get()
+
+
+@contextmanager
+def request_class(priority: int, flow: str):
+    """Run a block's upstream calls with the given priority and flow"""
+    token = _request_class.set((priority, flow))
+    try:
+        yield
+    finally:
+        _request_class.reset(token)
+
+
+def upstream_class(priority: int, flow: str):
+    """Endpoint decorator: upstream calls made by the handler use this priority and flow"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with request_class(priority, flow):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def parse_model_limits(value: Optional[str]) -> Dict[str, Tuple[int, int]]:
+    """
+    Parse per-model limits like "gpt-4=8:40000,gpt-3.5-turbo=32:90000"
+    (concurrency:tokens per minute; 0 tokens per minute means no token limit)
+    """
+    limits = {}
+    for entry in (value or "").split(","):
+        if not entry.strip():
+            continue
+        model, _, spec = entry.strip().partition("=")
+        concurrency, _, tokens_per_minute = spec.partition(":")
+        limits[model.strip()] = (int(concurrency), int(tokens_per_minute or 0))
+    return limits
+
+
+class Grant:
+    """A slot held by one upstream call"""
+
+    __slots__ = ("limiter", "tokens", "priority", "flow", "enqueued", "future", "started", "released")
+
+    def __init__(self, limiter: "ModelLimiter", tokens: int, priority: int, flow: str):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.priority = priority
+        self.flow = flow
+        self.enqueued = time.monotonic()
+        self.future: Optional[asyncio.Future] = None
+        self.started = False
+        self.released = False
+
+    def release(self, used_tokens: Optional[int] = None):
+        """Give the slot back, correcting the token charge with the real usage if known"""
+        if not self.released:
+            self.released = True
+            self.limiter._release(self, used_tokens)
+
+
+class ModelLimiter:
+    """Concurrency and tokens-per-minute limits for one model, with a priority and fair queue"""
+
+    def __init__(self, model: str, max_concurrency: int, tokens_per_minute: int = 0, background_after: int = 8):
+        self.model = model
+        self.limits = (max_concurrency, tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.background_after = background_after
+
+        self.in_flight = 0
+        self._queues: Dict[int, "OrderedDict[str, Deque[Grant]]"] = {INTERACTIVE: OrderedDict(), BACKGROUND: OrderedDict()}
+        self._waiting = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._interactive_streak = 0
+
+        self._tokens = float(tokens_per_minute)
+        self._refilled = time.monotonic()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+        self.granted = 0
+        self.throttled = 0
+
+    async def acquire(self, tokens: int, priority: int, flow: str) -> Grant:
+        """Wait for a slot (and, with a token limit, budget for tokens)"""
+        grant = Grant(self, tokens, priority, flow)
+        if not self._waiting[INTERACTIVE] and not self._waiting[BACKGROUND] and self._admit(grant):
+            self._start(grant)
+            return grant
+
+        grant.future = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(flow, deque()).append(grant)
+        self._waiting[priority] += 1
+        UPSTREAM_QUEUE_DEPTH.labels(self.model, PRIORITY_NAMES[priority]).inc()
+        self.throttled += 1
+        # Nothing may be in flight to trigger a dispatch (e.g. only the token budget is short)
+        self._dispatch()
+        try:
+            await grant.future
+        except asyncio.CancelledError:
+            if grant.started:
+                # Granted in the same loop iteration the caller gave up
+                grant.release()
+            else:
+                self._remove(grant)
+            raise
+        return grant
+
+    def oldest_wait(self, priority: int) -> float:
+        """Seconds the longest-waiting call of a priority class has been queued (0 if none)"""
+        if not self._waiting[priority]:
+            return 0.0
+        # Each flow is FIFO, so its head is its oldest call
+        oldest = min(queue[0].enqueued for queue in self._queues[priority].values())
+        return time.monotonic() - oldest
+
+    def set_share(self, members: int):
+        """Apply 1/members of the configured limits (one share per process)"""
+        concurrency, tokens_per_minute = self.limits
+        self._refill()
+        self.max_concurrency = max(1, concurrency // members)
+        self.tokens_per_minute = max(1, tokens_per_minute // members) if tokens_per_minute else 0
+        self._tokens = min(self._tokens, float(self.tokens_per_minute))
+        self._dispatch()
+
+    def stats(self) -> dict:
+        self._refill()
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "tokens_per_minute": self.tokens_per_minute,
+            "tokens_available": int(self._tokens) if self.tokens_per_minute else None,
+            "waiting": {PRIORITY_NAMES[priority]: count for priority, count in self._waiting.items()},
+            "granted": self.granted,
+            "throttled": self.throttled
+        }
+
+    def _refill(self):
+        if not self.tokens_per_minute:
+            return
+        now = time.monotonic()
+        self._tokens = min(
+            float(self.tokens_per_minute),
+            self._tokens + (now - self._refilled) * self.tokens_per_minute / 60
+        )
+        self._refilled = now
+
+    def _admit(self, grant: Grant) -> bool:
+        if self.in_flight >= self.max_concurrency:
+            return False
+        if not self.tokens_per_minute:
+            return True
+        self._refill()
+        # A call larger than the whole budget waits for a full bucket instead of forever
+        return self._tokens >= min(grant.tokens, self.tokens_per_minute)
+
+    def _start(self, grant: Grant):
+        grant.started = True
+        self.in_flight += 1
+        self.granted += 1
+        if self.tokens_per_minute:
+            self._tokens -= grant.tokens
+            UPSTREAM_TOKENS_AVAILABLE.labels(self.model).set(self._tokens)
+        UPSTREAM_IN_FLIGHT.labels(self.model).set(self.in_flight)
+        UPSTREAM_QUEUE_WAIT.labels(self.model, PRIORITY_NAMES[grant.priority]).observe(time.monotonic() - grant.enqueued)
+
+    def _release(self, grant: Grant, used_tokens: Optional[int]):
+        self.in_flight -= 1
+        UPSTREAM_IN_FLIGHT.labels(self.model).set(self.in_flight)
+        if self.tokens_per_minute and used_tokens is not None:
+            self._refill()
+            self._tokens += grant.tokens - used_tokens
+            UPSTREAM_TOKENS_AVAILABLE.labels(self.model).set(self._tokens)
+        self._dispatch()
+
+    def _remove(self, grant: Grant):
+        flows = self._queues[grant.priority]
+        queue = flows.get(grant.flow)
+        if queue is not None and grant in queue:
+            queue.remove(grant)
+            if not queue:
+                del flows[grant.flow]
+            self._dequeued(grant)
+
+    def _dequeued(self, grant: Grant):
+        self._waiting[grant.priority] -= 1
+        UPSTREAM_QUEUE_DEPTH.labels(self.model, PRIORITY_NAMES[grant.priority]).dec()
+
+    def _next_priority(self) -> Optional[int]:
+        if not self._waiting[INTERACTIVE]:
+            return BACKGROUND if self._waiting[BACKGROUND] else None
+        if self._waiting[BACKGROUND] and self._interactive_streak >= self.background_after:
+            return BACKGROUND
+        return INTERACTIVE
+
+    def _dispatch(self):
+        """Grant slots to waiting calls in priority, then round-robin flow order"""
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+
+        while True:
+            priority = self._next_priority()
+            if priority is None:
+                return
+            flows = self._queues[priority]
+            flow, queue = next(iter(flows.items()))
+            grant = queue[0]
+            if grant.future.done():
+                # Cancelled (deadline or disconnect) but its task has not run to dequeue it yet
+                queue.popleft()
+                if not queue:
+                    del flows[flow]
+                self._dequeued(grant)
+                continue
+            if not self._admit(grant):
+                if self.in_flight < self.max_concurrency:
+                    # Out of tokens: look again once the bucket has refilled enough
+                    missing = min(grant.tokens, self.tokens_per_minute) - self._tokens
+                    delay = max(0.01, missing * 60 / self.tokens_per_minute)
+                    self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+
+            queue.popleft()
+            # Round-robin: the flow just served goes to the back
+            del flows[flow]
+            if queue:
+                flows[flow] = queue
+            self._dequeued(grant)
+            self._interactive_streak = self._interactive_streak + 1 if priority == INTERACTIVE else 0
+
+            self._start(grant)
+            grant.future.set_result(None)
+
+
+class UpstreamScheduler:
+    """Per-model limiters, created on first use from configured or default limits"""
+
+    def __init__(
+        self,
+        default_concurrency: int = 64,
+        default_tokens_per_minute: int = 0,
+        model_limits: Optional[Dict[str, Tuple[int, int]]] = None,
+        background_after: int = 8
+    ):
+        self.default_concurrency = default_concurrency
+        self.default_tokens_per_minute = default_tokens_per_minute
+        self.model_limits = model_limits or {}
+        self.background_after = background_after
+        self._limiters: Dict[str, ModelLimiter] = {}
+
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.members = 1
+        self._redis = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    async def start(self, redis_url: Optional[str], heartbeat_seconds: float = 5.0):
+        """Share the limits with the other processes registered in Redis, if configured"""
+        if not redis_url or self._redis is not None:
+            return
+        try:
+            import redis.asyncio as redis
+
+            self._redis = redis.from_url(redis_url)
+            await self._sync_members(heartbeat_seconds)
+        except Exception as e:
+            logger.warning(f"Upstream limits not shared (Redis unavailable), each process applies them in full: {str(e)}")
+            self._redis = None
+            return
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop(heartbeat_seconds))
+
+    async def close(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        if self._redis is not None:
+            try:
+                await self._redis.delete(f"cop:scheduler:member:{self.instance_id}")
+            except Exception:
+                pass
+            await self._redis.close()
+        self._redis = None
+
+    async def _sync_members(self, heartbeat_seconds: float):
+        await self._redis.set(f"cop:scheduler:member:{self.instance_id}", 1, ex=max(1, int(heartbeat_seconds * 3)))
+        members = 0
+        async for _ in self._redis.scan_iter(match="cop:scheduler:member:*"):
+            members += 1
+        members = max(1, members)
+        if members != self.members:
+            logger.info(f"Upstream limits shared by {members} processes")
+            self.members = members
+            for limiter in self._limiters.values():
+                limiter.set_share(members)
+
+    async def _heartbeat_loop(self, heartbeat_seconds: float):
+        while True:
+            await asyncio.sleep(heartbeat_seconds)
+            try:
+                await self._sync_members(heartbeat_seconds)
+            except Exception as e:
+                logger.warning(f"Upstream scheduler heartbeat failed: {str(e)}")
+
+    def limiter(self, model: str) -> ModelLimiter:
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            concurrency, tokens_per_minute = self.model_limits.get(
+                model, (self.default_concurrency, self.default_tokens_per_minute)
+            )
+            limiter = self._limiters[model] = ModelLimiter(
+                model, concurrency, tokens_per_minute, background_after=self.background_after
+            )
+            if self.members > 1:
+                limiter.set_share(self.members)
+        return limiter
+
+    async def acquire(self, model: str, tokens: int) -> Grant:
+        """Wait for a slot for a call of about this many tokens, in the current context's class"""
+        priority, flow = current_request_class()
+        return await self.limiter(model).acquire(tokens, priority, flow)
+
+    def oldest_wait(self, priority: int = INTERACTIVE) -> float:
+        """Longest current queue wait for a slot across models, in seconds"""
+        return max((limiter.oldest_wait(priority) for limiter in self._limiters.values()), default=0.0)
+
+    def stats(self) -> dict:
+        return {
+            "processes": self.members,
+            "shared": self._redis is not None,
+            "models": {model: limiter.stats() for model, limiter in self._limiters.items()}
+        }
@@ -0,0 +1,59 @@
+"""
+Evaluate a local moderation classifier artifact on labelled data.
+
+Usage:
+    python scripts/evaluate_classifier.py models/moderation_classifier-<version>.json.gz \\
+        labelled.jsonl [--clean-threshold 0.95] [--violation-threshold 0.97] [--sweep]
+
+Prints accuracy, per-class precision/recall and how the tier would route
+the posts at the given thresholds: the share decided locally, the share
+escalated to the LLM, and how many violations the local tier would clear.
+With --sweep it prints the routing for a range of thresholds, which helps
+when picking CLASSIFIER_CLEAN_THRESHOLD and CLASSIFIER_VIOLATION_THRESHOLD.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifier import HashedNgramClassifier, evaluate, load_dataset  # noqa: E402
+
+SWEEP_THRESHOLDS = [0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.97, 0.99]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model")
+    parser.add_argument("data", nargs="+", help="labelled JSONL or CSV files")
+    parser.add_argument("--clean-threshold", type=float, default=0.95)
+    parser.add_argument("--violation-threshold", type=float, default=0.97)
+    parser.add_argument("--sweep", action="store_true", help="report routing across a range of thresholds")
+    args = parser.parse_args()
+
+    model = HashedNgramClassifier.load(args.model)
+    texts, labels = [], []
+    for path in args.data:
+        file_texts, file_labels = load_dataset(path)
+        texts.extend(file_texts)
+        labels.extend(file_labels)
+    if not texts:
+        sys.exit("No labelled records found")
+
+    print(f"Model {model.version}: {len(model.classes)} classes, {len(model.weights)} features")
+    report = evaluate(model, texts, labels, args.clean_threshold, args.violation_threshold)
+    print(json.dumps(report, indent=2))
+
+    if args.sweep:
+        print(f"\n{'threshold':>9} {'local':>7} {'llm':>7} {'local_acc':>9} {'cleared':>7}")
+        for threshold in SWEEP_THRESHOLDS:
+            tier = evaluate(model, texts, labels, threshold, threshold)["tier"]
+            print(
+                f"{threshold:>9.2f} {tier['decided_locally']:>7.2%} {tier['escalated_to_llm']:>7.2%} "
+                f"{tier['local_accuracy']:>9.2%} {tier['violations_cleared_locally']:>7}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Train the local moderation classifier from exported flag data.
+
+Usage:
+    python scripts/train_classifier.py export.jsonl [more.jsonl ...] \\
+        [--output-dir models] [--version 2024-06-01] [--holdout 0.2]
+
+Input files are JSONL or CSV with a "content" column and either a "label"
+column or the flag's "violation_type" and "status" (approved/resolved flags
+are violations, rejected flags and unflagged posts are clean, pending flags
+are skipped).
+
+The model is trained on a shuffled split, evaluated on the holdout, then
+written to <output-dir>/moderation_classifier-<version>.json.gz with the
+holdout metrics in its metadata. Point CLASSIFIER_MODEL_PATH at the file
+to deploy it.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifier import HashedNgramClassifier, evaluate, load_dataset  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data", nargs="+", help="exported JSONL or CSV files")
+    parser.add_argument("--output-dir", default="models")
+    parser.add_argument("--version", default=datetime.utcnow().strftime("%Y%m%d-%H%M%S"))
+    parser.add_argument("--holdout", type=float, default=0.2, help="fraction held out for evaluation")
+    parser.add_argument("--epochs", type=int, default=8)
+    parser.add_argument("--learning-rate", type=float, default=0.5)
+    parser.add_argument("--l2", type=float, default=1e-6)
+    parser.add_argument("--feature-bits", type=int, default=18, help="hash space is 2**bits features")
+    parser.add_argument("--ngram-max", type=int, default=2)
+    parser.add_argument("--clean-threshold", type=float, default=0.95)
+    parser.add_argument("--violation-threshold", type=float, default=0.97)
+    parser.add_argument("--seed", type=int, default=13)
+    args = parser.parse_args()
+
+    texts, labels = [], []
+    for path in args.data:
+        file_texts, file_labels = load_dataset(path)
+        texts.extend(file_texts)
+        labels.extend(file_labels)
+    if not texts:
+        sys.exit("No labelled records found")
+
+    order = list(range(len(texts)))
+    random.Random(args.seed).shuffle(order)
+    split = int(len(order) * (1 - args.holdout))
+    train_idx, test_idx = order[:split], order[split:]
+
+    counts = {}
+    for label in labels:
+        counts[label] = counts.get(label, 0) + 1
+    print(f"Loaded {len(texts)} examples: {json.dumps(counts, sort_keys=True)}")
+    print(f"Training on {len(train_idx)}, holding out {len(test_idx)}")
+
+    model = HashedNgramClassifier.fit(
+        [texts[i] for i in train_idx],
+        [labels[i] for i in train_idx],
+        classes=sorted(counts),
+        n_features=2 ** args.feature_bits,
+        ngram_max=args.ngram_max,
+        epochs=args.epochs,
+        learning_rate=args.learning_rate,
+        l2=args.l2,
+        seed=args.seed,
+        version=args.version
+    )
+
+    if test_idx:
+        report = evaluate(
+            model,
+            [texts[i] for i in test_idx],
+            [labels[i] for i in test_idx],
+            args.clean_threshold,
+            args.violation_threshold
+        )
+        print(json.dumps(report, indent=2))
+        model.metadata["holdout"] = report
+
+    model.metadata["training"] = {
+        "sources": [os.path.basename(path) for path in args.data],
+        "examples": len(train_idx),
+        "class_counts": counts,
+        "epochs": args.epochs,
+        "learning_rate": args.learning_rate,
+        "l2": args.l2
+    }
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output = os.path.join(args.output_dir, f"moderation_classifier-{args.version}.json.gz")
+    model.save(output)
+    print(f"Wrote {output} ({len(model.weights)} non-zero features)")
+
+
+if __name__ == "__main__":
+    main()
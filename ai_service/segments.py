@@ -0,0 +1,53 @@
+"""
+Paragraph segmentation and diffing for incremental re-moderation of edits.
+
+A post is split into paragraphs and each paragraph is hashed after
+normalization that drops what cannot change a verdict: case, whitespace,
+Unicode form and Markdown/punctuation characters. Comparing the hashes
+stored from the last moderation with the edited post's hashes tells which
+paragraphs are new or materially changed and which were removed.
+"""
+import hashlib
+import re
+import unicodedata
+from typing import Dict, List
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+IMMATERIAL_CHARS = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def split_segments(content: str) -> List[str]:
+    """Non-empty paragraphs of a post"""
+    return [segment.strip() for segment in PARAGRAPH_BREAK.split(content) if segment.strip()]
+
+
+def segment_hash(segment: str) -> str:
+    """Hash of a paragraph's material content"""
+    text = unicodedata.normalize("NFKC", segment).casefold()
+    text = " ".join(IMMATERIAL_CHARS.sub(" ", text).split())
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def diff_segments(previous_hashes: List[str], segments: List[str]) -> Dict[str, list]:
+    """
+    Compare an edited post's paragraphs with the hashes from the last moderation.
+
+    Returns the hashes of the edited post, the paragraphs whose material
+    content is new ("changed") and the previous hashes that no longer appear
+    ("removed"). Reordering paragraphs changes neither list.
+    """
+    hashes = [segment_hash(segment) for segment in segments]
+    previous = set(previous_hashes)
+    current = set(hashes)
+
+    changed, seen = [], set()
+    for segment, digest in zip(segments, hashes):
+        if digest not in previous and digest not in seen:
+            changed.append(segment)
+            seen.add(digest)
+
+    return {
+        "hashes": hashes,
+        "changed": changed,
+        "removed": [digest for digest in previous_hashes if digest not in current]
+    }
@@ -0,0 +1,70 @@
+"""
+Fast response encoding for the moderation and verification endpoints.
+
+Returning a model from a FastAPI endpoint with a response_model makes
+FastAPI validate it against that model again, run it through
+jsonable_encoder and json.dumps. The results returned here were built by
+the service itself (and validated then), so encode_response hands them
+straight to the encoder, which reads each model's field values as stored
+(no pydantic serialization pass, no intermediate dicts):
+
+- orjson when it is installed (the stdlib json module otherwise)
+- MessagePack when the caller's Accept header asks for
+  application/msgpack (or application/x-msgpack) and msgpack is
+  installed; callers that ask for it get JSON otherwise, marked by the
+  Content-Type
+
+The endpoints keep their response_model, so the OpenAPI schema is
+unchanged; a Response returned directly bypasses FastAPI's processing.
+Encoding now happens inside the handler, so traces show it as "encode".
+
+Only plain models belong here: field serializers, aliases and
+exclude settings are not applied.
+"""
+import json
+from typing import Any
+
+from fastapi import Request, Response
+
+from tracing import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, "application/x-msgpack")
+
+
+def model_fields(value: Any) -> dict:
+    """Encoder hook: a model's field values as they are (nested models come back here)"""
+    # Cheaper than isinstance(value, BaseModel), which goes through pydantic's metaclass
+    if hasattr(value, "__pydantic_fields_set__"):
+        return value.__dict__
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def dumps_json(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=model_fields)
+    return json.dumps(content, default=model_fields, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def wants_msgpack(request: Request) -> bool:
+    accept = request.headers.get("accept", "")
+    return msgpack is not None and any(media_type in accept for media_type in MSGPACK_MEDIA_TYPES)
+
+
+def encode_response(request: Request, value: Any) -> Response:
+    """Encode a service-built result as JSON or MessagePack, as the caller's Accept header prefers"""
+    with span("encode"):
+        if wants_msgpack(request):
+            return Response(content=msgpack.packb(value, default=model_fields), media_type=MSGPACK_MEDIA_TYPE)
+        return Response(content=dumps_json(value), media_type=JSON_MEDIA_TYPE)
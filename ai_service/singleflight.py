@@ -0,0 +1,159 @@
+"""
+In-flight request coalescing.
+
+Concurrent calls with the same key share one upstream call: the first
+caller starts it as a task, later callers await the same task, and the key
+is released as soon as it finishes. Callers await the task through
+asyncio.shield, so one caller disconnecting does not cancel the call for
+the others.
+
+With a Redis URL the coalescing also spans processes (uvicorn workers,
+replicas). The leader task takes a short Redis lock for the key before
+calling upstream; if another process holds it, the task polls the caller's
+lookup (normally the shared result cache) until the other process's
+result shows up, and only makes the call itself if the lock goes away
+without a result. Redis errors fall back to process-local coalescing.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from metrics import SINGLEFLIGHT_CALLS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Deduplicates concurrent async calls by key"""
+
+    def __init__(
+        self,
+        name: str,
+        redis_url: Optional[str] = None,
+        lock_seconds: float = 30.0,
+        poll_seconds: float = 0.05
+    ):
+        self.name = name
+        self.redis_url = redis_url
+        self.lock_seconds = lock_seconds
+        self.poll_seconds = poll_seconds
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._redis = None
+        self.leaders = 0
+        self.shared = 0
+        self.remote = 0
+
+    async def start(self):
+        """Connect to Redis for cross-process coalescing, if configured"""
+        if not self.redis_url or self._redis is not None:
+            return
+        try:
+            import redis.asyncio as redis
+
+            self._redis = redis.from_url(self.redis_url)
+            await self._redis.ping()
+        except Exception as e:
+            logger.warning(f"{self.name} flights: Redis unavailable, coalescing within this process only: {str(e)}")
+            self._redis = None
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.close()
+        self._redis = None
+
+    async def do(
+        self,
+        key: str,
+        func: Callable[[], Awaitable[T]],
+        lookup: Optional[Callable[[], Awaitable[Optional[T]]]] = None
+    ) -> T:
+        """
+        Run func() unless a call with the same key is already in flight.
+
+        lookup() returns the result another process stored for the key, or
+        None; without it, calls are only coalesced within this process.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(self._lead(key, func, lookup))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._release(key, done))
+            self.leaders += 1
+            SINGLEFLIGHT_CALLS.labels(self.name, "leader").inc()
+        else:
+            self.shared += 1
+            SINGLEFLIGHT_CALLS.labels(self.name, "shared").inc()
+
+        return await asyncio.shield(task)
+
+    async def _lead(self, key: str, func: Callable[[], Awaitable[T]], lookup) -> T:
+        if self._redis is None or lookup is None:
+            return await func()
+
+        lock_key = f"cop:flight:{self.name}:{key}"
+        try:
+            acquired = await self._redis.set(lock_key, self.instance_id, nx=True, px=int(self.lock_seconds * 1000))
+        except Exception as e:
+            logger.warning(f"{self.name} flights: Redis lock failed, calling upstream: {str(e)}")
+            return await func()
+
+        if acquired:
+            try:
+                return await func()
+            finally:
+                await self._unlock(lock_key)
+
+        # Another process is making this call; wait for its result
+        self.remote += 1
+        SINGLEFLIGHT_CALLS.labels(self.name, "remote").inc()
+        deadline = time.monotonic() + self.lock_seconds
+        delay = self.poll_seconds
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
+                result = await lookup()
+                if result is not None:
+                    return result
+                if not await self._redis.exists(lock_key):
+                    break
+            result = await lookup()
+            if result is not None:
+                return result
+        except Exception as e:
+            logger.warning(f"{self.name} flights: waiting on another process failed: {str(e)}")
+
+        # The other process failed (its results are never stored) or took too long
+        return await func()
+
+    async def _unlock(self, lock_key: str):
+        try:
+            # Only release our own lock, not one taken after ours expired
+            owner = await self._redis.get(lock_key)
+            if owner is not None and owner.decode() == self.instance_id:
+                await self._redis.delete(lock_key)
+        except Exception as e:
+            logger.warning(f"{self.name} flights: Redis unlock failed (lock expires on its own): {str(e)}")
+
+    def _release(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception as retrieved even if every caller went away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "shared": self.shared,
+            "remote": self.remote,
+            "redis_enabled": self._redis is not None
+        }
@@ -0,0 +1,94 @@
+"""
+Startup timing and readiness for the AI service.
+
+Each startup step (loading models, connecting Redis, warming upstream
+connections) is timed. Cold start is measured from the moment the process
+was created, read from /proc on Linux, so interpreter start-up and module
+imports are included; elsewhere it falls back to when this module was
+imported. Both are logged once the worker is ready, exported as gauges and
+reported on /health.
+
+Liveness and readiness are separate: a worker is live as soon as it
+serves HTTP, but only ready (worth sending traffic to) between the end of
+startup and the start of shutdown.
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from metrics import STARTUP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+_IMPORTED_AT = time.time()
+
+
+def process_start_time() -> float:
+    """Wall-clock time this process was created (module import time if unknown)"""
+    try:
+        with open("/proc/self/stat") as f:
+            # Field 22 (starttime) is in clock ticks since boot; the name in field 2 may contain spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime "))
+        return boot_time + int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return _IMPORTED_AT
+
+
+class StartupState:
+    """Times the startup steps and tracks whether the worker is ready"""
+
+    def __init__(self):
+        self.process_started = process_start_time()
+        self.startup_began: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        self.steps: Dict[str, float] = {}
+        self.ready = False
+        self.shutting_down = False
+
+    @contextmanager
+    def step(self, name: str):
+        """Time one startup step"""
+        if self.startup_began is None:
+            self.startup_began = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = round(time.perf_counter() - start, 4)
+            STARTUP_SECONDS.labels(name).set(self.steps[name])
+
+    def mark_ready(self):
+        self.ready_at = time.time()
+        self.ready = True
+        cold_start = self.ready_at - self.process_started
+        STARTUP_SECONDS.labels("imports").set(self.imports_seconds)
+        STARTUP_SECONDS.labels("cold_start").set(cold_start)
+        slowest = sorted(self.steps.items(), key=lambda item: item[1], reverse=True)[:3]
+        logger.info(
+            f"Ready {cold_start:.2f}s after process start "
+            f"(imports {self.imports_seconds:.2f}s, startup {self.ready_at - (self.startup_began or self.ready_at):.2f}s; "
+            f"slowest: {', '.join(f'{name} {seconds:.2f}s' for name, seconds in slowest)})"
+        )
+
+    def mark_shutting_down(self):
+        self.ready = False
+        self.shutting_down = True
+
+    @property
+    def imports_seconds(self) -> float:
+        """Process creation to the start of the startup phase (interpreter, imports, module setup)"""
+        return max((self.startup_began or time.time()) - self.process_started, 0.0)
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "shutting_down": self.shutting_down,
+            "cold_start_seconds": round(self.ready_at - self.process_started, 3) if self.ready_at else None,
+            "imports_seconds": round(self.imports_seconds, 3),
+            "steps": self.steps,
+            "uptime_seconds": round(time.time() - self.process_started, 1)
+        }
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Tests import the service modules the way main.py does (flat, from ai_service/)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main.py reads its config at import; give it a key so the LLM paths are enabled
+# (the tests replace the client, nothing reaches OpenAI)
+os.environ.setdefault("OPENAI_API_KEY", "test")
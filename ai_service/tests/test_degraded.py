@@ -0,0 +1,88 @@
+"""
+Degraded moderation: cached LLM verdicts are reused, including per-chunk
+verdicts of long posts, and only uncached posts get a guess and a re-check
+"""
+import asyncio
+import json
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+class FlaggingLLM:
+    """Stand-in for LLMClient.chat that flags content containing VIOLATION"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def chat(self, model: str, messages: list, timeout=None, **kwargs):
+        self.calls += 1
+        if "VIOLATION" in messages[-1]["content"]:
+            content = {"flagged": True, "violation_type": "harassment", "severity": 5, "confidence": 0.9}
+        else:
+            content = {"flagged": False, "confidence": 0.9}
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(content)))],
+            usage=None
+        )
+
+
+@pytest.fixture
+def rechecks(monkeypatch):
+    queued = []
+
+    async def queue_recheck(post):
+        queued.append(post.post_id)
+
+    monkeypatch.setattr(main.llm_client, "chat", FlaggingLLM().chat)
+    monkeypatch.setattr(main, "queue_recheck", queue_recheck)
+    monkeypatch.setattr(main, "MODERATION_MICROBATCH_ENABLED", False)
+    monkeypatch.setattr(main, "MODERATION_CHUNK_TOKENS", 60)
+    monkeypatch.setattr(main, "MODERATION_CHUNK_OVERLAP_TOKENS", 10)
+    return queued
+
+
+def long_post(violation: bool) -> main.PostContent:
+    paragraphs = [
+        f"Paragraph {index} on board reporting cadence and hiring plans for next year ({uuid.uuid4().hex})."
+        for index in range(12)
+    ]
+    if violation:
+        paragraphs[8] += " VIOLATION"
+    return main.PostContent(post_id=1, user_id=1, peer_id="Peer #001", content="\n\n".join(paragraphs))
+
+
+def test_long_post_uses_cached_chunk_verdicts(rechecks):
+    post = long_post(violation=True)
+    assert main.token_counter.count(post.content) > main.MODERATION_CHUNK_TOKENS
+
+    async def run():
+        full = await main.moderate_with_cache(post.content, post.post_id)
+        return full, await main.degraded_review(post)
+
+    full, degraded = asyncio.run(run())
+    assert full.flagged and full.tokens.chunks > 1
+    assert degraded.flagged
+    assert not degraded.degraded
+    assert degraded.violation_type == "harassment"
+    assert rechecks == []
+
+
+def test_long_post_with_a_missing_chunk_is_guessed(rechecks):
+    post = long_post(violation=True)
+
+    async def run():
+        await main.moderate_with_cache(post.content, post.post_id)
+        chunks, _ = main.budget_chunks(post.content)
+        await main.moderation_cache.invalidate(
+            main.moderation_cache.make_key(chunks[-1], main.MODERATION_MODEL, main.MODERATION_PROMPT_VERSION)
+        )
+        return await main.degraded_review(post)
+
+    degraded = asyncio.run(run())
+    assert degraded.degraded
+    assert not degraded.flagged
+    assert rechecks == [post.post_id]
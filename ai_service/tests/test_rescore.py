@@ -0,0 +1,98 @@
+"""
+Bulk rescoring: transient failures are retried, and an outage stops the run
+without leaving error lines that --resume would skip
+"""
+import argparse
+import asyncio
+import json
+
+import pytest
+
+import rescore
+from circuit_breaker import CircuitOpenError
+from main import ModerationResult
+
+
+class StandIn:
+    """review_content stand-in that fails while the upstream is down"""
+
+    def __init__(self, down_from: int = None):
+        self.down_from = down_from
+        self.calls = 0
+
+    async def review(self, content: str, post_id: int) -> ModerationResult:
+        self.calls += 1
+        if self.down_from is not None and post_id >= self.down_from:
+            raise CircuitOpenError("openai", 0)
+        return ModerationResult(flagged=False, confidence=0.9)
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    model = StandIn()
+
+    async def no_prefilter(content: str):
+        return None
+
+    monkeypatch.setattr(rescore, "prefilter_content", no_prefilter)
+    monkeypatch.setattr(rescore, "review_content", model.review)
+    return model
+
+
+def test_transient_errors_are_retried(stand_in, monkeypatch):
+    failures = [CircuitOpenError("openai", 0), asyncio.TimeoutError()]
+    review = stand_in.review
+
+    async def flaky(content: str, post_id: int):
+        if failures:
+            raise failures.pop(0)
+        return await review(content, post_id)
+
+    monkeypatch.setattr(rescore, "review_content", flaky)
+    line = asyncio.run(rescore.rescore_post(1, "hello", retries=3, backoff=0))
+    assert line["error"] is None
+    assert stand_in.calls == 1
+
+
+def test_other_errors_are_not_retried(stand_in, monkeypatch):
+    calls = []
+
+    async def broken(content: str, post_id: int):
+        calls.append(post_id)
+        raise ValueError("bad output")
+
+    monkeypatch.setattr(rescore, "review_content", broken)
+    line = asyncio.run(rescore.rescore_post(1, "hello", retries=3, backoff=0))
+    assert line["error"] == "ValueError: bad output"
+    assert len(calls) == 1
+
+
+def make_args(tmp_path, resume: bool = False) -> argparse.Namespace:
+    return argparse.Namespace(
+        input=str(tmp_path / "posts.jsonl"), output=str(tmp_path / "results.jsonl"), postgres=False,
+        checkpoint=None, checkpoint_every=4, resume=resume, concurrency=2, window=4, limit=0,
+        retries=0, retry_backoff=0, max_error_rate=0.5, error_window=6
+    )
+
+
+def test_outage_stops_the_run_and_resume_redoes_the_failures(stand_in, tmp_path):
+    with open(tmp_path / "posts.jsonl", "w") as f:
+        for post_id in range(1, 31):
+            f.write(json.dumps({"post_id": post_id, "content": f"post {post_id}"}) + "\n")
+
+    stand_in.down_from = 11
+    with pytest.raises(rescore.ErrorRateExceeded):
+        asyncio.run(rescore.rescore(make_args(tmp_path)))
+
+    checkpoint = rescore.load_checkpoint(str(tmp_path / "results.jsonl.checkpoint"))
+    assert checkpoint["done"] == 10
+    assert checkpoint["errors"] == 0
+    assert checkpoint["last_post_id"] == 10
+
+    stand_in.down_from = None
+    summary = asyncio.run(rescore.rescore(make_args(tmp_path, resume=True)))
+    with open(tmp_path / "results.jsonl") as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["post_id"] for line in lines] == list(range(1, 31))
+    assert all(line["error"] is None for line in lines)
+    assert summary["done"] == 30
@@ -0,0 +1,84 @@
+"""
+Upstream scheduler: cancelled waiters must never take or leak a slot
+"""
+import asyncio
+import random
+
+from scheduler import INTERACTIVE, ModelLimiter
+
+
+async def acquire_at_once(limiter: ModelLimiter) -> bool:
+    """Whether a fresh acquire is granted within a second"""
+    try:
+        grant = await asyncio.wait_for(limiter.acquire(10, INTERACTIVE, "fresh"), 1.0)
+    except asyncio.TimeoutError:
+        return False
+    grant.release()
+    return True
+
+
+def test_release_with_cancelled_waiter_queued():
+    async def run():
+        limiter = ModelLimiter("test", max_concurrency=1)
+        holder = await limiter.acquire(10, INTERACTIVE, "a")
+        waiter = asyncio.create_task(limiter.acquire(10, INTERACTIVE, "b"))
+        await asyncio.sleep(0)  # the waiter is queued
+
+        # Cancelling marks the waiter's future cancelled at once; its task has
+        # not run yet when the only slot is released
+        waiter.cancel()
+        holder.release()
+        assert limiter.in_flight == 0
+
+        results = await asyncio.gather(waiter, return_exceptions=True)
+        assert isinstance(results[0], asyncio.CancelledError)
+        assert await acquire_at_once(limiter)
+
+    asyncio.run(run())
+
+
+def test_cancelled_acquire_after_grant_returns_slot():
+    async def run():
+        limiter = ModelLimiter("test", max_concurrency=1)
+        holder = await limiter.acquire(10, INTERACTIVE, "a")
+        waiter = asyncio.create_task(limiter.acquire(10, INTERACTIVE, "b"))
+        await asyncio.sleep(0)
+
+        # The slot is handed to the waiter, which is cancelled before it resumes
+        holder.release()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        assert limiter.in_flight == 0
+        assert await acquire_at_once(limiter)
+
+    asyncio.run(run())
+
+
+def test_wait_for_deadlines_do_not_leak_slots():
+    async def run():
+        limiter = ModelLimiter("stress", max_concurrency=4)
+        rng = random.Random(7)
+
+        async def call(index: int):
+            grant = await limiter.acquire(10, INTERACTIVE, f"flow{index % 3}")
+            try:
+                await asyncio.sleep(rng.uniform(0, 0.004))
+            finally:
+                grant.release()
+
+        async def bounded(index: int):
+            # Deadlines cancel calls while queued, just granted or holding a slot
+            try:
+                await asyncio.wait_for(call(index), rng.uniform(0, 0.01))
+            except asyncio.TimeoutError:
+                pass
+
+        await asyncio.gather(*(bounded(index) for index in range(2000)))
+
+        stats = limiter.stats()
+        assert stats["in_flight"] == 0
+        assert not any(stats["waiting"].values())
+        assert await acquire_at_once(limiter)
+
+    asyncio.run(run())
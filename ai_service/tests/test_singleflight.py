@@ -0,0 +1,78 @@
+"""
+In-flight deduplication: N concurrent identical requests make one upstream call
+"""
+import asyncio
+import json
+import uuid
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import main
+
+CONCURRENCY = 50
+
+
+class CountingLLM:
+    """Stand-in for LLMClient.chat that counts calls and answers after a delay"""
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.calls = 0
+
+    async def chat(self, model: str, messages: list, timeout=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if "Vera" in messages[0]["content"]:
+            content = json.dumps({
+                "recommendation": "review_required",
+                "confidence_score": 0.5,
+                "risk_factors": [],
+                "analysis": {"notes": "stand-in"}
+            })
+        else:
+            content = json.dumps({"flagged": False, "confidence": 0.8})
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=None
+        )
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    counting = CountingLLM()
+    monkeypatch.setattr(main.llm_client, "chat", counting.chat)
+    return counting
+
+
+async def fire(path: str, body: dict) -> list:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await asyncio.gather(*(client.post(path, json=body) for _ in range(CONCURRENCY)))
+
+
+def test_concurrent_moderate_makes_one_upstream_call(llm):
+    # Unique content, so neither the result cache nor another test answers it
+    body = {
+        "post_id": 42, "user_id": 7, "peer_id": "Peer #007",
+        "content": f"Has anyone restructured their board committees after an IPO? ({uuid.uuid4().hex})"
+    }
+    responses = asyncio.run(fire("/moderate", body))
+
+    assert llm.calls == 1
+    assert {response.status_code for response in responses} == {200}
+    assert len({response.text for response in responses}) == 1
+
+
+def test_concurrent_verify_makes_one_upstream_call(llm):
+    body = {
+        "user_info": {"name": "A. Person", "title": "CFO", "company": f"Example Corp {uuid.uuid4().hex}"},
+        "application_data": {},
+        "criteria": [{"name": "Executive role", "description": "C-level title", "weight": 1.0}]
+    }
+    responses = asyncio.run(fire("/verify", body))
+
+    assert llm.calls == 1
+    assert {response.status_code for response in responses} == {200}
+    assert len({response.text for response in responses}) == 1
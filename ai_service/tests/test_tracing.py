@@ -0,0 +1,52 @@
+"""
+Request tracing: Server-Timing is only returned to sampled or authorized requests
+"""
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from tracing import Tracer
+
+
+def test_force_needs_the_configured_token():
+    tracer = Tracer(force_token="s3cret")
+    assert tracer.forced("s3cret")
+    assert not tracer.forced("1")
+    assert not tracer.forced("")
+    assert not tracer.forced(None)
+
+
+def test_force_is_disabled_without_a_token():
+    tracer = Tracer()
+    assert not tracer.forced("1")
+    assert not tracer.forced("")
+
+
+def server_timing(headers: dict):
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/", headers=headers)
+
+    return asyncio.run(run()).headers.get("server-timing")
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    tracer = Tracer(sample_rate=0.0, force_token="s3cret")
+    monkeypatch.setattr(main, "tracer", tracer)
+    return tracer
+
+
+def test_server_timing_only_for_authorized_force(tracer):
+    assert server_timing({}) is None
+    assert server_timing({main.TRACE_FORCE_HEADER: "1"}) is None
+    assert server_timing({main.TRACE_FORCE_HEADER: "wrong"}) is None
+    assert "total;dur=" in server_timing({main.TRACE_FORCE_HEADER: "s3cret"})
+
+
+def test_server_timing_on_sampled_requests(tracer):
+    tracer.sample_rate = 1.0
+    assert "total;dur=" in server_timing({})
@@ -0,0 +1,94 @@
+"""
+Token counting and token-aware chunking for LLM prompts.
+
+Uses tiktoken when it is installed and its encoding can be loaded (the BPE
+files are fetched on first use, or read from TIKTOKEN_CACHE_DIR). Otherwise
+it falls back to an estimate of four characters per token, which is close
+enough for budgeting English text. The encoding is loaded on the first
+count, or earlier by calling load(), so constructing a counter never
+touches the network.
+
+Chunks are cut on word boundaries, packed up to max_tokens, and each chunk
+repeats the last overlap_tokens of the previous one so a violation spanning
+a boundary is seen whole by at least one chunk.
+"""
+import logging
+import math
+import re
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+WORD_RE = re.compile(r"\S+\s*")
+
+
+class TokenCounter:
+    """Counts tokens for a model and splits text into overlapping token-bounded chunks"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self._encoding = None
+        self._loaded = False
+
+    def load(self) -> bool:
+        """Load the tiktoken encoding if it is not loaded yet; False when estimating instead"""
+        if self._loaded:
+            return self._encoding is not None
+        try:
+            import tiktoken
+
+            try:
+                self._encoding = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+        except ImportError:
+            logger.info("tiktoken not installed, estimating token counts")
+        except Exception as e:
+            logger.warning(f"Could not load tiktoken encoding for {self.model}, estimating token counts: {str(e)}")
+        self._loaded = True
+        return self._encoding is not None
+
+    @property
+    def exact(self) -> bool:
+        return self.load()
+
+    def count(self, text: str) -> int:
+        """Tokens in the text"""
+        if not self._loaded:
+            self.load()
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+    def split(self, text: str, max_tokens: int, overlap_tokens: int = 0) -> List[Tuple[str, int]]:
+        """(chunk, token count) pairs covering the text, each at most about max_tokens"""
+        overlap_tokens = min(overlap_tokens, max_tokens // 2)
+        words = []
+        for match in WORD_RE.finditer(text):
+            word = match.group()
+            # Cut pathological "words" (base64, long URLs) so no chunk exceeds the limit by much
+            for offset in range(0, len(word), max_tokens):
+                piece = word[offset:offset + max_tokens]
+                words.append((piece, self.count(piece)))
+
+        chunks = []
+        start = 0
+        while start < len(words):
+            end, total = start, 0
+            # Always take at least one word, even one longer than max_tokens
+            while end < len(words) and (end == start or total + words[end][1] <= max_tokens):
+                total += words[end][1]
+                end += 1
+            chunks.append(("".join(word for word, _ in words[start:end]).strip(), total))
+            if end >= len(words):
+                break
+
+            # Step back over the overlap, but always move forward
+            back, carried = end, 0
+            while back > start + 1 and carried + words[back - 1][1] <= overlap_tokens:
+                back -= 1
+                carried += words[back][1]
+            start = back
+
+        return chunks
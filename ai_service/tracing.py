@@ -0,0 +1,196 @@
+"""
+Per-request stage tracing.
+
+A sampled request, or one whose caller forces tracing, gets a Trace in a
+context variable. Pipeline stages
+(metrics.time_stage and tracing.span) add spans to it, and when the
+response is ready the spans are summarized in a Server-Timing header and,
+if configured, exported as OpenTelemetry spans.
+
+Sampling is off unless a rate is configured. A caller can force a trace
+(and get Server-Timing back) only by presenting the configured force token,
+so by default stage timings are not exposed to anyone. Sampled requests do
+carry Server-Timing, so only enable a sample rate where every caller is
+trusted. Unsampled requests have no Trace, so a stage costs one context
+variable lookup on top of its timing.
+
+OpenTelemetry is optional. Export is enabled when OTEL_EXPORTER_OTLP_ENDPOINT
+is set and opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http are
+installed. Spans are exported after the response, from the recorded
+timings, so the request path never calls into the SDK.
+"""
+import functools
+import hmac
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+
+
+class Trace:
+    """Spans recorded for one request, as (name, start, duration) in perf_counter seconds"""
+
+    __slots__ = ("name", "started", "wall_started", "spans", "handler_started", "handler_finished")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.wall_started = time.time_ns()
+        self.spans: List[Tuple[str, float, float]] = []
+        self.handler_started: Optional[float] = None
+        self.handler_finished: Optional[float] = None
+
+    def add(self, name: str, start: float, duration: float):
+        self.spans.append((name, start, duration))
+
+    def finish(self) -> float:
+        """Close the request, adding parse/validate and serialize spans around the handler"""
+        finished = time.perf_counter()
+        if self.handler_started is not None:
+            self.add("parse_validate", self.started, self.handler_started - self.started)
+        if self.handler_finished is not None:
+            self.add("serialize", self.handler_finished, finished - self.handler_finished)
+        self.add("total", self.started, finished - self.started)
+        return finished
+
+    def server_timing(self) -> str:
+        """Server-Timing header value; repeated stages are summed with a count"""
+        totals: Dict[str, List[float]] = {}
+        for name, _, duration in self.spans:
+            entry = totals.setdefault(name, [0.0, 0])
+            entry[0] += duration
+            entry[1] += 1
+        parts = []
+        for name, (duration, count) in totals.items():
+            part = f"{name};dur={duration * 1000:.2f}"
+            if count > 1:
+                part += f';desc="x{count}"'
+            parts.append(part)
+        return ", ".join(parts)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+def record_span(name: str, start: float, duration: float):
+    """Add a finished span to the current trace, if the request is sampled"""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, start, duration)
+
+
+@contextmanager
+def span(name: str):
+    """Trace a block without exporting it as a Prometheus stage"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.perf_counter() - start)
+
+
+def traced_handler(func):
+    """
+    Mark an endpoint's body as the handler, so the time before it is reported
+    as parse_validate (body parsing and pydantic validation) and the time
+    after it as serialize
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        trace = _current.get()
+        if trace is None:
+            return await func(*args, **kwargs)
+        trace.handler_started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            trace.handler_finished = time.perf_counter()
+
+    return wrapper
+
+
+class Tracer:
+    """Decides which requests are traced and exports finished traces"""
+
+    def __init__(
+        self,
+        sample_rate: float = 0.0,
+        otlp_endpoint: Optional[str] = None,
+        service_name: str = "cop-ai-service",
+        force_token: Optional[str] = None
+    ):
+        self.sample_rate = sample_rate
+        self.force_token = force_token
+        self.service_name = service_name
+        self._otel_tracer = None
+        # Forced traces are exported too, so the exporter does not depend on the rate
+        if otlp_endpoint:
+            self._otel_tracer = self._start_otel(otlp_endpoint)
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def forced(self, token: Optional[str]) -> bool:
+        """Whether a request's force header carries the configured token (never, without one)"""
+        if not self.force_token or not token:
+            return False
+        return hmac.compare_digest(token.encode(), self.force_token.encode())
+
+    def _start_otel(self, endpoint: str):
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        except ImportError:
+            logger.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set but opentelemetry-sdk is not installed, not exporting spans")
+            return None
+
+        provider = TracerProvider(resource=Resource.create({"service.name": self.service_name}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+        self._provider = provider
+        logger.info(f"Exporting trace spans to {endpoint}")
+        return provider.get_tracer("cop-ai-service")
+
+    def start(self, name: str, force: bool = False) -> Optional[Trace]:
+        """Begin a trace for the current request if it is sampled (or forced)"""
+        if not force and (self.sample_rate <= 0 or (self.sample_rate < 1 and random.random() >= self.sample_rate)):
+            return None
+        trace = Trace(name)
+        _current.set(trace)
+        return trace
+
+    def export(self, trace: Trace, finished: float, attributes: Optional[dict] = None):
+        """Send a finished trace to the OpenTelemetry collector as a root span with stage children"""
+        if self._otel_tracer is None:
+            return
+        from opentelemetry import trace as otel_trace
+
+        def wall(perf: float) -> int:
+            return trace.wall_started + int((perf - trace.started) * 1e9)
+
+        root = self._otel_tracer.start_span(trace.name, start_time=trace.wall_started, attributes=attributes or {})
+        context = otel_trace.set_span_in_context(root)
+        for name, start, duration in trace.spans:
+            if name == "total":
+                continue
+            child = self._otel_tracer.start_span(name, context=context, start_time=wall(start))
+            child.end(end_time=wall(start + duration))
+        root.end(end_time=wall(finished))
+
+    def shutdown(self):
+        provider = getattr(self, "_provider", None)
+        if provider is not None:
+            provider.shutdown()
@@ -0,0 +1,356 @@
+"""
+Bounded work queue with a fixed worker pool.
+
+Used for webhook moderation instead of FastAPI BackgroundTasks, which
+accepts unlimited work and loses everything pending on restart.
+
+- Backends: an in-memory queue, or a Redis list (REDIS_URL) that survives
+  restarts. In Redis mode each job is moved to a per-instance processing
+  list while it runs; lists left behind by a dead instance (its heartbeat
+  key expired) are pushed back onto the queue at startup.
+- enqueue() raises QueueFullError once max_size jobs are waiting, so the
+  caller can reject the request instead of buffering without limit.
+- Failed jobs are retried with exponential backoff and jitter, then
+  logged (and kept on a Redis dead-letter list) after max_retries. In
+  Redis mode a job waiting out its backoff sits in a sorted set scored by
+  when it is due (moved there from the processing list in one
+  transaction), and every instance polls it back onto the queue, so a
+  crash during the backoff loses nothing.
+- stop() stops accepting work and drains the queue before cancelling the
+  workers.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the queue cannot accept more work"""
+
+
+class WorkQueue:
+    """Bounded async job queue with retries and graceful shutdown"""
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[dict], Awaitable[None]],
+        max_size: int = 1000,
+        workers: int = 4,
+        max_retries: int = 3,
+        retry_backoff_seconds: float = 1.0,
+        retry_backoff_max_seconds: float = 60.0,
+        redis_url: Optional[str] = None,
+        heartbeat_seconds: float = 10.0,
+        retry_poll_seconds: float = 0.5
+    ):
+        self.name = name
+        self.handler = handler
+        self.max_size = max_size
+        self.worker_count = workers
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.retry_backoff_max_seconds = retry_backoff_max_seconds
+        self.redis_url = redis_url
+        self.heartbeat_seconds = heartbeat_seconds
+        self.retry_poll_seconds = retry_poll_seconds
+
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._queue_key = f"cop:queue:{name}"
+        self._dead_key = f"cop:queue:{name}:dead"
+        self._retry_key = f"cop:queue:{name}:retry"
+        self._processing_key = f"cop:queue:{name}:processing:{self.instance_id}"
+        self._alive_key = f"cop:queue:{name}:alive:{self.instance_id}"
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._redis = None
+        self._workers = []
+        self._retry_tasks = set()
+        self._heartbeat_task = None
+        self._retry_poll_task = None
+        self._closing = False
+        self._in_flight = 0
+
+        self.enqueued = 0
+        self.rejected = 0
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def backend(self) -> str:
+        return "redis" if self._redis is not None else "memory"
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def start(self):
+        """Connect the backend and start the worker pool"""
+        self._closing = False
+        self._queue = asyncio.Queue()
+
+        if self.redis_url:
+            try:
+                import redis.asyncio as redis
+
+                self._redis = redis.from_url(self.redis_url)
+                await self._redis.ping()
+                await self._heartbeat()
+                await self._recover_orphans()
+                self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+                self._retry_poll_task = asyncio.create_task(self._retry_poll_loop())
+            except Exception as e:
+                logger.warning(f"{self.name} queue Redis backend unavailable, using memory: {str(e)}")
+                self._redis = None
+
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+        logger.info(f"{self.name} queue started ({self.backend} backend, {self.worker_count} workers, max {self.max_size})")
+
+    async def enqueue(self, payload: dict):
+        """Add a job, raising QueueFullError if the queue is full or shutting down"""
+        if self._closing:
+            self.rejected += 1
+            raise QueueFullError(f"{self.name} queue is shutting down")
+        if await self.depth() >= self.max_size:
+            self.rejected += 1
+            raise QueueFullError(f"{self.name} queue is full ({self.max_size} jobs)")
+
+        # The id keeps identical payloads apart in the Redis retry set
+        await self._push({"id": uuid.uuid4().hex, "payload": payload, "attempts": 0})
+        self.enqueued += 1
+
+    async def depth(self) -> int:
+        """Number of jobs waiting to be picked up"""
+        if self._redis is not None:
+            try:
+                return await self._redis.llen(self._queue_key)
+            except Exception as e:
+                logger.warning(f"{self.name} queue Redis llen error: {str(e)}")
+                return 0
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def pending_retries(self) -> int:
+        """Failed jobs waiting out their backoff"""
+        if self._redis is not None:
+            try:
+                return await self._redis.zcard(self._retry_key)
+            except Exception as e:
+                logger.warning(f"{self.name} queue Redis zcard error: {str(e)}")
+                return 0
+        return len(self._retry_tasks)
+
+    async def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "depth": await self.depth(),
+            "in_flight": self._in_flight,
+            "pending_retries": await self.pending_retries(),
+            "max_size": self.max_size,
+            "workers": self.worker_count,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "retried": self.retried,
+            "failed": self.failed
+        }
+
+    async def stop(self, timeout: float = 30.0):
+        """Stop accepting work, drain what is queued, then stop the workers"""
+        self._closing = True
+        deadline = time.monotonic() + timeout
+
+        if self._redis is not None:
+            # The backlog and pending retries are durable; only let in-flight jobs finish
+            while self._in_flight and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+        else:
+            while (self._queue.qsize() or self._in_flight or self._retry_tasks) and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            if self._queue.qsize() or self._retry_tasks:
+                logger.warning(
+                    f"{self.name} queue stopped with {self._queue.qsize()} queued and "
+                    f"{len(self._retry_tasks)} pending retries undelivered"
+                )
+
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._retry_tasks, return_exceptions=True)
+        self._workers = []
+
+        for task in (self._heartbeat_task, self._retry_poll_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._heartbeat_task = None
+        self._retry_poll_task = None
+        if self._redis is not None:
+            try:
+                await self._redis.delete(self._alive_key)
+            except Exception as e:
+                logger.warning(f"{self.name} queue heartbeat cleanup error: {str(e)}")
+            await self._redis.close()
+            self._redis = None
+        logger.info(f"{self.name} queue stopped")
+
+    async def _push(self, job: dict):
+        if self._redis is not None:
+            await self._redis.lpush(self._queue_key, json.dumps(job))
+        else:
+            self._queue.put_nowait(job)
+
+    async def _pop(self):
+        """Wait for the next job; returns (job, raw) where raw is the Redis entry"""
+        if self._redis is not None:
+            raw = await self._redis.blmove(self._queue_key, self._processing_key, 1, "RIGHT", "LEFT")
+            if raw is None:
+                return None, None
+            return json.loads(raw), raw
+        return await self._queue.get(), None
+
+    async def _worker(self):
+        while True:
+            try:
+                job, raw = await self._pop()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"{self.name} queue pop error: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+            if job is None:
+                continue
+
+            self._in_flight += 1
+            try:
+                await self._run(job, raw)
+            finally:
+                self._in_flight -= 1
+
+    async def _ack(self, raw):
+        """Drop a finished job from this instance's processing list"""
+        if raw is None:
+            return
+        try:
+            await self._redis.lrem(self._processing_key, 1, raw)
+        except Exception as e:
+            logger.error(f"{self.name} queue ack error: {str(e)}")
+
+    async def _run(self, job: dict, raw):
+        try:
+            await self.handler(job["payload"])
+            self.processed += 1
+        except Exception as e:
+            job["attempts"] += 1
+            if job["attempts"] > self.max_retries:
+                self.failed += 1
+                logger.error(f"{self.name} job failed after {job['attempts']} attempts: {str(e)}")
+                await self._dead_letter(job, str(e))
+                await self._ack(raw)
+                return
+
+            self.retried += 1
+            delay = min(
+                self.retry_backoff_seconds * 2 ** (job["attempts"] - 1),
+                self.retry_backoff_max_seconds
+            ) * random.uniform(0.5, 1.0)
+            logger.warning(f"{self.name} job attempt {job['attempts']} failed, retrying in {delay:.1f}s: {str(e)}")
+
+            if raw is not None:
+                await self._schedule_retry(job, raw, delay)
+                return
+            task = asyncio.create_task(self._retry_later(job, delay))
+            self._retry_tasks.add(task)
+            task.add_done_callback(self._retry_tasks.discard)
+        else:
+            await self._ack(raw)
+
+    async def _retry_later(self, job: dict, delay: float):
+        await asyncio.sleep(delay)
+        await self._push(job)
+
+    async def _schedule_retry(self, job: dict, raw, delay: float):
+        """Move a failed job from the processing list to the retry set in one transaction"""
+        try:
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.zadd(self._retry_key, {json.dumps(job): time.time() + delay})
+                pipe.lrem(self._processing_key, 1, raw)
+                await pipe.execute()
+        except Exception as e:
+            # Still in the processing list: recovered (and run again) after a restart
+            logger.error(f"{self.name} queue retry scheduling error: {str(e)}")
+
+    async def _promote_due_retries(self, limit: int = 100) -> int:
+        """Move retries whose backoff has passed back onto the queue"""
+        import redis.asyncio as redis
+
+        async with self._redis.pipeline(transaction=True) as pipe:
+            # Other instances poll the same set; WATCH makes sure each job moves once
+            await pipe.watch(self._retry_key)
+            due = await pipe.zrangebyscore(self._retry_key, "-inf", time.time(), start=0, num=limit)
+            if not due:
+                await pipe.unwatch()
+                return 0
+            pipe.multi()
+            pipe.zrem(self._retry_key, *due)
+            pipe.lpush(self._queue_key, *due)
+            try:
+                await pipe.execute()
+            except redis.WatchError:
+                return 0
+        return len(due)
+
+    async def _retry_poll_loop(self):
+        while True:
+            try:
+                while await self._promote_due_retries():
+                    pass
+            except Exception as e:
+                logger.warning(f"{self.name} queue retry poll error: {str(e)}")
+            await asyncio.sleep(self.retry_poll_seconds)
+
+    async def _dead_letter(self, job: dict, error: str):
+        if self._redis is None:
+            return
+        try:
+            await self._redis.lpush(self._dead_key, json.dumps({**job, "error": error}))
+        except Exception as e:
+            logger.error(f"{self.name} queue dead-letter error: {str(e)}")
+
+    async def _heartbeat(self):
+        await self._redis.set(self._alive_key, "1", ex=int(self.heartbeat_seconds * 3))
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_seconds)
+            try:
+                await self._heartbeat()
+            except Exception as e:
+                logger.warning(f"{self.name} queue heartbeat error: {str(e)}")
+
+    async def _recover_orphans(self):
+        """Requeue jobs left in processing lists by instances that died"""
+        prefix = f"cop:queue:{self.name}:processing:"
+        async for key in self._redis.scan_iter(match=prefix + "*"):
+            key = key.decode() if isinstance(key, bytes) else key
+            instance_id = key[len(prefix):]
+            # Our own list is stale at startup too: a restarted container
+            # usually comes back with the same hostname and pid
+            if instance_id != self.instance_id and await self._redis.exists(
+                f"cop:queue:{self.name}:alive:{instance_id}"
+            ):
+                continue
+
+            recovered = 0
+            while await self._redis.lmove(key, self._queue_key, "RIGHT", "RIGHT"):
+                recovered += 1
+            if recovered:
+                logger.info(f"{self.name} queue recovered {recovered} jobs from {instance_id}")
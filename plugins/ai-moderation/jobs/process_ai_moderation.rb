@@ -1,5 +1,15 @@
 module Jobs
   class ProcessAiModeration < ::Jobs::Base
+    # An overloaded AI service answers without its LLM ("degraded": true, never flagged)
+    # and re-checks the post in the background; ask again once that verdict is cached.
+    # Keep asking until a full verdict arrives: with the flag outbox off (the default)
+    # this job is the only thing that can flag the post. The wait grows by
+    # DEGRADED_RETRY_DELAY per retry up to DEGRADED_MAX_RETRY_DELAY, with a warning
+    # from DEGRADED_WARN_RETRIES on so a long overload is visible.
+    DEGRADED_RETRY_DELAY = 2.minutes
+    DEGRADED_MAX_RETRY_DELAY = 10.minutes
+    DEGRADED_WARN_RETRIES = 3
+    
     def execute(args)
       post_id = args[:post_id]
       return unless post_id
@@ -13,6 +23,21 @@ module Jobs
       # Call AI service for moderation
       ai_result = call_ai_moderation_service(post)
       
+      if ai_result && ai_result[:degraded]
+        retries = args[:degraded_retries].to_i
+        delay = [DEGRADED_RETRY_DELAY * (retries + 1), DEGRADED_MAX_RETRY_DELAY].min
+        if retries >= DEGRADED_WARN_RETRIES
+          Rails.logger.warn "AI moderation of post #{post_id} still degraded after #{retries} retries, asking again in #{delay.inspect}"
+        end
+        Jobs.enqueue_in(
+          delay,
+          :process_ai_moderation,
+          post_id: post_id,
+          degraded_retries: retries + 1
+        )
+        return
+      end
+      
       if ai_result && ai_result[:flagged]
         create_ai_flag(post, ai_result)
       end
@@ -32,15 +57,22 @@ module Jobs
           thread_id: post.topic_id
         }
         
-        # Call FastAPI service
+        # Call FastAPI service (MessagePack replies are smaller and cheaper to parse)
         response = HTTP.post(
           "#{ai_service_url}/moderate",
           json: request_data,
-          headers: { 'Content-Type' => 'application/json' }
+          headers: {
+            'Content-Type' => 'application/json',
+            'Accept' => defined?(MessagePack) ? 'application/msgpack, application/json;q=0.9' : 'application/json'
+          }
         )
         
         if response.status.success?
-          JSON.parse(response.body.to_s, symbolize_names: true)
+          if response.mime_type == 'application/msgpack'
+            MessagePack.unpack(response.body.to_s, symbolize_keys: true)
+          else
+            JSON.parse(response.body.to_s, symbolize_names: true)
+          end
         else
           Rails.logger.error "AI moderation service error: #{response.status} - #{response.body}"
           nil